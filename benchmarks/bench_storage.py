@@ -0,0 +1,267 @@
+import os
+import sys
+import io
+import gc
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import datetime
+import subprocess
+import tracemalloc
+
+# Benchmarks for the history and storage paths (CPU only, no models):
+# builds synthetic output directories of mixed V1/V2 t2i / i2i / i2t logs and
+# images, then measures latency and Python memory of history indexing,
+# listing, filtering, uploads and delete.
+#
+#   python benchmarks/bench_storage.py                      # 1k, 10k, 100k
+#   python benchmarks/bench_storage.py --sizes 1000 --out a.json
+#   python benchmarks/bench_storage.py --compare base.json new.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+LORAS = [f"style_{i}.safetensors" for i in range(10)]
+DAY = 86400
+
+def _tiny_png(color=(40, 80, 120)):
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 8), color).save(buf, format="PNG")
+    return buf.getvalue()
+
+def _log(kind, name, rng, png_name):
+    """One synthetic generation log in the V1 or V2 layout handled by history_index.build_entry."""
+    mode, version = kind
+    prompt = f"synthetic prompt {rng.randint(0, 10**6)}"
+    seed = rng.randint(0, 2**32 - 1)
+    loras = [[f"/app/loras/{n}", 0.8, True] for n in rng.sample(LORAS, rng.randint(0, 2))]
+    params = {"width": 1024, "height": 1024, "steps": 30, "guidance": 3.0, "seed": seed,
+              "top_k": 1, "temperature": 0.6}
+    if version == 1:
+        data = {"parameters": dict(params, mode=mode, prompt=prompt), "input": {"prompt": prompt}}
+        if mode != "t2i":
+            data["input"]["source_image"] = "/app/outputs/upload.png"
+        if mode == "i2t":
+            data["output"] = {"text": "synthetic caption"}
+        return data
+    data = {
+        "meta": {"version": "2.0", "mode": mode, "timestamp": "", "job_id": name},
+        "inputs": {"prompt": prompt, "loras": loras},
+        "parameters": params,
+        "outputs": {"type": "image", "files": [png_name]}
+    }
+    if mode == "i2i":
+        data["inputs"]["source_images"] = ["upload.png"]
+    if mode == "i2t":
+        data["inputs"] = {"prompt": prompt, "source_images": ["upload.png"]}
+        data["outputs"] = {"type": "text", "text_content": {
+            "thinking_process": "synthetic " * 40, "final_answer": "synthetic caption " * 20, "raw_full_response": ""}}
+    return data
+
+# (mode, log version) -> share of the generated entries
+MIX = [(("t2i", 2), 40), (("t2i", 1), 15), (("i2i", 2), 15), (("i2i", 1), 10), (("i2t", 2), 15), (("i2t", 1), 5)]
+
+def make_dataset(output_dir, thumb_dir, count, seed=0):
+    """Writes count log/image pairs (i2t: log only) with mtimes spread over a year, plus 2 thumbnails per image."""
+    rng = random.Random(seed)
+    png = _tiny_png()
+    kinds = [kind for kind, share in MIX for _ in range(share)]
+    now = time.time()
+    names = []
+    for i in range(count):
+        mode, version = kind = rng.choice(kinds)
+        base = f"{mode}_{1700000000 + i}"
+        png_name = base + ".png"
+        mtime = now - rng.random() * 365 * DAY
+        if mode != "i2t":
+            path = os.path.join(output_dir, png_name)
+            with open(path, "wb") as f:
+                f.write(png)
+            os.utime(path, (mtime, mtime))
+            for size in (128, 256):
+                open(os.path.join(thumb_dir, f"{i:040x}_{size}.webp"), "wb").close()
+        json_path = os.path.join(output_dir, base + ".json")
+        with open(json_path, "w") as f:
+            json.dump(_log(kind, base, rng, png_name), f)
+        os.utime(json_path, (mtime, mtime))
+        names.append(base + ".json")
+    with open(os.path.join(output_dir, "upload.png"), "wb") as f:
+        f.write(png)
+    return names
+
+def measure(fn, repeat=1):
+    """
+    Runs fn repeat times for latency (ms), then once more under tracemalloc for
+    the peak Python allocation (KB); tracing is too slow to leave on while timing.
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times.sort()
+    return {
+        "n": repeat,
+        "mean_ms": round(sum(times) / len(times), 3),
+        "p50_ms": round(times[len(times) // 2], 3),
+        "p95_ms": round(times[min(len(times) - 1, int(len(times) * 0.95))], 3),
+        "max_ms": round(times[-1], 3),
+        "peak_kb": round(peak / 1024, 1)
+    }
+
+def bench_size(count, workdir, repeat):
+    import history_index
+    import thumbnails
+    import storage
+
+    output_dir = os.path.join(workdir, "outputs")
+    thumb_dir = os.path.join(workdir, "thumbs")
+    db_path = os.path.join(workdir, "history_index.db")
+    os.makedirs(output_dir)
+    os.makedirs(thumb_dir)
+    thumbnails.THUMB_DIR = thumb_dir
+
+    start = time.perf_counter()
+    names = make_dataset(output_dir, thumb_dir, count)
+    print(f"--> [Bench] {count} entries generated in {time.perf_counter() - start:.1f}s", flush=True)
+
+    rng = random.Random(1)
+    results = {}
+
+    def run(op, fn, n=repeat):
+        results[op] = measure(fn, n)
+        print(f"    {op:<24} mean {results[op]['mean_ms']:>10.2f} ms   p95 {results[op]['p95_ms']:>10.2f} ms   "
+              f"peak {results[op]['peak_kb']:>10.1f} KB", flush=True)
+
+    # History: index build from scratch, then the steady state (nothing changed on disk)
+    def reconcile_cold():
+        for path in (db_path, db_path + "-wal", db_path + "-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+        history_index._ready.discard(db_path)
+        history_index.reconcile(output_dir, db_path)
+    run("reconcile_cold", reconcile_cold, 1)
+    run("reconcile_warm", lambda: history_index.reconcile(output_dir, db_path))
+
+    query = lambda **kw: history_index.query(db_path=db_path, **kw)
+    run("list_first_page", lambda: query(limit=50))
+    run("list_first_page_summary", lambda: query(limit=50, summary=True))
+
+    def walk_all():
+        cursor = None
+        while True:
+            _, cursor = query(limit=history_index.MAX_LIMIT, cursor=cursor, summary=True)
+            if not cursor:
+                break
+    run("list_all_pages", walk_all, max(1, repeat // 5))
+
+    _, deep_cursor = query(limit=min(count // 2, history_index.MAX_LIMIT))
+    run("list_deep_page", lambda: query(limit=50, cursor=deep_cursor))
+    run("filter_mode", lambda: query(limit=50, mode="i2i"))
+    run("filter_lora", lambda: query(limit=50, lora=LORAS[3]))
+    run("filter_seed", lambda: query(limit=50, seed=rng.randint(0, 2**32 - 1)))
+    day = datetime.date.today() - datetime.timedelta(days=100)
+    run("filter_date", lambda: query(limit=50, date_from=day.isoformat(), date_to=(day + datetime.timedelta(days=7)).isoformat()))
+    run("get_item", lambda: history_index.get_item(rng.choice(names), db_path=db_path))
+
+    # Uploads: new content (hash, decode, store, record) and content already stored (hash + lookup only)
+    fresh = iter([_tiny_png((i % 256, i // 256 % 256, 7)) for i in range(repeat + 1)])
+    upload = lambda data, name: storage.save_upload(io.BytesIO(data), name, output_dir, db_path)
+    run("upload_fresh", lambda: upload(next(fresh), "photo.png"))
+    known = _tiny_png((1, 2, 3))
+    upload(known, "photo.png")
+    run("upload_duplicate", lambda: upload(known, "photo.png"))
+
+    # Delete: random entries (image, thumbnails, log and index row)
+    victims = rng.sample(names, min(len(names), repeat + 1))
+    iterator = iter(victims)
+    run("delete", lambda: storage.delete_entry(next(iterator), output_dir, db_path), len(victims) - 1)
+    return results
+
+def git_revision():
+    try:
+        rev = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                                    capture_output=True, text=True).stdout.strip())
+        return rev or None, dirty
+    except OSError:
+        return None, False
+
+def run_benchmarks(sizes, repeat, out_path=None, keep=False):
+    commit, dirty = git_revision()
+    report = {
+        "meta": {
+            "commit": commit, "dirty": dirty,
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "platform": platform.platform(),
+            "cpu_count": os.cpu_count(), "repeat": repeat
+        },
+        "results": {}
+    }
+    for count in sizes:
+        workdir = tempfile.mkdtemp(prefix=f"glm_bench_{count}_")
+        print(f"--> [Bench] Size {count} in {workdir}", flush=True)
+        try:
+            report["results"][str(count)] = bench_size(count, workdir, repeat)
+        finally:
+            if not keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+    report["meta"]["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    if out_path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out_path = os.path.join(RESULTS_DIR, f"{(commit or 'nocommit')[:10]}{'-dirty' if dirty else ''}.json")
+    with open(out_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"--> [Bench] Results saved: {out_path}", flush=True)
+    return report
+
+def compare(base_path, new_path, metric="p50_ms", threshold=1.25):
+    """Prints new/base ratios per size and operation. Returns the number of regressions above threshold."""
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{'size':>7}  {'operation':<24}{'base':>12}{'new':>12}{'ratio':>8}")
+    regressions = 0
+    for size, ops in new["results"].items():
+        for op, stats in ops.items():
+            old = base["results"].get(size, {}).get(op)
+            if old is None:
+                continue
+            ratio = stats[metric] / old[metric] if old[metric] else float("inf")
+            flag = ""
+            if ratio > threshold:
+                regressions += 1
+                flag = "  <-- slower"
+            print(f"{size:>7}  {op:<24}{old[metric]:>12.2f}{stats[metric]:>12.2f}{ratio:>8.2f}{flag}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="History / storage benchmarks (CPU only)")
+    parser.add_argument("--sizes", type=str, default=",".join(str(s) for s in DEFAULT_SIZES))
+    parser.add_argument("--repeat", type=int, default=20, help="Runs per operation")
+    parser.add_argument("--out", type=str, default=None, help="Result file (default benchmarks/results/<commit>.json)")
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic directories")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="Compare two result files")
+    parser.add_argument("--metric", type=str, default="p50_ms")
+    parser.add_argument("--threshold", type=float, default=1.25, help="Ratio reported as a regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.metric, args.threshold) else 0)
+    run_benchmarks([int(s) for s in args.sizes.split(",") if s], args.repeat, args.out, args.keep)
@@ -0,0 +1,454 @@
+import os
+import json
+import base64
+import sqlite3
+import logging
+import datetime
+import threading
+
+# Persistent index of the generation logs stored in OUTPUT_DIR.
+# The JSON files stay the source of truth: the index can always be rebuilt from them.
+OUTPUT_DIR = "/app/outputs"
+DB_PATH = os.environ.get("GLM_HISTORY_DB", "/app/cache/history_index.db")
+
+# Bump when the table layout or the normalization changes: the index is rebuilt from disk
+SCHEMA_VERSION = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    json_filename TEXT PRIMARY KEY,
+    mode TEXT NOT NULL,
+    prompt TEXT,
+    seed INTEGER,
+    image TEXT,
+    filename TEXT,
+    timestamp REAL NOT NULL,
+    params TEXT NOT NULL,
+    output_type TEXT,
+    files TEXT,
+    outputs TEXT NOT NULL,
+    fingerprint TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history (timestamp DESC, json_filename DESC);
+CREATE INDEX IF NOT EXISTS idx_history_mode_timestamp ON history (mode, timestamp DESC, json_filename DESC);
+CREATE INDEX IF NOT EXISTS idx_history_seed ON history (seed);
+CREATE INDEX IF NOT EXISTS idx_history_fingerprint ON history (fingerprint);
+CREATE TABLE IF NOT EXISTS history_loras (
+    json_filename TEXT NOT NULL REFERENCES history (json_filename) ON DELETE CASCADE,
+    lora TEXT NOT NULL,
+    PRIMARY KEY (lora, json_filename)
+);
+CREATE INDEX IF NOT EXISTS idx_history_loras_file ON history_loras (json_filename);
+CREATE TABLE IF NOT EXISTS uploads (
+    digest TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    format TEXT,
+    size INTEGER,
+    created REAL NOT NULL
+);
+"""
+
+# Page size bounds for query()
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+_ready = set()
+_init_lock = threading.Lock()
+
+def init(db_path=DB_PATH):
+    """
+    Creates (or rebuilds, on schema change) the tables. The server calls it once at startup,
+    before the reconciler and the request threads use the index.
+    """
+    with _init_lock:
+        if db_path in _ready:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        conn = sqlite3.connect(db_path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                conn.executescript("DROP TABLE IF EXISTS history_loras; DROP TABLE IF EXISTS history;")
+            conn.executescript(SCHEMA)
+            conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            conn.commit()
+        finally:
+            conn.close()
+        _ready.add(db_path)
+
+def connect(db_path=DB_PATH):
+    """Opens the index (initialized first in processes that did not call init(), e.g. the workers)."""
+    if db_path not in _ready:
+        init(db_path)
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+def infer_mode(json_filename):
+    # --- STRICT MODE DETECTION ---
+    lower_name = json_filename.lower()
+    if lower_name.startswith("i2t_"): return "i2t"
+    elif lower_name.startswith("t2i_"): return "t2i"
+    elif lower_name.startswith("i2i_"): return "i2i"
+    elif lower_name.startswith("sweep_"): return "sweep"
+    return "unk"
+
+def extract_lora_names(raw_inputs):
+    """LoRA file names used by a generation ([path, strength, active] lists or {'path'/'filename'} dicts)."""
+    names = []
+    for item in raw_inputs.get("loras") or []:
+        path = None
+        if isinstance(item, (list, tuple)) and item:
+            if len(item) < 3 or item[2]: path = item[0]
+        elif isinstance(item, dict):
+            path = item.get("path") or item.get("filename")
+        elif isinstance(item, str):
+            path = item
+        if path:
+            names.append(os.path.basename(str(path)))
+    return names
+
+def build_entry(json_filename, output_dir=OUTPUT_DIR):
+    """
+    Reads one V1/V2 generation log and normalizes it into a history item
+    { id, image, filename, timestamp, params, output, loras, fingerprint }. Returns None if it cannot be shown.
+    """
+    json_path = os.path.join(output_dir, json_filename)
+    base_name = os.path.splitext(json_filename)[0]
+    inferred_mode = infer_mode(json_filename)
+
+    # Load JSON
+    try:
+        with open(json_path, 'r') as f:
+            data = json.load(f)
+        timestamp = os.path.getmtime(json_path)
+    except Exception as e:
+        print(f"Error parsing {json_filename}: {e}")
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    meta = data.get("meta", {})
+    raw_params = data.get("parameters", {})
+    raw_inputs = data.get("inputs", data.get("input", {}))
+    raw_outputs = data.get("outputs", data.get("output", {}))
+
+    params = raw_params.copy()
+
+    # Mode detection
+    if "mode" in meta: params["mode"] = meta["mode"]
+    elif "mode" not in params:
+         if inferred_mode != "unk": params["mode"] = inferred_mode
+         else: params["mode"] = "unk"
+
+    # Inject Inputs
+    if "prompt" in raw_inputs: params["prompt"] = raw_inputs["prompt"]
+
+    # Handle Source Images
+    if "source_images" in raw_inputs and isinstance(raw_inputs["source_images"], list):
+        for i, img in enumerate(raw_inputs["source_images"]):
+            key = f"source_image_{i+1}"
+            # Ensure full path mapping if needed, mostly backend handling
+            full_img_path = os.path.join(output_dir, img) if not img.startswith("/") else img
+            params[key] = full_img_path
+
+    elif "source_image" in raw_inputs: # V1 Legacy
+         if "source_image_1" not in params:
+             params["source_image_1"] = raw_inputs["source_image"]
+         for k in ["source_image_1", "source_image_2", "source_image_3", "source_image_4"]:
+            if k in raw_inputs: params[k] = raw_inputs[k]
+
+    # Determine Image Filename for Display
+    image_filename = None
+    if "files" in raw_outputs and isinstance(raw_outputs["files"], list) and len(raw_outputs["files"]) > 0:
+        image_filename = os.path.basename(raw_outputs["files"][0])
+
+    if not image_filename:
+        if "filename" in meta:
+            candidate = meta["filename"]
+            if os.path.exists(os.path.join(output_dir, candidate)):
+                image_filename = candidate
+        if not image_filename:
+            for ext in ['.png', '.jpg', '.jpeg', '.webp']:
+                if os.path.exists(os.path.join(output_dir, base_name + ext)):
+                    image_filename = base_name + ext
+                    break
+
+    image_url = None
+    display_filename = None
+
+    if image_filename:
+        image_url = f"/outputs/{image_filename}"
+        display_filename = image_filename
+    else:
+        # Fallback for I2T (Source Image as Thumbnail)
+        if params.get("mode") == "i2t":
+            src = params.get("source_image_1")
+            if src:
+                if src.startswith("/app"): image_url = src.replace("/app", "")
+                elif not src.startswith("/"): image_url = f"/outputs/{src}"
+                else: image_url = src
+                display_filename = json_filename
+            else:
+                image_url = "https://placehold.co/100/000000/00FF00?text=I2T"
+                display_filename = json_filename
+        else:
+            return None
+
+    return {
+        "id": json_filename,
+        "image": image_url,
+        "filename": display_filename,
+        "timestamp": timestamp,
+        "params": params,
+        "output": raw_outputs,
+        "loras": extract_lora_names(raw_inputs) if isinstance(raw_inputs, dict) else [],
+        "fingerprint": meta.get("fingerprint") if isinstance(meta, dict) else None
+    }
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _upsert(conn, json_filename, entry):
+    params = entry["params"]
+    output = entry["output"] if isinstance(entry["output"], dict) else {}
+    files = output.get("files") if isinstance(output.get("files"), list) else []
+    conn.execute(
+        "INSERT OR REPLACE INTO history "
+        "(json_filename, mode, prompt, seed, image, filename, timestamp, params, output_type, files, outputs, fingerprint) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (json_filename, str(params.get("mode", "unk")).lower(), params.get("prompt"), _as_int(params.get("seed")),
+         entry["image"], entry["filename"], entry["timestamp"],
+         json.dumps(params, ensure_ascii=False), output.get("type"), json.dumps(files, ensure_ascii=False),
+         json.dumps(entry["output"], ensure_ascii=False), entry.get("fingerprint"))
+    )
+    conn.executemany(
+        "INSERT OR IGNORE INTO history_loras (json_filename, lora) VALUES (?, ?)",
+        [(json_filename, name) for name in entry["loras"]]
+    )
+
+def _upsert_hidden(conn, json_filename, json_path):
+    # Logs that cannot be displayed are still recorded (image = NULL) so they are not re-parsed on every reconcile
+    try:
+        mtime = os.path.getmtime(json_path)
+    except OSError:
+        return
+    conn.execute(
+        "INSERT OR REPLACE INTO history (json_filename, mode, timestamp, params, outputs) "
+        "VALUES (?, 'unk', ?, '{}', '{}')",
+        (json_filename, mtime)
+    )
+
+def _index(conn, json_filename, output_dir):
+    entry = build_entry(json_filename, output_dir)
+    if entry is None:
+        _upsert_hidden(conn, json_filename, os.path.join(output_dir, json_filename))
+    else:
+        _upsert(conn, json_filename, entry)
+
+def index_file(json_path, db_path=DB_PATH):
+    """Adds or refreshes one generation log in the index (called right after it is written)."""
+    output_dir, json_filename = os.path.split(json_path)
+    conn = connect(db_path)
+    try:
+        with conn:
+            _index(conn, json_filename, output_dir)
+    finally:
+        conn.close()
+
+def remove_file(json_filename, db_path=DB_PATH):
+    conn = connect(db_path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM history WHERE json_filename = ?", (os.path.basename(json_filename),))
+    finally:
+        conn.close()
+
+def reconcile(output_dir=OUTPUT_DIR, db_path=DB_PATH):
+    """
+    Brings the index in sync with the files on disk: logs added, changed or
+    removed outside the app are picked up. Only new/modified files are parsed.
+    Returns (added_or_updated, removed).
+    """
+    if not os.path.isdir(output_dir):
+        return 0, 0
+
+    on_disk = {}
+    with os.scandir(output_dir) as it:
+        for entry in it:
+            if entry.name.lower().endswith(".json") and entry.is_file():
+                on_disk[entry.name] = entry.stat().st_mtime
+
+    conn = connect(db_path)
+    try:
+        indexed = dict(conn.execute("SELECT json_filename, timestamp FROM history").fetchall())
+        removed = [name for name in indexed if name not in on_disk]
+        changed = [name for name, mtime in on_disk.items() if indexed.get(name) != mtime]
+
+        with conn:
+            conn.executemany("DELETE FROM history WHERE json_filename = ?", [(n,) for n in removed])
+            for name in changed:
+                _index(conn, name, output_dir)
+    finally:
+        conn.close()
+
+    if changed or removed:
+        logging.info(f"--> [History] Index reconciled: {len(changed)} added/updated, {len(removed)} removed")
+    return len(changed), len(removed)
+
+def _row_to_item(row, summary=False, loras=None):
+    item = {
+        "id": row["json_filename"],
+        "image": row["image"],
+        "filename": row["filename"],
+        "timestamp": row["timestamp"],
+        "params": json.loads(row["params"]),
+        "loras": loras or []
+    }
+    if summary:
+        # Lightweight: no I2T text, fetch the full item with get_item() when needed
+        item["output"] = {"type": row["output_type"], "files": json.loads(row["files"] or "[]")}
+        item["summary"] = True
+    else:
+        item["output"] = json.loads(row["outputs"])
+    return item
+
+def encode_cursor(timestamp, json_filename):
+    raw = json.dumps([timestamp, json_filename]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def decode_cursor(cursor):
+    """(timestamp, json_filename) of the last item of the previous page. Raises ValueError if malformed."""
+    try:
+        timestamp, json_filename = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return float(timestamp), str(json_filename)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def parse_date(value, end_of_day=False):
+    """Accepts a unix timestamp or an ISO date/datetime ('2024-06-15', '2024-06-15T10:00')."""
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        dt = datetime.datetime.fromisoformat(str(value))
+    except ValueError:
+        raise ValueError(f"Invalid date: {value}")
+    if end_of_day and len(str(value)) <= 10:
+        dt += datetime.timedelta(days=1)
+    return dt.timestamp()
+
+def query(limit=DEFAULT_LIMIT, cursor=None, mode=None, date_from=None, date_to=None,
+          lora=None, seed=None, summary=False, db_path=DB_PATH):
+    """
+    One page of history, newest first, using keyset pagination on (timestamp, json_filename).
+    Returns (items, next_cursor); next_cursor is None on the last page.
+    date_from is inclusive, date_to exclusive (a bare date covers the whole day).
+    """
+    limit = max(1, min(int(limit or DEFAULT_LIMIT), MAX_LIMIT))
+    where, args = ["image IS NOT NULL"], []
+
+    if mode and mode != "all":
+        where.append("mode = ?")
+        args.append(mode.lower())
+    if seed is not None:
+        where.append("seed = ?")
+        args.append(int(seed))
+    start = parse_date(date_from)
+    if start is not None:
+        where.append("timestamp >= ?")
+        args.append(start)
+    end = parse_date(date_to, end_of_day=True)
+    if end is not None:
+        where.append("timestamp < ?")
+        args.append(end)
+    if lora:
+        where.append("json_filename IN (SELECT json_filename FROM history_loras WHERE lora = ?)")
+        args.append(os.path.basename(lora))
+    if cursor:
+        ts, name = decode_cursor(cursor)
+        where.append("(timestamp < ? OR (timestamp = ? AND json_filename < ?))")
+        args.extend([ts, ts, name])
+
+    columns = "json_filename, image, filename, timestamp, params, output_type, files"
+    if not summary:
+        columns += ", outputs"
+
+    conn = connect(db_path)
+    try:
+        rows = conn.execute(
+            f"SELECT {columns} FROM history WHERE {' AND '.join(where)} "
+            "ORDER BY timestamp DESC, json_filename DESC LIMIT ?",
+            args + [limit + 1]
+        ).fetchall()
+        page = rows[:limit]
+        loras = {}
+        if page:
+            marks = ",".join("?" * len(page))
+            for name, lora_name in conn.execute(
+                f"SELECT json_filename, lora FROM history_loras WHERE json_filename IN ({marks})",
+                [row["json_filename"] for row in page]
+            ):
+                loras.setdefault(name, []).append(lora_name)
+    finally:
+        conn.close()
+
+    items = [_row_to_item(row, summary, loras.get(row["json_filename"])) for row in page]
+    next_cursor = None
+    if len(rows) > limit:
+        last = page[-1]
+        next_cursor = encode_cursor(last["timestamp"], last["json_filename"])
+    return items, next_cursor
+
+def get_item(json_filename, db_path=DB_PATH):
+    """Full history item (including I2T text) by its id, or None."""
+    name = os.path.basename(json_filename)
+    conn = connect(db_path)
+    try:
+        row = conn.execute("SELECT * FROM history WHERE json_filename = ? AND image IS NOT NULL", (name,)).fetchone()
+        loras = [r[0] for r in conn.execute("SELECT lora FROM history_loras WHERE json_filename = ?", (name,))]
+    finally:
+        conn.close()
+    return _row_to_item(row, loras=loras) if row else None
+
+def find_by_fingerprint(fingerprint, db_path=DB_PATH):
+    """[(json_filename, image file name)] of the logs written for a request fingerprint, oldest first."""
+    conn = connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT json_filename, filename FROM history WHERE fingerprint = ? AND image IS NOT NULL "
+            "ORDER BY timestamp, json_filename", (fingerprint,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [(row["json_filename"], row["filename"]) for row in rows]
+
+# --- Uploads (content-addressed, see storage.save_upload) ---
+def find_upload(digest, db_path=DB_PATH):
+    """{filename, width, height, format, size} of the upload with this SHA-256, or None."""
+    conn = connect(db_path)
+    try:
+        row = conn.execute("SELECT filename, width, height, format, size FROM uploads WHERE digest = ?", (digest,)).fetchone()
+    finally:
+        conn.close()
+    return dict(row) if row else None
+
+def record_upload(digest, filename, width, height, fmt, size, db_path=DB_PATH):
+    conn = connect(db_path)
+    try:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO uploads (digest, filename, width, height, format, size, created) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (digest, filename, width, height, fmt, size, datetime.datetime.now().timestamp()))
+    finally:
+        conn.close()
@@ -0,0 +1,164 @@
+import os
+import re
+import gzip
+import hashlib
+import mimetypes
+import stat
+import threading
+import anyio
+from starlette.staticfiles import StaticFiles
+from starlette.responses import FileResponse, Response
+from starlette.datastructures import Headers, QueryParams
+import storage
+
+try:
+    import brotli  # optional: gzip only without it
+except ImportError:
+    brotli = None
+
+# HTTP caching for the /outputs and /static mounts.
+# Generated images and uploads never change once written: they are served with a
+# strong ETag (their SHA-256) and an immutable Cache-Control, so the browser does
+# not revalidate them at all. Static assets are compressed once per version
+# (brotli when installed, else gzip) and kept in memory; index.html references
+# them as name?v=<content hash>, and those versioned URLs are immutable too.
+# Everything else is revalidated with If-None-Match (304 without a body).
+# FileResponse handles Range / If-Range requests on the uncompressed files.
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"  # may be stored, but checked with the server on every use
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp")
+COMPRESSIBLE_EXTS = (".html", ".js", ".css", ".svg", ".json", ".txt")
+MIN_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 9    # paid once per asset version
+BROTLI_QUALITY = 11
+
+# src="script.js" / href="style.css?v=12" in index.html (relative URLs only)
+ASSET_REF = re.compile(r'(src|href)="([\w./-]+\.(?:js|css))(?:\?v=[^"]*)?"')
+
+def etag_matches(request_headers, etag):
+    if_none_match = request_headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+def not_modified(headers):
+    return Response(status_code=304, headers=headers)
+
+def preferred_encoding(request_headers):
+    accepted = [part.split(";")[0].strip().lower() for part in request_headers.get("accept-encoding", "").split(",")]
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return "identity"
+
+class OutputFiles(StaticFiles):
+    """/outputs: images are content-addressed (strong SHA-256 ETag) and immutable; other files revalidate."""
+
+    async def get_response(self, path, scope):
+        if scope["method"] in ("GET", "HEAD") and path.lower().endswith(IMAGE_EXTS):
+            full_path, stat_result = await anyio.to_thread.run_sync(self.lookup_path, path)
+            if stat_result and stat.S_ISREG(stat_result.st_mode):
+                # Hashed once per file (memoized by size + mtime in storage)
+                digest = await anyio.to_thread.run_sync(storage.file_digest, full_path)
+                headers = {"etag": f'"{digest}"', "cache-control": IMMUTABLE}
+                if etag_matches(Headers(scope=scope), headers["etag"]):
+                    return not_modified(headers)
+                return FileResponse(full_path, stat_result=stat_result, headers=headers)
+        response = await super().get_response(path, scope)
+        response.headers.setdefault("cache-control", REVALIDATE)
+        return response
+
+class StaticAssets(StaticFiles):
+    """
+    /static: text assets precompressed once per content version and kept in memory,
+    index.html rewritten to versioned asset URLs (name?v=<hash>, immutable).
+    Text assets are always sent whole (200, "Accept-Ranges: none"): a Range would have to refer
+    to the encoded body, and these files are small. Other files get Range support from StaticFiles.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._variants = {}  # full path -> ((size, mtime), version, {encoding: body})
+        self._lock = threading.Lock()
+
+    def version(self, name):
+        """Short content hash of a static file, None if it does not exist."""
+        full_path, stat_result = self.lookup_path(name)
+        if stat_result is None:
+            return None
+        return storage.file_digest(full_path)[:12]
+
+    def render_index(self, html):
+        def versioned(match):
+            attr, name = match.group(1), match.group(2)
+            version = self.version(os.path.normpath(name))
+            return f'{attr}="{name}?v={version}"' if version else match.group(0)
+        return ASSET_REF.sub(versioned, html)
+
+    def variants(self, full_path, stat_result):
+        """(version, {encoding: body}) of a text asset, compressed once per version."""
+        key = (stat_result.st_size, stat_result.st_mtime)
+        is_index = os.path.basename(full_path) == "index.html"
+        with self._lock:
+            cached = self._variants.get(full_path)
+        if cached and not is_index and cached[0] == key:
+            return cached[1], cached[2]
+
+        with open(full_path, "rb") as f:
+            body = f.read()
+        if is_index:
+            # Rendered on every request: it changes when any referenced asset does
+            body = self.render_index(body.decode("utf-8")).encode("utf-8")
+            version = hashlib.sha256(body).hexdigest()[:12]
+            if cached and cached[1] == version:
+                return cached[1], cached[2]
+        else:
+            version = storage.file_digest(full_path)[:12]
+
+        bodies = {"identity": body}
+        if len(body) >= MIN_COMPRESS_SIZE:
+            bodies["gzip"] = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+            if brotli is not None:
+                bodies["br"] = brotli.compress(body, quality=BROTLI_QUALITY)
+        with self._lock:
+            self._variants[full_path] = (key, version, bodies)
+        return version, bodies
+
+    async def get_response(self, path, scope):
+        if scope["method"] not in ("GET", "HEAD"):
+            return await super().get_response(path, scope)
+        full_path, stat_result = await anyio.to_thread.run_sync(self.lookup_path, path)
+        if not stat_result or not stat.S_ISREG(stat_result.st_mode):
+            return await super().get_response(path, scope)
+
+        request_headers = Headers(scope=scope)
+        requested = QueryParams(scope.get("query_string", b"")).get("v")
+
+        if not full_path.endswith(COMPRESSIBLE_EXTS):
+            version = await anyio.to_thread.run_sync(self.version, path)
+            response = await super().get_response(path, scope)
+            response.headers["cache-control"] = IMMUTABLE if requested and requested == version else REVALIDATE
+            return response
+
+        version, bodies = await anyio.to_thread.run_sync(self.variants, full_path, stat_result)
+        encoding = preferred_encoding(request_headers)
+        if encoding not in bodies:
+            encoding = "identity"
+        headers = {
+            "etag": f'"{version}"' if encoding == "identity" else f'"{version}-{encoding}"',
+            # A ?v= that is not the current version was cached from an older page: revalidate it
+            "cache-control": IMMUTABLE if requested and requested == version else REVALIDATE,
+            "vary": "Accept-Encoding",
+            "accept-ranges": "none"  # Range headers are ignored here, see the class docstring
+        }
+        if encoding != "identity":
+            headers["content-encoding"] = encoding
+        if etag_matches(request_headers, headers["etag"]):
+            return not_modified(headers)
+        media_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+        return Response(bodies[encoding], media_type=media_type, headers=headers)
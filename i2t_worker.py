@@ -0,0 +1,74 @@
+import sys
+import os
+import json
+import gc
+import time
+import traceback
+import torch
+import shared_utils
+import ipc
+import process_i2t
+from prefix_cache import PrefixCache
+from transformers import AutoProcessor
+
+# Resident GLM-4.1V worker.
+# Loads the model ONCE, then serves I2T questions received as JSON lines on stdin:
+#   {"job_id": "...", "mode": "i2t" | "chat", "args": {...}}
+# chat args also carry the earlier turns ("history") and the session id.
+# A prefix KV cache keyed by image content lets follow-up questions on the same
+# image skip the image decode and vision tower and prefill only the new tokens.
+
+def serve():
+    print(f"--> [I2T Worker] Starting resident worker PID: {os.getpid()}", flush=True)
+
+    # The load time is reported with the first job served by this process
+    timer = shared_utils.stage_timer
+    with timer.stage("load"):
+        processor = AutoProcessor.from_pretrained(process_i2t.MODEL_ID, trust_remote_code=True)
+        model = shared_utils.load_i2t_model(process_i2t.MODEL_ID)
+    prefix_cache = PrefixCache()
+
+    ipc.emit("ready", pid=os.getpid())
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+
+        ok = False
+        result = {}
+        start = time.time()
+        try:
+            job = json.loads(line)
+            ipc.set_job(job.get("job_id"))
+            args = dict(job.get("args", {}))
+
+            print(f"--> [I2T Worker] Job {job.get('job_id')} ({job.get('mode', 'i2t').upper()})", flush=True)
+            result = process_i2t.analyze_i2t(model, processor, prefix_cache=prefix_cache, start=start, **args)
+            ok = True
+
+        except Exception as e:
+            print(f"CRITICAL ERROR IN I2T WORKER:", flush=True)
+            traceback.print_exc()
+            sys.stdout.flush()
+            ipc.emit("error", message=f"{type(e).__name__}: {e}")
+            if shared_utils.is_oom_error(e):
+                prefix_cache.clear()
+
+        finally:
+            gc.collect()
+            metrics = {"elapsed": round(time.time() - start, 2), "tokens": result.get("tokens"),
+                       "ttft": result.get("ttft"), "prefix_cache_tokens": prefix_cache.total_tokens(),
+                       "timings": timer.snapshot()}
+            if torch.cuda.is_available():
+                metrics["max_vram_mb"] = round(torch.cuda.max_memory_allocated() / 2**20)
+                torch.cuda.reset_peak_memory_stats()
+            ipc.emit("metrics", **metrics)
+            ipc.emit("done", ok=ok)
+            ipc.set_job(None)
+            timer.reset()
+
+    print("--> [I2T Worker] stdin closed, exiting.", flush=True)
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,128 @@
+import os
+import json
+import asyncio
+import threading
+
+# Structured JSON-lines channel between the server and its workers.
+# The server opens a pipe and passes its write end to the worker (fd number in
+# GLM_IPC_FD). Workers send one JSON object per line on it:
+#   {"type": "ready" | "progress" | "log" | "token" | "result" | "error" | "metrics" | "done", "job_id": ..., ...}
+# stdout/stderr stay free for library output and are only shown as log lines.
+# The two pipes are read independently, so before "done" the worker prints an
+# end mark with the job id on stdout: the server keeps reading stdout until it,
+# and the job's last log lines never spill into the next job.
+# Results carry file paths (never image data) or the final I2T text; I2T text is
+# also streamed while it is generated as "token" messages (section think|answer).
+
+IPC_FD_ENV = "GLM_IPC_FD"
+LINE_LIMIT = 16 * 1024 * 1024
+MESSAGE_TYPES = ("ready", "progress", "log", "token", "result", "error", "metrics", "done")
+END_MARK = "::glm-ipc-end::"  # + job id, last stdout line of a job
+
+# --- Worker side ---
+_out = None
+_job_id = None
+_lock = threading.Lock()
+
+def _channel():
+    global _out
+    if _out is None and os.environ.get(IPC_FD_ENV):
+        _out = os.fdopen(int(os.environ[IPC_FD_ENV]), "w", buffering=1)
+    return _out
+
+def set_job(job_id):
+    """Tags every following message with job_id (None when idle)."""
+    global _job_id
+    _job_id = job_id
+
+def emit(msg_type, **fields):
+    """Sends one message. Without a server channel (CLI use) it is printed to stdout instead."""
+    message = {"type": msg_type, "job_id": _job_id}
+    message.update(fields)
+    line = json.dumps(message, ensure_ascii=False)
+    with _lock:
+        out = _channel()
+        if out is None:
+            print(f"[{msg_type}] {line}", flush=True)
+        else:
+            if msg_type == "done":
+                print(f"{END_MARK}{_job_id}", flush=True)  # after everything the job printed
+            out.write(line + "\n")
+            out.flush()
+
+# --- Server side ---
+class WorkerChannel:
+    """
+    A worker subprocess whose stdout (plain log lines) and IPC pipe (messages)
+    are merged into one asyncio queue of ("log", text) / ("msg", dict) / ("end_mark", job_id)
+    items, followed by a single ("eof", None) once the process has closed both.
+    """
+
+    def __init__(self, process, queue):
+        self.process = process
+        self.queue = queue
+        self.tasks = []
+        self.current_job = None  # job id the stream errors are reported for (see ResidentWorker.run_job)
+
+    @classmethod
+    async def spawn(cls, *cmd, stdin=False, env=None):
+        """env: variables set for the child on top of the server's environment."""
+        read_fd, write_fd = os.pipe()
+        env = dict(os.environ, **(env or {}))
+        env[IPC_FD_ENV] = str(write_fd)
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.PIPE if stdin else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                env=env, pass_fds=(write_fd,), limit=LINE_LIMIT
+            )
+        finally:
+            os.close(write_fd)  # only the child keeps the write end: EOF when it exits
+
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=LINE_LIMIT)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(read_fd, "rb", 0))
+
+        channel = cls(process, asyncio.Queue())
+        pending = [2]
+
+        async def pump(stream, kind):
+            try:
+                async for raw in stream:
+                    text = raw.decode(errors="replace").strip()
+                    if not text:
+                        continue
+                    if kind == "msg":
+                        try:
+                            message = json.loads(text)
+                        except ValueError:
+                            channel.queue.put_nowait(("log", text))
+                            continue
+                        channel.queue.put_nowait(("msg", message))
+                    elif text.startswith(END_MARK):
+                        channel.queue.put_nowait(("end_mark", text[len(END_MARK):]))
+                    else:
+                        channel.queue.put_nowait(("log", text))
+            except Exception as e:
+                # e.g. a line over LINE_LIMIT: the stream cannot be read any further. Reported as an
+                # error of the current job; the worker is killed so the job ends instead of hanging
+                channel.queue.put_nowait(("msg", {"type": "error", "job_id": channel.current_job,
+                                                  "message": f"Worker {kind} stream failed: {type(e).__name__}: {e}"}))
+                if process.returncode is None:
+                    process.kill()
+            finally:
+                pending[0] -= 1
+                if not pending[0]:
+                    channel.queue.put_nowait(("eof", None))
+
+        # Keep references: the event loop only holds tasks weakly
+        channel.tasks = [loop.create_task(pump(process.stdout, "log")), loop.create_task(pump(reader, "msg"))]
+        return channel
+
+    async def send(self, data):
+        self.process.stdin.write((json.dumps(data) + "\n").encode())
+        await self.process.stdin.drain()
+
+    async def next(self):
+        return await self.queue.get()
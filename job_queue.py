@@ -0,0 +1,250 @@
+import time
+import uuid
+import asyncio
+import itertools
+import logging
+from collections import OrderedDict
+
+# Job lifecycle
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINAL_STATES = (DONE, FAILED, CANCELLED)
+
+# How many finished jobs are kept for /api/jobs
+MAX_FINISHED_JOBS = 200
+
+class Job:
+    """
+    A single unit of GPU work (t2i, i2i, sweep or i2t).
+    Events are stored as SSE payloads ("LOG|...", "IMG|...") so any number of
+    clients can (re)attach to the stream at any time.
+    All methods run on the server event loop.
+    """
+
+    def __init__(self, mode, args, priority=0):
+        self.id = uuid.uuid4().hex
+        self.mode = mode
+        self.args = args
+        self.priority = priority
+        self.state = QUEUED
+        self.error = None
+        self.outputs = []
+        self.progress = None
+        self.metrics = None  # last "metrics" IPC message of the worker
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_requested = False
+        self.cancel_hook = None  # set by the runner while the job is on the GPU
+        self.device = None       # device slot the job ran on (worker pool)
+        self.events = []
+        self._changed = asyncio.Event()
+
+    def set_cancel_hook(self, hook):
+        """Registers how to abort the running job; fires at once if a cancel arrived while it was starting."""
+        self.cancel_hook = hook
+        if self.cancel_requested and hook is not None:
+            hook()
+
+    def _notify(self):
+        # Wake every waiting client, then arm a fresh event for the next change
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def emit(self, event):
+        self.events.append(event)
+        self._notify()
+
+    def log(self, text):
+        self.emit(f"LOG|{text}")
+
+    def set_state(self, state, error=None):
+        self.state = state
+        if error:
+            self.error = error
+        if state == RUNNING:
+            self.started_at = time.time()
+        elif state in FINAL_STATES:
+            self.finished_at = time.time()
+        self._notify()
+
+    def finish(self, state, event, error=None):
+        """Moves to a final state and publishes the closing SSE event."""
+        self.set_state(state, error)
+        self.emit(event)
+
+    def is_finished(self):
+        return self.state in FINAL_STATES
+
+    async def iter_events(self, heartbeat=15.0):
+        """Yields every event from the start of the job until it reaches a final state (None = heartbeat)."""
+        index = 0
+        while True:
+            if index >= len(self.events) and not self.is_finished():
+                changed = self._changed
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+            pending = self.events[index:]
+            index += len(pending)
+            for event in pending:
+                yield event
+            if self.is_finished() and index >= len(self.events):
+                return
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "mode": self.mode,
+            "state": self.state,
+            "priority": self.priority,
+            "prompt": self.args.get("prompt"),
+            "error": self.error,
+            "outputs": self.outputs,
+            "progress": self.progress,
+            "metrics": self.metrics,
+            "device": self.device,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+class JobScheduler:
+    """
+    FIFO/priority queue drained by a single asyncio task, which keeps up to
+    `concurrency` jobs running (one per GPU of the worker pool; 1 serializes every
+    job onto the GPU back to back). Lower priority value runs first;
+    equal priorities keep submission order.
+    runners: { mode: async fn(job) -> bool } run the job and return success.
+    on_finish: optional fn(job) called once per job when it reaches a final state.
+    """
+
+    def __init__(self, runners, on_finish=None, concurrency=1):
+        self.runners = runners
+        self.on_finish = on_finish
+        self.concurrency = max(1, concurrency)
+        self.queue = asyncio.PriorityQueue()
+        self.counter = itertools.count()
+        self.jobs = OrderedDict()
+        self.running = OrderedDict()  # job id -> Job
+        self.task = None
+        self._tasks = set()
+        self._free = None  # asyncio.Semaphore(concurrency), created on the running loop
+
+    def start(self):
+        """Starts the dispatcher on the running event loop (idempotent)."""
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._loop())
+
+    def submit(self, mode, args, priority=0):
+        if mode not in self.runners:
+            raise ValueError(f"Unknown job mode: {mode}")
+        self.start()
+        job = Job(mode, args, priority)
+        # Jobs that must start (or finish) before this one can
+        ahead = self.queue_depth() + (len(self.running) if len(self.running) >= self.concurrency else 0)
+        self.jobs[job.id] = job
+        self._trim()
+        job.emit(f"JOB|{job.id}")
+        if ahead:
+            job.log(f"--> [Queue] Job queued ({ahead} ahead)")
+        self.queue.put_nowait((priority, next(self.counter), job))
+        return job
+
+    def complete(self, mode, args, outputs, note):
+        """Registers a job that needed no GPU work (e.g. served from the result cache) as already done."""
+        job = Job(mode, args)
+        self.jobs[job.id] = job
+        self._trim()
+        job.emit(f"JOB|{job.id}")
+        job.log(note)
+        job.set_state(RUNNING)
+        for url in outputs:
+            job.outputs.append(url)
+            job.emit(f"IMG|{url}")
+        job.finish(DONE, "DONE|Finished in 0.0s (cached)")
+        self._finished(job)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def list(self):
+        return [job.to_dict() for job in reversed(self.jobs.values())]
+
+    def queue_depth(self):
+        return sum(1 for job in self.jobs.values() if job.state == QUEUED)
+
+    def cancel(self, job_id):
+        """Cancels a queued job, or aborts it if it is running. Returns False if unknown / already finished."""
+        job = self.get(job_id)
+        if job is None or job.is_finished():
+            return False
+        job.cancel_requested = True
+        if job.state == QUEUED:
+            job.finish(CANCELLED, "ERR|Job cancelled")
+            self._finished(job)
+        elif job.cancel_hook:
+            job.cancel_hook()
+        return True
+
+    def cancel_current(self):
+        """Cancels every running job."""
+        return any([self.cancel(job_id) for job_id in list(self.running)])
+
+    def cancel_all(self):
+        for job_id in [job.id for job in self.jobs.values() if not job.is_finished()]:
+            self.cancel(job_id)
+
+    def _finished(self, job):
+        if self.on_finish:
+            try:
+                self.on_finish(job)
+            except Exception:
+                logging.exception("on_finish hook error")
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.is_finished()]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    async def _loop(self):
+        if self._free is None:
+            self._free = asyncio.Semaphore(self.concurrency)
+        while True:
+            await self._free.acquire()
+            _, _, job = await self.queue.get()
+            if job.state != QUEUED:
+                self._free.release()
+                continue  # cancelled while waiting
+
+            self.running[job.id] = job
+            job.set_state(RUNNING)
+            # The event loop keeps only weak references to tasks
+            task = asyncio.get_running_loop().create_task(self._run(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job):
+        try:
+            ok = await self.runners[job.mode](job)
+            if job.cancel_requested:
+                job.finish(CANCELLED, "ERR|Job cancelled")
+            elif ok:
+                job.finish(DONE, f"DONE|Finished in {time.time() - job.started_at:.1f}s")
+            else:
+                error = job.error or "Worker job failed"
+                job.finish(FAILED, f"ERR|{error}", error=error)
+        except Exception as e:
+            logging.exception("Job runner error")
+            job.finish(FAILED, f"ERR|Server Error: {e}", error=f"Server Error: {e}")
+        finally:
+            job.cancel_hook = None
+            self.running.pop(job.id, None)
+            self._free.release()
+            self._finished(job)
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import uuid
+import torch
+import ipc
+import shared_utils
+import output_writer
+from result_cache import model_revision
+from PIL import Image
+
+# Live previews of the denoising loop.
+# Every N steps callback_on_step_end projects the current latents to RGB with a
+# linear map (latent channels + bias -> RGB) instead of running the VAE: one
+# small matmul on the GPU, a copy of a latent-sized image and a small JPEG.
+# The map is fitted once per model revision by least squares, from the final
+# latents and the decoded image of the first generation, and stored in
+# /app/cache/latent_rgb.json; until then no previews are sent.
+# Preview time is charged to the "preview" stage and a preview is skipped
+# whenever it would exceed GLM_PREVIEW_BUDGET of the denoising time so far.
+
+CACHE_PATH = os.environ.get("GLM_LATENT_RGB_CACHE", "/app/cache/latent_rgb.json")
+DEFAULT_EVERY = int(os.environ.get("GLM_PREVIEW_EVERY", "5"))    # steps between previews, 0 disables them
+BUDGET = float(os.environ.get("GLM_PREVIEW_BUDGET", "0.03"))     # max preview time / denoise time
+MAX_SIDE = 256
+QUALITY = 70
+
+_projection = {}   # model id -> {"revision", "channels", "weights": (C + 1, 3) tensor}
+_final_latents = None  # first latents of the last step, for calibrate()
+
+def _load(model_id):
+    entry = _projection.get(model_id)
+    if entry is not None:
+        return entry
+    try:
+        with open(CACHE_PATH, "r") as f:
+            cached = json.load(f).get(model_id)
+    except (OSError, ValueError):
+        cached = None
+    if cached and cached.get("revision") == model_revision(model_id):
+        entry = {"revision": cached["revision"], "channels": cached["channels"],
+                 "weights": torch.tensor(cached["weights"], dtype=torch.float32)}
+        _projection[model_id] = entry
+    return entry
+
+def _save(model_id, entry):
+    try:
+        with open(CACHE_PATH, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache[model_id] = {"revision": entry["revision"], "channels": entry["channels"],
+                       "weights": entry["weights"].tolist()}
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        with open(CACHE_PATH, "w") as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print(f"--> [Preview] Warning: could not cache the latent projection: {e}", flush=True)
+
+def fit_projection(latents, image):
+    """Least-squares (C + 1, 3) map from one latent (C, h, w) to the RGB of its decoded image, downscaled to h x w."""
+    channels, height, width = latents.shape
+    target = image.convert("RGB").resize((width, height), Image.BOX)
+    y = torch.frombuffer(bytearray(target.tobytes()), dtype=torch.uint8).float().view(-1, 3) / 255.0
+    x = latents.float().reshape(channels, -1).T.cpu()
+    x = torch.cat([x, torch.ones(x.shape[0], 1)], dim=1)
+    return torch.linalg.lstsq(x, y).solution
+
+def calibrate(model_id, image):
+    """Fits the projection of model_id from the last step's latents and their decoded image, if not known yet."""
+    global _final_latents
+    latents, _final_latents = _final_latents, None
+    if latents is None or _load(model_id) is not None:
+        return
+    entry = {"revision": model_revision(model_id), "channels": latents.shape[0],
+             "weights": fit_projection(latents, image)}
+    _projection[model_id] = entry
+    _save(model_id, entry)
+    print(f"--> [Preview] Latent preview projection fitted ({latents.shape[0]} channels)", flush=True)
+
+def render(latents, weights):
+    """RGB PIL image of one latent (C, h, w), scaled to at most MAX_SIDE."""
+    weights = weights.to(latents.device)
+    rgb = torch.einsum("chw,cr->hwr", latents.float(), weights[:-1]) + weights[-1]
+    rgb = (rgb.clamp(0, 1) * 255).to(torch.uint8).cpu().numpy()
+    image = Image.fromarray(rgb)
+    scale = MAX_SIDE / max(image.size)
+    return image.resize((round(image.width * scale), round(image.height * scale)), Image.BILINEAR)
+
+def make_callback(model_id, total_steps, every=None, progress=None):
+    """
+    callback_on_step_end: runs progress (e.g. shared_utils.make_progress_callback) after each step,
+    then every `every` steps writes a preview of the first image and emits it as a "latent" result.
+    """
+    every = DEFAULT_EVERY if every is None else int(every)
+    entry = _load(model_id)
+    state = {"last": None, "denoise": 0.0, "preview": 0.0, "sent": 0, "skipped": 0}
+    token = uuid.uuid4().hex[:12]
+    if entry is not None and every > 0:
+        os.makedirs(output_writer.PREVIEW_DIR, exist_ok=True)
+        output_writer.prune_previews()
+
+    def callback(pipe, step_index, timestep, callback_kwargs):
+        global _final_latents
+        if progress is not None:
+            callback_kwargs = progress(pipe, step_index, timestep, callback_kwargs)
+        now = time.perf_counter()
+        step = step_index + 1
+        total = shared_utils.denoising_steps(pipe, total_steps)  # img2img: about steps * strength
+        if state["last"] is not None and step > 1:
+            state["denoise"] += now - state["last"]
+        state["last"] = now
+
+        latents = callback_kwargs.get("latents")
+        if latents is None or latents.ndim != 4:
+            return callback_kwargs  # packed or missing latents: no preview for this pipeline
+        if step == total and entry is None:
+            _final_latents = latents[0].detach().clone()
+        if entry is None or every <= 0 or step % every or step == total or latents.shape[1] != entry["channels"]:
+            return callback_kwargs
+        if state["preview"] > BUDGET * state["denoise"]:
+            state["skipped"] += 1
+            return callback_kwargs
+
+        with shared_utils.stage_timer.stage("preview"):
+            start = time.perf_counter()
+            image = render(latents[0], entry["weights"])
+            path = os.path.join(output_writer.PREVIEW_DIR, f"latent_{token}_{step}.jpg")
+            image.save(path, "JPEG", quality=QUALITY)
+            ipc.emit("result", kind="latent", path=path, step=step, total=total)
+            spent = time.perf_counter() - start
+        state["preview"] += spent
+        state["sent"] += 1
+        # The time spent here is not denoising: start the next step's measure after it
+        state["last"] = time.perf_counter()
+        return callback_kwargs
+
+    callback.stats = state
+    return callback
+
+def report(callback, label):
+    """Logs how many previews were sent and their share of the denoising time."""
+    state = getattr(callback, "stats", None)
+    if not state or not (state["sent"] or state["skipped"]):
+        return
+    share = 100 * state["preview"] / state["denoise"] if state["denoise"] else 0.0
+    print(f"--> [{label}] Previews: {state['sent']} sent, {state['skipped']} skipped, "
+          f"{state['preview']:.2f}s ({share:.1f}% of denoising)", flush=True)
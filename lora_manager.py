@@ -1,6 +1,20 @@
 import os
 import glob
 import json
+import re
+import struct
+import threading
+from collections import Counter
+
+# Persistent LoRA metadata catalog, keyed by path and invalidated by size + mtime
+CATALOG_PATH = os.environ.get("GLM_LORA_CATALOG", "/app/cache/lora_catalog.json")
+CATALOG_VERSION = 1
+# Refuse absurd header lengths (corrupt / non-safetensors files)
+MAX_HEADER_BYTES = 100 * 1024 * 1024
+LORA_DOWN_MARKERS = (".lora_A.", ".lora_down.", ".lora.down.")
+
+_catalog = None
+_catalog_lock = threading.Lock()
 
 def list_lora_files(folder_path):
     """Returns a list of .safetensors filenames."""
@@ -27,3 +41,126 @@ def create_config_json(lora_data, save_path="/app/lora_run_config.json"):
     with open(save_path, "w") as f:
         json.dump(worker_format, f)
     return save_path
+
+def read_safetensors_header(path):
+    """Parses only the JSON header of a .safetensors file (the tensors are never read)."""
+    with open(path, "rb") as f:
+        raw = f.read(8)
+        if len(raw) != 8:
+            raise ValueError("File too short")
+        (length,) = struct.unpack("<Q", raw)
+        if length > MAX_HEADER_BYTES:
+            raise ValueError(f"Header too large ({length} bytes)")
+        return json.loads(f.read(length))
+
+def _module_type(module):
+    # "transformer.blocks.0.attn.to_q" -> "to_q", kohya "lora_unet_..._attentions_0_proj_in" -> "proj_in"
+    if "." in module:
+        return module.split(".")[-1]
+    return re.sub(r"^.*_\d+_", "", module)
+
+def _trigger_words(metadata, limit=8):
+    for key in ("modelspec.trigger_phrase", "ss_trigger_words", "trigger_words"):
+        if metadata.get(key):
+            return [w.strip() for w in str(metadata[key]).split(",") if w.strip()][:limit]
+    # Kohya trainers: most frequent dataset tags
+    try:
+        freq = Counter()
+        for tags in json.loads(metadata.get("ss_tag_frequency", "{}")).values():
+            freq.update(tags)
+        return [tag for tag, _ in freq.most_common(limit)]
+    except Exception:
+        return []
+
+def describe_lora(path):
+    """Summary of a LoRA file: rank, alpha, target modules, trigger words, dtypes."""
+    header = read_safetensors_header(path)
+    metadata = header.pop("__metadata__", None) or {}
+    ranks, targets, dtypes = Counter(), set(), set()
+    for name, info in header.items():
+        dtypes.add(info.get("dtype"))
+        for marker in LORA_DOWN_MARKERS:
+            if marker in name:
+                module = name.split(marker)[0]
+                targets.add(_module_type(module))
+                shape = info.get("shape") or []
+                if shape:
+                    ranks[shape[0]] += 1
+                break
+
+    rank = ranks.most_common(1)[0][0] if ranks else metadata.get("ss_network_dim")
+    return {
+        "rank": int(rank) if rank is not None else None,
+        "alpha": metadata.get("ss_network_alpha"),
+        "target_modules": sorted(targets),
+        "num_tensors": len(header),
+        "dtypes": sorted(d for d in dtypes if d),
+        "base_model": metadata.get("ss_base_model_version") or metadata.get("modelspec.architecture"),
+        "trigger_words": _trigger_words(metadata),
+        "title": metadata.get("modelspec.title") or metadata.get("ss_output_name")
+    }
+
+def _load_catalog(store_path):
+    global _catalog
+    if _catalog is None:
+        _catalog = {}
+        try:
+            with open(store_path, "r") as f:
+                data = json.load(f)
+            if data.get("version") == CATALOG_VERSION:
+                _catalog = data.get("entries", {})
+        except (OSError, ValueError):
+            pass
+    return _catalog
+
+def _save_catalog(store_path):
+    try:
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        tmp_path = store_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": CATALOG_VERSION, "entries": _catalog}, f)
+        os.replace(tmp_path, store_path)
+    except OSError as e:
+        print(f"Warning: could not save LoRA catalog: {e}")
+
+def scan_catalog(folder_path, store_path=CATALOG_PATH):
+    """
+    Returns metadata for every .safetensors in folder_path, sorted by filename.
+    Only new or changed files (size / mtime) have their header read; the rest
+    comes from the persistent catalog.
+    """
+    if not os.path.isdir(folder_path):
+        return []
+
+    with _catalog_lock:
+        catalog = _load_catalog(store_path)
+        folder = os.path.abspath(folder_path)
+        seen, results, changed = set(), [], False
+
+        with os.scandir(folder) as it:
+            for entry in it:
+                if not entry.name.endswith(".safetensors") or not entry.is_file():
+                    continue
+                st = entry.stat()
+                path = entry.path
+                seen.add(path)
+                cached = catalog.get(path)
+                if cached is None or cached["size"] != st.st_size or cached["mtime"] != st.st_mtime:
+                    cached = {"filename": entry.name, "path": path, "size": st.st_size, "mtime": st.st_mtime}
+                    try:
+                        cached.update(describe_lora(path))
+                    except Exception as e:
+                        cached["error"] = str(e)
+                    catalog[path] = cached
+                    changed = True
+                results.append(cached)
+
+        # Files removed from this folder
+        for path in [p for p in catalog if os.path.dirname(p) == folder and p not in seen]:
+            del catalog[path]
+            changed = True
+
+        if changed:
+            _save_catalog(store_path)
+
+    return sorted(results, key=lambda e: e["filename"])
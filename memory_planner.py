@@ -0,0 +1,307 @@
+import os
+import json
+import torch
+import shared_utils
+from result_cache import model_revision
+
+# Memory strategy of the GLM-Image pipeline, chosen per pipeline call.
+# The weights of every component are measured once; the activations of a call
+# are estimated from the requested width, height, batch and CFG, and the active
+# LoRA files are added to the transformer. The planner compares the predicted
+# peak of each plan with the memory this process can use on the device
+# (free + already reserved by us, minus GLM_MEMORY_HEADROOM_MB) and picks the
+# fastest plan that fits:
+#   resident            all components on the GPU, full VAE decode, SDPA attention
+#   resident_tiled      same, VAE decoded in tiles
+#   model_offload       one component on the GPU at a time (accelerate hooks), tiled VAE
+#   model_offload_sliced  same, attention computed in slices
+#   sequential_offload  one submodule at a time, max attention slicing (slowest, smallest)
+# The placement only changes when the chosen plan needs a different one, and
+# release() moves everything back to the CPU before another model (GLM-4.1V)
+# runs on the same device.
+# After each call the measured peak corrects the activation estimate (moving
+# average per model revision, kept in /app/cache/memory_planner.json).
+# GLM_MEMORY_PLAN forces a plan by name ("auto" by default).
+
+CACHE_PATH = os.environ.get("GLM_MEMORY_PLAN_CACHE", "/app/cache/memory_planner.json")
+FORCED_PLAN = os.environ.get("GLM_MEMORY_PLAN", "auto")
+HEADROOM = int(os.environ.get("GLM_MEMORY_HEADROOM_MB", "1536")) * 2**20
+
+MB = 2**20
+GB = 2**30
+
+# Rough bf16 activation costs, corrected at runtime from the measured peaks
+DIT_BYTES_PER_TOKEN = 160 * 1024   # per latent token (16x16 pixels) of each image in the transformer call
+AR_BYTES = 2 * GB                  # AR prior: KV cache and logits (sampled once per call)
+TEXT_BYTES = 256 * MB
+VAE_BYTES_PER_PIXEL = 1536         # untiled decode of one image
+VAE_TILED_BYTES = 1536 * MB        # tiled decode, any size
+SLICED_FACTOR = 0.6                # share of the transformer activations left with attention slicing
+SEQUENTIAL_WEIGHTS = 2 * GB        # largest block on the GPU at a time with sequential offload
+CORRECTION_RANGE = (0.25, 4.0)
+CORRECTION_RATE = 0.3
+
+# Components of each stage of a GLM-Image call, in order
+STAGES = {
+    "ar": "vision_language_encoder",
+    "text": "text_encoder",
+    "dit": "transformer",
+    "vae": "vae"
+}
+# Modules pinned to the GPU by i2i under model offload (see pin_vision_encoders)
+VISION_COMPONENTS = ("vision_language_encoder", "vision_model", "image_encoder")
+
+# name -> (placement, vae_tiling, attention); fastest first
+PLANS = {
+    "resident": ("resident", False, "sdpa"),
+    "resident_tiled": ("resident", True, "sdpa"),
+    "model_offload": ("model_offload", True, "sdpa"),
+    "model_offload_sliced": ("model_offload", True, "sliced"),
+    "sequential_offload": ("sequential_offload", True, "sliced_max")
+}
+
+def module_bytes(module):
+    """Bytes of the parameters and buffers of a torch module."""
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+def lora_bytes(loras):
+    """Total file size of the active LoRAs of a job ([[path, strength, active], ...])."""
+    total = 0
+    for entry in loras or []:
+        path = entry[0] if entry else None
+        active = entry[2] if len(entry) > 2 else True
+        if active and path and os.path.exists(path):
+            total += os.path.getsize(path)
+    return total
+
+def device_budget():
+    """(usable bytes, free bytes) on the current CUDA device, None if there is none."""
+    if not torch.cuda.is_available():
+        return None
+    free, _ = torch.cuda.mem_get_info()
+    # Memory already cached by our allocator is reusable by this process
+    usable = free + torch.cuda.memory_reserved() - HEADROOM
+    return max(usable, 0), free
+
+class MemoryPlanner:
+    def __init__(self, pipe, model_id, prefix="Worker"):
+        self.pipe = pipe
+        self.prefix = prefix
+        self.model_id = model_id
+        self.revision = model_revision(model_id)
+        self.weights = {}  # component name -> bytes
+        for name, component in getattr(pipe, "components", {}).items():
+            if isinstance(component, torch.nn.Module):
+                self.weights[name] = module_bytes(component)
+        self.placement = "cpu"  # from_pretrained loads on the CPU
+        self.vae_tiling = None
+        self.attention = None
+        self.correction = self._load_correction()
+        self.last = None
+        self.job_peak = 0  # peak bytes of the calls observed before the latest reset
+
+    # --- Estimates ---
+    def activations(self, width, height, batch, guidance, attention, vae_tiling):
+        """Predicted activation bytes per stage of one pipeline call."""
+        cfg = 2 if guidance and guidance > 1 else 1
+        tokens = (width // 16) * (height // 16)
+        dit = batch * cfg * tokens * DIT_BYTES_PER_TOKEN
+        if attention != "sdpa":
+            dit *= SLICED_FACTOR
+        vae = VAE_TILED_BYTES if vae_tiling else batch * width * height * VAE_BYTES_PER_PIXEL
+        return {stage: size * self.correction for stage, size in
+                (("ar", AR_BYTES), ("text", TEXT_BYTES), ("dit", dit), ("vae", vae))}
+
+    def predict(self, name, width, height, batch, guidance, lora_size=0, pinned=()):
+        """(predicted peak bytes, of which weights) of plan `name` for one call."""
+        placement, vae_tiling, attention = PLANS[name]
+        act = self.activations(width, height, batch, guidance, attention, vae_tiling)
+        if placement == "resident":
+            weights = sum(self.weights.values()) + lora_size
+            return weights + max(act.values()), weights
+        if placement == "sequential_offload":
+            return SEQUENTIAL_WEIGHTS + max(act.values()), SEQUENTIAL_WEIGHTS
+        # Model offload: one stage's component on the GPU at a time, plus the pinned ones
+        pinned_bytes = sum(self.weights.get(name, 0) for name in pinned)
+        peak, peak_weights = 0, 0
+        for stage, component in STAGES.items():
+            weights = pinned_bytes
+            if component not in pinned:
+                weights += self.weights.get(component, 0)
+            if stage == "dit":
+                weights += lora_size
+            if weights + act[stage] > peak:
+                peak, peak_weights = weights + act[stage], weights
+        return peak, peak_weights
+
+    def choose(self, width, height, batch, guidance, loras=None, pinned=()):
+        """Plan info for one call: the fastest plan predicted to fit (the forced one if GLM_MEMORY_PLAN is set)."""
+        lora_size = lora_bytes(loras)
+        budget = device_budget()
+        if budget is None:
+            return {"plan": "cpu", "placement": "cpu", "vae_tiling": True, "attention": "sdpa"}
+        usable, free = budget
+        candidates = [FORCED_PLAN] if FORCED_PLAN in PLANS else list(PLANS)
+        for name in candidates:
+            peak, weights = self.predict(name, width, height, batch, guidance, lora_size, pinned)
+            if peak <= usable:
+                break
+        # Nothing fits: the smallest plan, generate_in_chunks halves the batch on OOM
+        placement, vae_tiling, attention = PLANS[name]
+        return {
+            "plan": name, "placement": placement, "vae_tiling": vae_tiling, "attention": attention,
+            "predicted_peak_mb": round(peak / MB), "predicted_weights_mb": round(weights / MB),
+            "usable_mb": round(usable / MB), "free_mb": round(free / MB),
+            "lora_mb": round(lora_size / MB), "batch": batch
+        }
+
+    # --- Placement ---
+    def apply(self, plan, pin_vision=False):
+        """Moves the pipeline to the plan's placement and sets VAE tiling / attention (only what changed)."""
+        pipe = self.pipe
+        placement = plan["placement"]
+        if placement != self.placement and placement != "cpu":
+            print(f"--> [{self.prefix}] Memory plan: {plan['plan']} "
+                  f"(predicted peak {plan['predicted_peak_mb']} MB of {plan['usable_mb']} MB usable)", flush=True)
+            with shared_utils.stage_timer.stage("offload", sync=True):
+                if hasattr(pipe, "remove_all_hooks"):
+                    pipe.remove_all_hooks()
+                if self.placement == "resident":
+                    pipe.to("cpu")
+                    torch.cuda.empty_cache()
+                if placement == "resident":
+                    pipe.to("cuda")
+                elif placement == "model_offload":
+                    pipe.enable_model_cpu_offload()
+                else:
+                    pipe.enable_sequential_cpu_offload()
+            self.placement = placement
+
+        if plan["vae_tiling"] != self.vae_tiling:
+            method = "enable_vae_tiling" if plan["vae_tiling"] else "disable_vae_tiling"
+            if hasattr(pipe, method):
+                getattr(pipe, method)()
+            self.vae_tiling = plan["vae_tiling"]
+
+        if plan["attention"] != self.attention:
+            if plan["attention"] == "sdpa":
+                # Default processors: scaled_dot_product_attention (flash / memory-efficient kernels)
+                if hasattr(pipe, "disable_attention_slicing"):
+                    pipe.disable_attention_slicing()
+            elif hasattr(pipe, "enable_attention_slicing"):
+                pipe.enable_attention_slicing("max" if plan["attention"] == "sliced_max" else "auto")
+            self.attention = plan["attention"]
+
+        if pin_vision and self.placement == "model_offload":
+            # The vision encoders must stay on the GPU for i2i under model offload
+            with shared_utils.stage_timer.stage("offload", sync=True):
+                shared_utils.pin_vision_encoders(pipe)
+
+    def release(self):
+        """Moves the whole pipeline back to the CPU, e.g. before another model runs on this device."""
+        if self.placement == "cpu":
+            return False
+        print(f"--> [{self.prefix}] Releasing VRAM ({self.placement} -> cpu)", flush=True)
+        with shared_utils.stage_timer.stage("offload", sync=True):
+            if hasattr(self.pipe, "remove_all_hooks"):
+                self.pipe.remove_all_hooks()
+            self.pipe.to("cpu")
+            torch.cuda.empty_cache()
+        self.placement = "cpu"  # the next prepare() places it again
+        return True
+
+    def prepare(self, width, height, batch, guidance, loras=None, pin_vision=False):
+        """Chooses and applies the plan of the next pipeline call. Returns its plan info."""
+        pinned = VISION_COMPONENTS if pin_vision else ()
+        plan = self.choose(width, height, batch, guidance, loras, pinned)
+        if pin_vision and plan["placement"] == "model_offload":
+            plan["pinned"] = [name for name in VISION_COMPONENTS if name in self.weights]
+        self.apply(plan, pin_vision)
+        if torch.cuda.is_available():
+            # Each observation covers one call (chunks, OOM retries and sweep cells included)
+            self.job_peak = max(self.job_peak, torch.cuda.max_memory_allocated())
+            torch.cuda.reset_peak_memory_stats()
+        self.last = plan
+        return plan
+
+    def observe(self, plan):
+        """Adds the measured peak of the call to plan info and corrects the activation estimate with it."""
+        if not torch.cuda.is_available() or "predicted_peak_mb" not in plan:
+            return plan
+        torch.cuda.synchronize()
+        actual = torch.cuda.max_memory_allocated() / MB
+        plan["actual_peak_mb"] = round(actual)
+        plan["actual_reserved_mb"] = round(torch.cuda.max_memory_reserved() / MB)
+        predicted_act = plan["predicted_peak_mb"] - plan["predicted_weights_mb"]
+        measured_act = actual - plan["predicted_weights_mb"]
+        if predicted_act > 0 and measured_act > 0:
+            ratio = measured_act / predicted_act
+            correction = self.correction * (1 - CORRECTION_RATE + CORRECTION_RATE * ratio)
+            self.correction = min(max(correction, CORRECTION_RANGE[0]), CORRECTION_RANGE[1])
+            self._save_correction()
+        print(f"--> [{self.prefix}] Memory: {plan['plan']}, peak {plan['actual_peak_mb']} MB "
+              f"(predicted {plan['predicted_peak_mb']} MB)", flush=True)
+        return plan
+
+    # --- Correction cache ---
+    def _load_correction(self):
+        try:
+            with open(CACHE_PATH, "r") as f:
+                entry = json.load(f).get(self.model_id)
+        except (OSError, ValueError):
+            entry = None
+        if entry and entry.get("revision") == self.revision:
+            return float(entry["correction"])
+        return 1.0
+
+    def _save_correction(self):
+        try:
+            with open(CACHE_PATH, "r") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        cache[self.model_id] = {"revision": self.revision, "correction": round(self.correction, 4)}
+        try:
+            os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+            with open(CACHE_PATH, "w") as f:
+                json.dump(cache, f)
+        except OSError as e:
+            print(f"--> [{self.prefix}] Warning: could not cache the memory estimate: {e}", flush=True)
+
+_planner = None
+
+def install(pipe, model_id, prefix="Worker", width=1024, height=1024):
+    """Creates the planner of a freshly loaded pipeline and places it for a default 1024x1024 image."""
+    global _planner
+    _planner = MemoryPlanner(pipe, model_id, prefix)
+    _planner.prepare(width, height, 1, 1.5)
+    return _planner
+
+def prepare(width, height, batch=1, guidance=1.5, loras=None, pin_vision=False):
+    """Plan info of the next pipeline call (None if no planner is installed)."""
+    if _planner is None:
+        return None
+    return _planner.prepare(width, height, batch, guidance, loras, pin_vision)
+
+def release():
+    """Frees the VRAM held by the pipeline (False if nothing was on the GPU)."""
+    return _planner.release() if _planner is not None else False
+
+def observe(plan):
+    if _planner is None or plan is None:
+        return plan
+    return _planner.observe(plan)
+
+def last_plan():
+    """Plan info of the latest pipeline call, with its measured peak once observed."""
+    return dict(_planner.last) if _planner is not None and _planner.last else None
+
+def take_job_peak():
+    """Peak bytes allocated since the last call (whole job, across the per-call resets of prepare())."""
+    if not torch.cuda.is_available():
+        return 0
+    peak = torch.cuda.max_memory_allocated()
+    if _planner is not None:
+        peak, _planner.job_peak = max(peak, _planner.job_peak), 0
+    return peak
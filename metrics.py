@@ -0,0 +1,116 @@
+import bisect
+
+# Minimal Prometheus text-format metrics (exposition format 0.0.4) for /metrics.
+# Only what the server needs: labelled counters and histograms, plus gauges
+# that are read at scrape time. Everything is updated on the server event loop.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds: sub-second stages (LoRA switch, save) up to multi-minute jobs
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.label_names = name, help_text, tuple(labels)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, key)} {_number(value)}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.label_names = name, help_text, tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}  # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        series = self.series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, ('le', _number(float(bound))))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(self.label_names, key, ('le', '+Inf'))} {series[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(round(series[-2], 6))}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {series[-1]}")
+        return lines
+
+class Gauge:
+    """Value read from a callable at scrape time."""
+
+    def __init__(self, name, help_text, read):
+        self.name, self.help, self.read = name, help_text, read
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {_number(self.read())}"]
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+JOBS = registry.add(Counter("glm_jobs_total", "Finished jobs by mode and final state (done, failed, cancelled).", ("mode", "state")))
+JOB_SECONDS = registry.add(Histogram("glm_job_duration_seconds", "Wall time of a job on the GPU.", ("mode",)))
+QUEUE_WAIT_SECONDS = registry.add(Histogram("glm_job_queue_wait_seconds", "Time a job waited in the queue before running.", ("mode",)))
+RESULT_CACHE = registry.add(Counter("glm_result_cache_total", "Generation requests answered from existing outputs (hit) or rendered (miss).", ("result",)))
+STAGE_SECONDS = registry.add(Histogram("glm_stage_duration_seconds", "Worker time per job stage (load, lora, ar_prior, denoise, vae_decode, offload, save, ...).", ("mode", "stage")))
+
+OUTPUT_ENCODE_SECONDS = registry.add(Histogram("glm_output_encode_seconds", "Archival encode time per saved image.", ("format",)))
+OUTPUT_BYTES = registry.add(Counter("glm_output_bytes_total", "Bytes of saved images by output format.", ("format",)))
+
+def observe_job(job):
+    """JobScheduler on_finish hook."""
+    JOBS.inc(mode=job.mode, state=job.state)
+    if job.started_at:
+        QUEUE_WAIT_SECONDS.observe(job.started_at - job.created_at, mode=job.mode)
+        JOB_SECONDS.observe(job.finished_at - job.started_at, mode=job.mode)
+
+def observe_stages(mode, timings):
+    for stage, seconds in (timings or {}).items():
+        STAGE_SECONDS.observe(float(seconds), mode=mode, stage=stage)
+
+def observe_outputs(stats):
+    """Per-format totals of one job (output_writer.BackgroundWriter.take_stats); the encode time is averaged per image."""
+    for fmt, entry in (stats or {}).items():
+        for _ in range(entry["count"]):
+            OUTPUT_ENCODE_SECONDS.observe(entry["encode_s"] / entry["count"], format=fmt)
+        OUTPUT_BYTES.inc(entry["bytes"], format=fmt)
@@ -0,0 +1,193 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import shared_utils
+import thumbnails
+import ipc
+
+# Encoding policy and background archival of generated images.
+# As soon as an image is decoded, the worker writes a fast JPEG preview and
+# streams it to the client. The archival encode (PNG / WebP / JPEG per policy)
+# and the thumbnails then run on one background thread, overlapping with the
+# next images on the GPU. The V2 logs are written by the worker thread once the
+# job's images are all saved (write_logs), with the job's final stage timings.
+# Encode time and file size are recorded per format in each log and in the job metrics.
+
+OUTPUT_DIR = "/app/outputs"
+PREVIEW_DIR = os.path.join(OUTPUT_DIR, "previews")  # served under /outputs/previews
+PREVIEW_QUALITY = 85
+PREVIEW_MAX_AGE = 600  # seconds a preview is kept after it was written
+
+DEFAULT_FORMAT = os.environ.get("GLM_OUTPUT_FORMAT", "png")
+DEFAULT_QUALITY = int(os.environ.get("GLM_OUTPUT_QUALITY", "95"))
+PNG_COMPRESS_LEVEL = int(os.environ.get("GLM_PNG_COMPRESS_LEVEL", "6"))  # PIL default; 1 is several times faster
+
+# format -> (extension, PIL format)
+FORMATS = {
+    "png": (".png", "PNG"),
+    "webp_lossless": (".webp", "WEBP"),
+    "webp": (".webp", "WEBP"),
+    "jpeg": (".jpg", "JPEG")
+}
+
+def resolve_policy(fmt=None, quality=None):
+    """Per-request format / quality, falling back to the server defaults. Raises ValueError for unknown formats."""
+    fmt = (fmt or DEFAULT_FORMAT).lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown output format: {fmt} (expected one of {', '.join(FORMATS)})")
+    quality = int(quality if quality is not None else DEFAULT_QUALITY)
+    if not 1 <= quality <= 100:
+        raise ValueError("Output quality must be between 1 and 100")
+    return {"format": fmt, "quality": quality}
+
+def extension(policy):
+    return FORMATS[policy["format"]][0]
+
+def _save_options(policy):
+    fmt, quality = policy["format"], policy["quality"]
+    if fmt == "png":
+        return {"compress_level": PNG_COMPRESS_LEVEL}
+    if fmt == "webp_lossless":
+        return {"lossless": True, "quality": 80, "method": 4}  # quality is compression effort here
+    if fmt == "webp":
+        return {"quality": quality, "method": 4}
+    return {"quality": quality, "subsampling": 0}  # JPEG, 4:4:4 chroma
+
+def encode(image, path, policy):
+    """
+    Archival encode of image to path (written under a temporary name first). Returns (seconds, bytes).
+    The name claim of shared_utils.unique_output_path() is dropped once the file is in place.
+    """
+    if policy["format"] == "jpeg" and image.mode != "RGB":
+        image = image.convert("RGB")
+    start = time.perf_counter()
+    tmp_path = path + ".tmp"
+    image.save(tmp_path, FORMATS[policy["format"]][1], **_save_options(policy))
+    os.replace(tmp_path, path)
+    shared_utils.release_output_path(path)
+    return time.perf_counter() - start, os.path.getsize(path)
+
+def write_preview(image, final_path):
+    """Fast JPEG of the image for the client while the archival file is encoded. Returns its path."""
+    os.makedirs(PREVIEW_DIR, exist_ok=True)
+    prune_previews()
+    path = os.path.join(PREVIEW_DIR, os.path.splitext(os.path.basename(final_path))[0] + ".jpg")
+    rgb = image if image.mode == "RGB" else image.convert("RGB")
+    rgb.save(path, "JPEG", quality=PREVIEW_QUALITY)
+    return path
+
+def prune_previews():
+    limit = time.time() - PREVIEW_MAX_AGE
+    for entry in os.scandir(PREVIEW_DIR):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < limit:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+class BackgroundWriter:
+    """One background thread for archival work; drain() waits for it and re-raises the first failure."""
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="output_writer")
+        self.pending = []
+        self.stats = {}  # format -> {"count", "encode_s", "bytes"} for the current job
+        self.logs = []   # save_generation_log() arguments of the images archived in the current job
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        self.pending.append(self.executor.submit(fn, *args, **kwargs))
+
+    def drain(self):
+        pending, self.pending = self.pending, []
+        error = None
+        for future in pending:
+            try:
+                future.result()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    def record(self, fmt, seconds, size):
+        with self._lock:
+            entry = self.stats.setdefault(fmt, {"count": 0, "encode_s": 0.0, "bytes": 0})
+            entry["count"] += 1
+            entry["encode_s"] = round(entry["encode_s"] + seconds, 4)
+            entry["bytes"] += size
+
+    def take_stats(self):
+        with self._lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    def defer_log(self, *args, **kwargs):
+        with self._lock:
+            self.logs.append((args, kwargs))
+
+    def take_logs(self):
+        with self._lock:
+            logs, self.logs = self.logs, []
+        return logs
+
+writer = BackgroundWriter()
+
+def write_logs(timings):
+    """Writes the V2 logs of the images archived so far, with the job's stage timings (worker thread, after drain())."""
+    for args, kwargs in writer.take_logs():
+        shared_utils.save_generation_log(*args, timings=timings, **kwargs)
+
+def archive(image, save_path, policy, finish, label):
+    """
+    Queues the archival encode of image, then finish(output_info) on the background thread.
+    output_info: {"format", "quality", "encode_s", "bytes"}, also recorded in the job stats.
+    """
+    def run():
+        try:
+            seconds, size = encode(image, save_path, policy)
+        except Exception:
+            if os.path.exists(save_path + ".tmp"):
+                os.remove(save_path + ".tmp")
+            shared_utils.release_output_path(save_path)
+            raise
+        writer.record(policy["format"], seconds, size)
+        print(f"--> [{label}] Saved: {os.path.basename(save_path)} ({policy['format']}, "
+              f"{size / 1024:.0f} KB, {seconds:.2f}s)", flush=True)
+        finish(dict(policy, encode_s=round(seconds, 4), bytes=size))
+
+    writer.submit(run)
+
+def save_images(mode, seeds, images, inputs, params, policy, meta, label):
+    """
+    Saves the images of one batched pipeline call (T2I / I2I), each under a claimed name with its
+    own V2 log: a preview is streamed now, the archival file and thumbnails follow in the background,
+    the log at the end of the job (write_logs).
+    params: log parameters, "seed" is set per image. meta: extra log meta (None values are left out),
+    plus the output info and, for batches, the seed the shared AR prior was sampled from.
+    Returns the saved paths.
+    """
+    meta = {k: v for k, v in meta.items() if v is not None}
+    if len(seeds) > 1:
+        meta["prior_seed"] = seeds[0]  # the AR prior of a batched call is sampled once, from the first seed
+
+    saved = []
+    for seed, image in zip(seeds, images):
+        save_path = shared_utils.unique_output_path(mode, extension(policy))
+        image_params = dict(params, seed=seed)
+        outputs = {"type": "image", "files": [os.path.basename(save_path)]}
+
+        def finish(output_info, save_path=save_path, seed=seed, params=image_params, outputs=outputs):
+            # Background thread, once the archival file is written
+            ipc.emit("result", kind="image", path=save_path, seed=seed)
+            thumbnails.make_thumbnails(save_path)
+            writer.defer_log(mode, inputs, params, outputs, image_path_for_filename=save_path,
+                             extra_meta=dict(meta, output=output_info))
+
+        with shared_utils.stage_timer.stage("save"):
+            # Fast preview to the client now, the archival file in the background
+            preview = write_preview(image, save_path)
+            ipc.emit("result", kind="preview", path=preview, seed=seed)
+            archive(image, save_path, policy, finish, label)
+        saved.append(save_path)
+    return saved
@@ -0,0 +1,118 @@
+import os
+import copy
+import hashlib
+from collections import OrderedDict
+import torch
+import storage
+
+# Prefix KV cache of the resident I2T worker.
+# Questions about one image share a token prefix: the chat template header, the
+# image tokens and, in a conversation, the earlier turns. After each request the
+# KV cache of its prompt + answer is kept (in a chat, re-encoded as the answer-only
+# turn the next prompt will contain, see process_i2t); a later request on the same image
+# (same files, same blend) continues from the longest common token prefix, so the
+# image is not decoded again, the vision tower does not run and only the new
+# tokens are prefilled. Entries stay on the GPU, bounded by count and by tokens.
+
+MAX_ENTRIES = int(os.environ.get("GLM_I2T_PREFIX_ITEMS", "8"))
+MAX_TOKENS = int(os.environ.get("GLM_I2T_PREFIX_TOKENS", "32768"))
+MAX_IMAGES = 256
+
+def image_key(image_path, image_path_2=None, mix_ratio=0.5):
+    """Content hash of the source image(s) and blend ratio: what the vision tower actually sees."""
+    parts = [storage.file_digest(image_path)]
+    if image_path_2:
+        parts += [storage.file_digest(image_path_2), f"{float(mix_ratio):.4f}"]
+    return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+def common_prefix(a, b):
+    """Length of the common prefix of two 1D token tensors."""
+    n = min(len(a), len(b))
+    diff = (a[:n] != b[:n]).nonzero()
+    return int(diff[0]) if len(diff) else n
+
+def _layer_tensors(past_key_values):
+    """Key and value tensors ([batch, heads, seq, dim]) of a transformers DynamicCache, per-layer or legacy layout."""
+    layers = getattr(past_key_values, "layers", None)
+    if layers is not None:
+        tensors = [t for layer in layers for t in (getattr(layer, "keys", None), getattr(layer, "values", None))]
+    else:
+        tensors = list(past_key_values.key_cache) + list(past_key_values.value_cache)
+    return [t for t in tensors if torch.is_tensor(t) and t.dim() == 4]
+
+class CacheEntry:
+    def __init__(self, key, ids, past_key_values, rope_deltas):
+        self.key = key
+        self.ids = ids  # CPU tokens covered by past_key_values
+        self.past_key_values = past_key_values
+        self.rope_deltas = rope_deltas
+
+class PrefixCache:
+    def __init__(self, max_entries=MAX_ENTRIES, max_tokens=MAX_TOKENS):
+        self.max_entries = max_entries
+        self.max_tokens = max_tokens
+        self.entries = OrderedDict()  # id -> CacheEntry, least recently used first
+        self.images = OrderedDict()   # image key -> {"grid_thw", "original_dims"}
+        self._next_id = 0
+
+    # --- Per image: what is needed to rebuild the prompt tokens without the image ---
+    def image_info(self, key):
+        info = self.images.get(key)
+        if info is not None:
+            self.images.move_to_end(key)
+        return info
+
+    def remember_image(self, key, grid_thw, original_dims):
+        self.images[key] = {"grid_thw": grid_thw.detach().to("cpu"), "original_dims": tuple(original_dims)}
+        self.images.move_to_end(key)
+        while len(self.images) > MAX_IMAGES:
+            self.images.popitem(last=False)
+
+    # --- KV prefixes ---
+    def match(self, key, ids, min_length):
+        """Entry of this image sharing the longest token prefix with ids (at least min_length), and that length."""
+        best, best_length = None, 0
+        for entry_id, entry in self.entries.items():
+            if entry.key != key:
+                continue
+            length = common_prefix(entry.ids, ids)
+            if length > best_length:
+                best, best_length = entry_id, length
+        if best is None or best_length < min_length:
+            return None, 0
+        self.entries.move_to_end(best)
+        return self.entries[best], best_length
+
+    def fork(self, entry, length):
+        """
+        Private copy of an entry's KV cache cut to length tokens (generate() extends the cache in place).
+        Only the first length positions of each layer are copied, not the whole cache.
+        """
+        source = entry.past_key_values
+        # deepcopy() takes tensors found in the memo as already copied: give it the cropped clones
+        memo = {id(t): t[..., :length, :].clone() for t in _layer_tensors(source)}
+        past = copy.deepcopy(source, memo)
+        past.crop(length)  # cache bookkeeping (seen tokens); the tensors are already cut
+        return past
+
+    def store(self, key, ids, past_key_values, rope_deltas):
+        ids = ids.detach().to("cpu")
+        # A shorter prefix of the same conversation is superseded by this one
+        for entry_id, entry in list(self.entries.items()):
+            if entry.key == key and len(entry.ids) <= len(ids) and common_prefix(entry.ids, ids) == len(entry.ids):
+                del self.entries[entry_id]
+        self.entries[self._next_id] = CacheEntry(key, ids, past_key_values, rope_deltas)
+        self._next_id += 1
+        while len(self.entries) > self.max_entries or self.total_tokens() > self.max_tokens:
+            if len(self.entries) == 1:
+                break
+            self.entries.popitem(last=False)
+        torch.cuda.empty_cache()
+
+    def total_tokens(self):
+        return sum(len(entry.ids) for entry in self.entries.values())
+
+    def clear(self):
+        self.entries.clear()
+        self.images.clear()
+        torch.cuda.empty_cache()
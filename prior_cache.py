@@ -0,0 +1,174 @@
+import os
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+import torch
+from result_cache import model_revision
+
+# Cache of the GLM-Image autoregressive stage (prior tokens).
+# The pipeline's generate_prior_tokens() is wrapped, so every caller (t2i, i2i,
+# batched calls, sweeps) skips the AR model when the same prompt, seed, source
+# images, resolution, AR sampling params, LoRA set and model (with its revision)
+# were seen before.
+# Entries live in an in-memory LRU (CPU tensors) and are written through to disk,
+# so they survive worker restarts; the disk tier is size-bounded (LRU by mtime).
+
+CACHE_DIR = os.environ.get("GLM_PRIOR_CACHE_DIR", "/app/cache/prior_tokens")
+MAX_MEMORY_ITEMS = int(os.environ.get("GLM_PRIOR_CACHE_ITEMS", "32"))
+MAX_DISK_MB = int(os.environ.get("GLM_PRIOR_CACHE_MB", "1024"))
+
+_cache = None
+
+def _to_cpu(value):
+    if torch.is_tensor(value):
+        return value.detach().to("cpu").clone()
+    if isinstance(value, (list, tuple)):
+        return [_to_cpu(v) for v in value]
+    return value
+
+def _to_device(value, device):
+    if torch.is_tensor(value):
+        return value.to(device)
+    if isinstance(value, (list, tuple)):
+        return [_to_device(v, device) for v in value]
+    return value
+
+def _image_digest(image):
+    """Content hash of the normalized source images (List[List[PIL.Image]]), None if they cannot be hashed."""
+    h = hashlib.sha1()
+    for prompt_images in image:
+        for img in prompt_images:
+            if not hasattr(img, "tobytes"):
+                return None
+            h.update(f"{img.mode}{img.size}".encode())
+            h.update(img.tobytes())
+    return h.hexdigest()
+
+class PriorTokenCache:
+    def __init__(self, pipe, model_id, cache_dir=CACHE_DIR, max_items=MAX_MEMORY_ITEMS, max_disk_mb=MAX_DISK_MB):
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self.max_disk_mb = max_disk_mb
+        self.memory = OrderedDict()  # key -> (prior_token_ids, image_ids, grids) on CPU
+        self.context = {}
+        self.last_status = None
+        config = getattr(pipe, "config", None)
+        self.model = str(getattr(config, "_name_or_path", "") or getattr(pipe, "name_or_path", ""))
+        # Disk entries outlive the process: updated weights at the same path must not reuse them
+        self.revision = model_revision(model_id)
+        self._generate = pipe.generate_prior_tokens
+        pipe.generate_prior_tokens = self.generate_prior_tokens
+
+    def configure(self, top_k=None, temperature=None, loras=None):
+        """Job-level inputs that change the AR output but are not arguments of generate_prior_tokens."""
+        active = []
+        for item in loras or []:
+            path, strength, enabled = item[0], float(item[1]), bool(item[2])
+            if enabled and os.path.exists(path):
+                active.append((os.path.abspath(path), os.path.getmtime(path), strength))
+        self.context = {"top_k": top_k, "temperature": temperature, "loras": sorted(active)}
+        self.last_status = None
+
+    def _key(self, prompt, height, width, image, generator):
+        if generator is None:
+            return None  # unseeded: the AR output is random, nothing to reuse
+        parts = [self.model, self.revision, repr(prompt), str(height), str(width), str(generator.initial_seed()), repr(self.context)]
+        if image is not None:
+            digest = _image_digest(image)
+            if digest is None:
+                return None
+            parts.append(digest)
+        return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key + ".pt")
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def _load(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        path = self._disk_path(key)
+        try:
+            value = torch.load(path, map_location="cpu", weights_only=True)
+            os.utime(path)  # LRU marker for the disk tier
+        except (OSError, RuntimeError, EOFError, ValueError):
+            return None
+        value = tuple(value)
+        self._remember(key, value)
+        return value
+
+    def _store(self, key, value):
+        self._remember(key, value)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = f"{self._disk_path(key)}.{os.getpid()}.tmp"  # workers on other devices share the directory
+            torch.save(list(value), tmp)
+            os.replace(tmp, self._disk_path(key))
+            self.enforce_limit()
+        except Exception as e:
+            print(f"--> [Prior Cache] ⚠️ Could not write to disk: {e}", flush=True)
+
+    def enforce_limit(self):
+        """Evicts the least recently used disk entries until the directory fits in max_disk_mb."""
+        limit = self.max_disk_mb * 1024 * 1024
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(".pt"):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        if total <= limit:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        logging.info("--> [Prior Cache] Disk cache trimmed")
+
+    def generate_prior_tokens(self, prompt, height, width, image=None, device=None, generator=None):
+        key = self._key(prompt, height, width, image, generator)
+        if key is not None:
+            cached = self._load(key)
+            if cached is not None:
+                self.last_status = "hit"
+                print("--> [Prior Cache] Hit: skipping the AR stage", flush=True)
+                return tuple(_to_device(v, device) if device is not None else v for v in cached)
+
+        result = self._generate(prompt=prompt, height=height, width=width, image=image, device=device, generator=generator)
+        self.last_status = "miss" if key is not None else "bypass"
+        if key is not None:
+            self._store(key, tuple(_to_cpu(v) for v in result))
+        return result
+
+def install(pipe, model_id):
+    """Wraps pipe.generate_prior_tokens with the cache (no-op for pipelines without an AR stage)."""
+    global _cache
+    if not hasattr(pipe, "generate_prior_tokens"):
+        return None
+    _cache = PriorTokenCache(pipe, model_id)
+    return _cache
+
+def configure(top_k=None, temperature=None, loras=None):
+    if _cache is not None:
+        _cache.configure(top_k, temperature, loras)
+
+def last_status():
+    """'hit', 'miss' or 'bypass' for the latest AR call of this job, None if it did not run through the cache."""
+    return _cache.last_status if _cache is not None else None
+
+def reset_status():
+    if _cache is not None:
+        _cache.last_status = None
@@ -0,0 +1,233 @@
+import argparse
+import torch
+import sys
+import os
+import gc
+import json
+import time
+import datetime
+import shared_utils
+import ipc
+from PIL import Image
+from transformers import AutoProcessor
+from process_i2t import MODEL_ID, clean_output_text, split_thinking
+
+# Bulk I2T captioning (e.g. LoRA training sets) on one loaded GLM-4.1V model.
+# Images are sorted by size, so each batched generate() call holds inputs of
+# similar length (little padding), and every caption is written next to its
+# image as soon as its batch is done: an interrupted run resumes by skipping
+# the images that already have a sidecar.
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp")
+DEFAULT_BATCH = int(os.environ.get("GLM_CAPTION_BATCH", "8"))
+# Vision patch (14px) merged 2x2 by GLM-4.1V: ~one input token per 28x28 pixels
+PIXELS_PER_TOKEN = 28 * 28
+
+class _KeepMissing(dict):
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+def render_prompt(template, image_path):
+    """Fills {filename}, {stem} and {folder} in the prompt template; other braces are left as they are."""
+    try:
+        return template.format_map(_KeepMissing(
+            filename=os.path.basename(image_path),
+            stem=os.path.splitext(os.path.basename(image_path))[0],
+            folder=os.path.basename(os.path.dirname(os.path.abspath(image_path)))
+        ))
+    except (ValueError, IndexError):
+        return template  # unbalanced braces: not a template
+
+def sidecar_path(image_path, fmt="txt"):
+    """image.txt, or image.caption.json (image.json is the generation log of images in outputs/)."""
+    base = os.path.splitext(image_path)[0]
+    return base + (".txt" if fmt == "txt" else ".caption.json")
+
+def collect_images(folder=None, paths=None, recursive=False):
+    """Image files of folder (optionally recursive) plus the explicit paths, deduplicated, in a stable order."""
+    found = []
+    if folder:
+        if recursive:
+            for root, dirs, files in os.walk(folder):
+                dirs.sort()
+                found.extend(os.path.join(root, f) for f in sorted(files))
+        else:
+            found.extend(os.path.join(folder, f) for f in sorted(os.listdir(folder)))
+    found.extend(paths or [])
+    seen = set()
+    images = []
+    for path in found:
+        key = os.path.abspath(path)
+        if key in seen or not path.lower().endswith(IMAGE_EXTS) or not os.path.isfile(path):
+            continue
+        seen.add(key)
+        images.append(path)
+    return images
+
+def input_length(image_path, template):
+    """Estimated input tokens (image header only, nothing is decoded), used to bucket similar lengths."""
+    try:
+        with Image.open(image_path) as img:
+            width, height = img.size
+    except Exception:
+        width = height = 0
+    return width * height // PIXELS_PER_TOKEN + len(render_prompt(template, image_path)) // 4
+
+def write_sidecar(path, data, fmt):
+    # Written under a temporary name first: a killed run never leaves a half caption that resume would skip
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        if fmt == "txt":
+            f.write(data["caption"] + "\n")
+        else:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def caption_batch(model, processor, image_paths, template, gen_kwargs):
+    """One padded generate() call -> [(raw response, thinking, caption)] in the order of image_paths."""
+    timer = shared_utils.stage_timer
+    with timer.stage("preprocess"):
+        conversations = []
+        for path in image_paths:
+            image = Image.open(path).convert("RGB")
+            conversations.append([{"role": "user", "content": [
+                {"type": "image", "image": image},
+                {"type": "text", "text": render_prompt(template, path)}
+            ]}])
+        inputs = processor.apply_chat_template(
+            conversations, add_generation_prompt=True, tokenize=True,
+            return_dict=True, return_tensors="pt", padding=True
+        ).to("cuda")
+
+    with timer.stage("generate", sync=True):
+        with torch.no_grad():
+            outputs = model.generate(**inputs, **gen_kwargs)
+
+    with timer.stage("decode"):
+        outputs = outputs[:, inputs.input_ids.shape[1]:]
+        results = []
+        for raw in processor.batch_decode(outputs, skip_special_tokens=True):
+            response = clean_output_text(raw)
+            thought, answer = split_thinking(response)
+            results.append((response, thought, answer))
+    return results
+
+def run_caption(folder, paths, prompt, top_k, temperature, batch_size=DEFAULT_BATCH, max_new_tokens=1024,
+                fmt="txt", overwrite=False, recursive=False):
+    print(f"--> [Caption] Starting batch captioning. PID: {os.getpid()}", flush=True)
+    timer = shared_utils.stage_timer
+
+    images = collect_images(folder, paths, recursive)
+    todo = [p for p in images if overwrite or not os.path.exists(sidecar_path(p, fmt))]
+    skipped = len(images) - len(todo)
+    print(f"--> [Caption] {len(images)} images, {skipped} already captioned, {len(todo)} to do", flush=True)
+    if not todo:
+        ipc.emit("metrics", images=0, skipped=skipped, failed=0, images_per_sec=0.0, timings=timer.snapshot())
+        return
+
+    # Length bucketing: neighbours in this order have similar input lengths
+    todo.sort(key=lambda p: input_length(p, prompt))
+
+    try:
+        gc.collect()
+        torch.cuda.empty_cache()
+        with timer.stage("load"):
+            processor = AutoProcessor.from_pretrained(MODEL_ID, trust_remote_code=True)
+            processor.tokenizer.padding_side = "left"  # batched decoder-only generation
+            model = shared_utils.load_i2t_model(MODEL_ID, prefix="Caption")
+
+        gen_kwargs = {
+            "max_new_tokens": int(max_new_tokens),
+            "do_sample": True if temperature > 0 else False,
+            "top_k": int(top_k),
+            "temperature": temperature
+        }
+        params = dict(gen_kwargs, prompt_template=prompt, model=MODEL_ID)
+
+        done = failed = 0
+        start = time.time()
+
+        def run_chunk(chunk):
+            # OOM propagates to generate_in_chunks (smaller batches); any other error marks the image as failed
+            try:
+                return caption_batch(model, processor, chunk, prompt, gen_kwargs)
+            except Exception as e:
+                if shared_utils.is_oom_error(e):
+                    raise
+                if len(chunk) == 1:
+                    print(f"--> [Caption] ❌ {chunk[0]}: {e}", flush=True)
+                    return [None]
+                # A broken image fails the whole call: caption the batch one by one
+                print(f"--> [Caption] ⚠️ Batch failed ({e}), retrying image by image", flush=True)
+                results = []
+                for path in chunk:
+                    results.extend(run_chunk([path]))
+                return results
+
+        for chunk, results in shared_utils.generate_in_chunks(run_chunk, todo, prefix="Caption", max_batch=batch_size):
+            with timer.stage("save"):
+                for path, result in zip(chunk, results):
+                    if result is None:
+                        failed += 1
+                        continue
+                    response, thought, answer = result
+                    sidecar = sidecar_path(path, fmt)
+                    write_sidecar(sidecar, {
+                        "image": os.path.basename(path),
+                        "caption": answer,
+                        "thinking_process": thought,
+                        "raw_full_response": response,
+                        "prompt": render_prompt(prompt, path),
+                        "parameters": params,
+                        "timestamp": datetime.datetime.now().isoformat()
+                    }, fmt)
+                    done += 1
+                    ipc.emit("result", kind="caption", path=sidecar, image=path, caption=answer)
+
+            elapsed = time.time() - start
+            rate = done / elapsed if elapsed > 0 else 0.0
+            remaining = len(todo) - done - failed
+            ipc.emit("progress", step=done + failed, total=len(todo), it_s=round(rate, 3),
+                     eta=round(remaining / rate, 1) if rate > 0 else None, label="caption")
+            print(f"--> [Caption] {done + failed}/{len(todo)} ({rate:.2f} images/sec)", flush=True)
+
+        elapsed = time.time() - start
+        rate = round(done / elapsed, 3) if elapsed > 0 else 0.0
+        print(f"--> [Caption] Completed: {done} captioned, {failed} failed, {skipped} skipped, "
+              f"{rate} images/sec", flush=True)
+        ipc.emit("metrics", elapsed=round(elapsed, 2), images=done, skipped=skipped, failed=failed,
+                 images_per_sec=rate, timings=timer.snapshot())
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"ERROR: {str(e)}", flush=True)
+        ipc.emit("error", message=f"{type(e).__name__}: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Caption a folder or a list of images with GLM-4.1V")
+    parser.add_argument("--folder", type=str, default=None)
+    parser.add_argument("--paths_file", type=str, default=None, help="One image path per line ('-' reads stdin)")
+    parser.add_argument("--recursive", action="store_true")
+    parser.add_argument("--prompt", type=str, default="Describe this image in detail.",
+                        help="Template: {filename}, {stem} and {folder} are filled per image")
+    parser.add_argument("--top_k", type=float, default=1.0)
+    parser.add_argument("--temperature", type=float, default=0.6)
+    parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH)
+    parser.add_argument("--max_new_tokens", type=int, default=1024)
+    parser.add_argument("--format", type=str, default="txt", choices=["txt", "json"])
+    parser.add_argument("--overwrite", action="store_true", help="Caption again images that have a sidecar")
+
+    args = parser.parse_args()
+
+    paths = []
+    if args.paths_file:
+        stream = sys.stdin if args.paths_file == "-" else open(args.paths_file, "r", encoding="utf-8")
+        with stream:
+            paths = [line.strip() for line in stream if line.strip()]
+    if not args.folder and not paths:
+        parser.error("--folder or --paths_file is required")
+
+    run_caption(args.folder, paths, args.prompt, args.top_k, args.temperature, args.batch_size,
+                args.max_new_tokens, args.format, args.overwrite, args.recursive)
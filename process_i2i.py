@@ -9,6 +9,10 @@ import traceback
 import gc
 import datetime
 import shared_utils
+import prior_cache
+import output_writer
+import latent_preview
+import memory_planner
 from PIL import Image
 from diffusers import AutoPipelineForImage2Image, DiffusionPipeline
 
@@ -19,113 +23,138 @@ shared_utils.setup_logging()
 
 
 
-def run_i2i(prompt, image_path, width, height, steps, guidance, seed, lora_config=None, top_k=1, temperature=0.6, image_path_2=None, strength=0.75, mix_ratio=0.5):
-    print(f"--> [I2I Worker] Starting process PID: {os.getpid()}", flush=True)
-
+def generate_i2i(pipe, prompt, image_path, width, height, steps, guidance, seed, loras=None, top_k=1, temperature=0.6, image_path_2=None, strength=0.75, mix_ratio=0.5,
+                 batch_size=1, seeds=None, fingerprint=None, output_format=None, output_quality=None,
+                 preview_every=None):
+    """
+    Runs an I2I generation on an already loaded pipeline. Raises on failure.
+    batch_size images (or one per explicit seed) are generated in batched pipeline calls;
+    each one is saved with its own V2 log. Returns the list of saved paths.
+    fingerprint: request hash from result_cache, stored in each log's meta.
+    output_format / output_quality: archival encoding (see output_writer), server defaults if None.
+    preview_every: steps between latent previews (see latent_preview), 0 disables them.
+    """
     if not os.path.exists(image_path):
-        print(f"ERROR: Input image not found at: {image_path}", flush=True)
-        sys.exit(1)
-
-    try:
-        gc.collect()
-        torch.cuda.empty_cache()
-
-        print("--> [I2I Worker] Loading Pipeline...", flush=True)
-        pipe = DiffusionPipeline.from_pretrained(MODEL_ID, torch_dtype=torch.bfloat16, trust_remote_code=True)
-        shared_utils.load_loras(pipe, lora_config)
-
-
-        print("--> [I2I Worker] Enabling CPU Offload...", flush=True)
-        pipe.enable_model_cpu_offload()
-
-        # Fix Vision Encoder Pinning (Required for model_cpu_offload)
-        vision_components = ["vision_language_encoder", "vision_model", "image_encoder"]
-        for name in vision_components:
-            if hasattr(pipe, name) and getattr(pipe, name) is not None:
-                getattr(pipe, name).to("cuda")
-
-        try: pipe.enable_vae_tiling()
-        except: pass
-        try: pipe.enable_attention_slicing("max")
-        except: pass
+        raise FileNotFoundError(f"Input image not found at: {image_path}")
+    seed_list = shared_utils.resolve_seeds(seed, batch_size, seeds)
+    policy = output_writer.resolve_policy(output_format, output_quality)
+    prior_cache.configure(top_k, temperature, loras)
 
+    with shared_utils.stage_timer.stage("preprocess"):
         # Load and resize first image
         init_image = Image.open(image_path).convert("RGB")
         init_image = init_image.resize((width, height), Image.LANCZOS)
-        
+
         final_init_image = init_image
-        
+
         # Load and resize second image if present and blend
         if image_path_2 and os.path.exists(image_path_2):
             print(f"--> [I2I Worker] Loading secondary image for blending: {os.path.basename(image_path_2)}", flush=True)
             init_image_2 = Image.open(image_path_2).convert("RGB")
             init_image_2 = init_image_2.resize((width, height), Image.LANCZOS)
-            
+
             print(f"--> [I2I Worker] Blending images with ratio: {mix_ratio}", flush=True)
             # Use Image.blend: out = image1 * (1.0 - alpha) + image2 * alpha
             final_init_image = Image.blend(init_image, init_image_2, alpha=float(mix_ratio))
 
-        generator = torch.Generator(device="cuda").manual_seed(seed)
-
-        print(f"--> [I2I Worker] Generating (Strength: {strength}, TopK: {top_k}, Temp: {temperature})...", flush=True)
-        kwargs = {
-            "prompt": prompt, 
-            "image": [final_init_image], 
-            "width": width, "height": height,
-            "num_inference_steps": steps, "generator": generator,
-            "guidance_scale": guidance,
-        }
-        
-        # Filter unsupported kwargs
-        sig_params = inspect.signature(pipe.__call__).parameters
-        
-        if "top_k" in sig_params and top_k is not None: 
-            kwargs["top_k"] = int(top_k)
-        if "temperature" in sig_params and temperature is not None: 
-            kwargs["temperature"] = float(temperature)
-
-        if "strength" in sig_params: 
-            kwargs["strength"] = float(strength)
-        else:
-            print("--> [I2I Warning] 'strength' parameter not supported by this pipeline version.", flush=True)
-
-        image = pipe(**kwargs).images[0]
-
-        out_filename = f"i2i_{int(time.time())}.png"
-        save_path = os.path.join("/app/outputs", out_filename)
-        os.makedirs("/app/outputs", exist_ok=True)
-        image.save(save_path)
-        print(f"SUCCESS_OUTPUT:{save_path}", flush=True)
-
-        # SAVE JSON (V2)
-        
-        inputs_data = {
-            "prompt": prompt,
-            "source_images": [os.path.basename(image_path)],
-            "loras": []
-        }
-        if image_path_2:
-            inputs_data["source_images"].append(os.path.basename(image_path_2))
-            
-        if lora_config and os.path.exists(lora_config):
-            try:
-                with open(lora_config, 'r') as f: inputs_data["loras"] = json.load(f)
-            except: pass
-
-        params_data = {
-            "width": width, "height": height, "steps": steps, "guidance": guidance, 
-            "seed": seed, "strength": strength, "top_k": top_k, "temperature": temperature, 
-            "mix_ratio": mix_ratio
-        }
-
-        outputs_data = {
-            "type": "image",
-            "files": [os.path.basename(save_path)]
-        }
-
-        shared_utils.save_generation_log("i2i", inputs_data, params_data, outputs_data, image_path_for_filename=save_path)
-
-        print("--> [I2I Worker] Task Completed.", flush=True)
+    print(f"--> [I2I Worker] Generating {len(seed_list)} image(s) (Strength: {strength}, TopK: {top_k}, Temp: {temperature})...", flush=True)
+    kwargs = {
+        "prompt": prompt, 
+        "image": [final_init_image], 
+        "width": width, "height": height,
+        "num_inference_steps": steps,
+        "guidance_scale": guidance,
+    }
+    
+    # Filter unsupported kwargs
+    sig_params = inspect.signature(pipe.__call__).parameters
+    
+    if "top_k" in sig_params and top_k is not None: 
+        kwargs["top_k"] = int(top_k)
+    if "temperature" in sig_params and temperature is not None: 
+        kwargs["temperature"] = float(temperature)
+
+    if "strength" in sig_params: 
+        kwargs["strength"] = float(strength)
+    else:
+        print("--> [I2I Warning] 'strength' parameter not supported by this pipeline version.", flush=True)
+
+    step_callback = None
+    if "callback_on_step_end" in sig_params:
+        # img2img skips the first (1 - strength) of the schedule; the callbacks prefer pipe.num_timesteps
+        denoise_steps = max(1, min(int(steps * float(strength)), steps)) if "strength" in sig_params else steps
+        step_callback = latent_preview.make_callback(MODEL_ID, denoise_steps, preview_every,
+                                                     progress=shared_utils.make_progress_callback(denoise_steps))
+        kwargs["callback_on_step_end"] = step_callback
+        if "callback_on_step_end_tensor_inputs" in sig_params:
+            kwargs["callback_on_step_end_tensor_inputs"] = ["latents"]
+
+    def run_chunk(chunk_seeds):
+        # One generator per image for the diffusion noise (the pipeline uses the first one for the AR prior)
+        prior_cache.reset_status()
+        # The vision encoders are pinned to the GPU when the plan offloads the model
+        plan = memory_planner.prepare(width, height, len(chunk_seeds), guidance, loras, pin_vision=True)
+        device = shared_utils.execution_device(pipe)
+        generators = [torch.Generator(device=device).manual_seed(s) for s in chunk_seeds]
+        with shared_utils.stage_timer.stage("denoise", sync=True):
+            images = pipe(**kwargs, num_images_per_prompt=len(chunk_seeds), generator=generators).images
+        memory_planner.observe(plan)
+        latent_preview.calibrate(MODEL_ID, images[0])  # first run of a model only
+        return images
+
+    inputs_data = {
+        "prompt": prompt,
+        "source_images": [os.path.basename(image_path)],
+        "loras": loras or []
+    }
+    if image_path_2:
+        inputs_data["source_images"].append(os.path.basename(image_path_2))
+    params_data = {
+        "width": width, "height": height, "steps": steps, "guidance": guidance,
+        "seed": seed, "strength": strength, "top_k": top_k, "temperature": temperature,
+        "mix_ratio": mix_ratio
+    }
+
+    saved = []
+    for chunk_seeds, images in shared_utils.generate_in_chunks(run_chunk, seed_list, prefix="I2I Worker"):
+        # How the images were produced goes to the log meta, not to the user parameters
+        meta = {"prior_cache": prior_cache.last_status(), "memory": memory_planner.last_plan(),
+                "fingerprint": fingerprint}
+        saved += output_writer.save_images("i2i", chunk_seeds, images, inputs_data, params_data, policy,
+                                           meta, "I2I Worker")
+
+    with shared_utils.stage_timer.stage("save"):
+        output_writer.writer.drain()  # files and thumbnails all written before the job ends
+    output_writer.write_logs(shared_utils.stage_timer.snapshot())
+    latent_preview.report(step_callback, "I2I Worker")
+    print("--> [I2I Worker] Task Completed.", flush=True)
+    return saved
+
+def run_i2i(prompt, image_path, width, height, steps, guidance, seed, lora_config=None, top_k=1, temperature=0.6, image_path_2=None, strength=0.75, mix_ratio=0.5):
+    print(f"--> [I2I Worker] Starting process PID: {os.getpid()}", flush=True)
+
+    if not os.path.exists(image_path):
+        print(f"ERROR: Input image not found at: {image_path}", flush=True)
+        sys.exit(1)
+
+    try:
+        gc.collect()
+        torch.cuda.empty_cache()
+
+        print("--> [I2I Worker] Loading Pipeline...", flush=True)
+        with shared_utils.stage_timer.stage("load"):
+            pipe = DiffusionPipeline.from_pretrained(MODEL_ID, torch_dtype=torch.bfloat16, trust_remote_code=True)
+        with shared_utils.stage_timer.stage("lora"):
+            shared_utils.load_loras(pipe, lora_config)
+
+        with shared_utils.stage_timer.stage("load"):
+            memory_planner.install(pipe, MODEL_ID, prefix="I2I Worker")
+        shared_utils.instrument_pipeline(pipe)
+        prior_cache.install(pipe, MODEL_ID)
+
+        generate_i2i(pipe, prompt, image_path, width, height, steps, guidance, seed,
+                     shared_utils.read_lora_config(lora_config), top_k, temperature,
+                     image_path_2, strength, mix_ratio)
 
     except Exception as e:
         print(f"CRITICAL ERROR IN I2I WORKER:")
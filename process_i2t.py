@@ -5,10 +5,13 @@ import os
 import gc
 import re
 import json
+import time
 import datetime
 import shared_utils
+import ipc
+from prefix_cache import image_key, common_prefix
 from PIL import Image
-from transformers import AutoProcessor, AutoModel
+from transformers import AutoProcessor, TextStreamer
 
 # Thinking Version (GLM-4.1V)
 MODEL_ID = "zai-org/GLM-4.1V-9B-Thinking"
@@ -19,159 +22,335 @@ def clean_output_text(text):
     text = re.sub(r'\s+', ' ', text).strip()
     return text
 
+def split_thinking(response):
+    """Cleaned response -> (thinking process, final answer)."""
+    thought = ""
+    answer = response
+    think_match = re.search(r'<think>(.*?)</think>', response, re.DOTALL)
+    if think_match:
+        thought = think_match.group(1).strip()
+        answer = response.replace(think_match.group(0), "").strip()
 
+    answer = answer.replace("<answer>", "").replace("</answer>", "").strip()
+    return thought, answer
 
-def run_i2t(image_path, image_path_2, prompt, top_k, temperature, strength=0.75, mix_ratio=0.5):
-    print(f"--> [I2T Worker] Starting Analysis (GLM-4.1V Thinking). PID: {os.getpid()}", flush=True)
+# Tags that switch the streamed section (they are not sent themselves)
+SECTION_TAGS = {"<think>": "think", "</think>": "answer", "<answer>": "answer", "</answer>": "answer"}
 
-    if not os.path.exists(image_path):
-        print("ERROR: Image 1 not found", flush=True)
-        sys.exit(1)
-        
-    if image_path_2 and not os.path.exists(image_path_2):
-        print("WARNING: Image 2 provided but not found. Ignoring.", flush=True)
-        image_path_2 = None
+class SectionStreamer(TextStreamer):
+    """
+    Sends the response over IPC while generate() runs, as "token" messages
+    tagged think or answer. Also records when the first new token arrives.
+    """
 
-    try:
-        gc.collect()
-        torch.cuda.empty_cache()
+    def __init__(self, tokenizer):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.section = "answer"
+        self.pending = ""  # possible start of a tag split across chunks
+        self.first_token_at = None
 
-        print(f"--> [I2T Worker] Loading Processor...", flush=True)
-        processor = AutoProcessor.from_pretrained(MODEL_ID, trust_remote_code=True)
-
-        print(f"--> [I2T Worker] Loading Model...", flush=True)
-        # Class Inspection (Robust logic maintained)
-        base_model = AutoModel.from_pretrained(MODEL_ID, trust_remote_code=True, device_map="cpu", torch_dtype=torch.bfloat16)
-        module_name = base_model.__module__
-        remote_module = sys.modules[module_name]
-        TargetClass = None
-        candidate_names = ["ChatGLMForConditionalGeneration", "Glm4vForCausalLM", "GLM4VForCausalLM", "ModelForCausalLM"]
-        for name in candidate_names:
-            if hasattr(remote_module, name): TargetClass = getattr(remote_module, name); break
-        if TargetClass is None:
-            for name, obj in vars(remote_module).items():
-                if isinstance(obj, type) and (name.endswith("ForCausalLM") or name.endswith("ForConditionalGeneration")):
-                    if obj != type(base_model): TargetClass = obj; break
-        if TargetClass is None: raise ValueError(f"Could not find a CausalLM class in {module_name}")
-        del base_model
-        torch.cuda.empty_cache()
+    def put(self, value):
+        if self.first_token_at is None and not self.next_tokens_are_prompt:
+            self.first_token_at = time.time()
+        super().put(value)
 
-        model = TargetClass.from_pretrained(
-            MODEL_ID, torch_dtype=torch.bfloat16, trust_remote_code=True,
-            low_cpu_mem_usage=True, device_map="auto"
-        ).eval()
+    def on_finalized_text(self, text, stream_end=False):
+        text = self.pending + text.replace("Ġ", " ").replace("Ċ", "\n")
+        self.pending = ""
+        while text:
+            idx = text.find("<")
+            if idx == -1:
+                self._send(text)
+                break
+            self._send(text[:idx])
+            text = text[idx:]
+            tag = next((t for t in SECTION_TAGS if text.startswith(t)), None)
+            if tag:
+                self.section = SECTION_TAGS[tag]
+                text = text[len(tag):]
+            elif not stream_end and any(t.startswith(text) for t in SECTION_TAGS):
+                self.pending = text
+                break
+            else:
+                self._send("<")
+                text = text[1:]
 
-        print("--> [I2T Worker] Processing Input...", flush=True)
-        image1 = Image.open(image_path).convert("RGB")
-        original_dims = image1.size
-        
-        # BLENDING LOGIC
-        if image_path_2:
-            print(f"--> [I2T Worker] Loading Second Image for Blending (Mix: {mix_ratio})...", flush=True)
-            image2 = Image.open(image_path_2).convert("RGB")
-            # Resize image2 to match image1 for blending
-            image2 = image2.resize(image1.size, Image.LANCZOS)
-            
-            # Blend: out = image1 * (1.0 - alpha) + image2 * alpha
-            # If mix_ratio is 0.0 -> Image 1 only
-            # If mix_ratio is 1.0 -> Image 2 only
-            final_image = Image.blend(image1, image2, alpha=float(mix_ratio))
-        else:
-            final_image = image1
+    def _send(self, text):
+        if text:
+            ipc.emit("token", section=self.section, text=text)
+
+def prepare_image(image_path, image_path_2=None, mix_ratio=0.5):
+    """Opens the source image, blended with a second one if given. Returns (image, original size)."""
+    image1 = Image.open(image_path).convert("RGB")
+    original_dims = image1.size
+    
+    # BLENDING LOGIC
+    if image_path_2:
+        print(f"--> [I2T Worker] Loading Second Image for Blending (Mix: {mix_ratio})...", flush=True)
+        image2 = Image.open(image_path_2).convert("RGB")
+        # Resize image2 to match image1 for blending
+        image2 = image2.resize(image1.size, Image.LANCZOS)
         
-        content_list = [{"type": "image", "image": final_image}]
-            
-        content_list.append({"type": "text", "text": prompt})
+        # Blend: out = image1 * (1.0 - alpha) + image2 * alpha
+        # If mix_ratio is 0.0 -> Image 1 only
+        # If mix_ratio is 1.0 -> Image 2 only
+        return Image.blend(image1, image2, alpha=float(mix_ratio)), original_dims
+    return image1, original_dims
 
-        messages = [{"role": "user", "content": content_list}]
+def build_messages(prompt, image=None, history=None):
+    """
+    Chat messages: the image goes in the first user turn, followed by earlier turns and the new prompt
+    (none if prompt is None, e.g. to template a conversation ending with an answer).
+    """
+    turns = list(history or []) + ([{"role": "user", "content": prompt}] if prompt is not None else [])
+    messages = []
+    for i, turn in enumerate(turns):
+        content = [{"type": "text", "text": turn["content"]}]
+        if i == 0:
+            content.insert(0, {"type": "image", "image": image} if image is not None else {"type": "image"})
+        messages.append({"role": turn["role"], "content": content})
+    return messages
 
-        inputs = processor.apply_chat_template(
-            messages, add_generation_prompt=True, tokenize=True,
-            return_dict=True, return_tensors="pt"
-        ).to("cuda")
+def _rope_owner(model):
+    # GLM-4.1V keeps the multimodal RoPE offset of the last prefill on its inner model
+    for module in (getattr(model, "model", None), model):
+        if module is not None and hasattr(module, "rope_deltas"):
+            return module
+    return None
 
-        print(f"--> [I2T Worker] Generating (TopK: {top_k}, Temp: {temperature})...", flush=True)
+def _template_ids(processor, info, messages, add_generation_prompt=True):
+    """Token ids of the templated messages, with the image placeholder expanded to the cached grid. Returns (ids, image tokens)."""
+    text = processor.apply_chat_template(messages, add_generation_prompt=add_generation_prompt, tokenize=False)
+    image_token = processor.image_token
+    num_tokens = int(info["grid_thw"].prod()) // processor.image_processor.merge_size ** 2
+    text = text.replace(image_token, image_token * num_tokens, 1)
+    return processor.tokenizer(text, add_special_tokens=False, return_tensors="pt").input_ids[0], num_tokens
 
-        # Cast top_k to int because generation expects integer
-        k_val = int(top_k)
-        
-        gen_kwargs = {
-            "max_new_tokens": 4096,
-            "do_sample": True if temperature > 0 else False, 
-            "top_k": k_val, 
-            "temperature": temperature
-        }
+def _answer_turn_kv(model, processor, info, messages, sequence, past_key_values):
+    """
+    KV cache of a chat conversation ending with the answer-only assistant turn, tokenized the way the
+    next turn's prompt will be: the generated KV is cut where it stops matching (the thinking section)
+    and the rest of the templated turn is prefilled on top. Returns (ids, past_key_values).
+    """
+    ids, _ = _template_ids(processor, info, messages, add_generation_prompt=False)
+    length = min(common_prefix(sequence.detach().to("cpu"), ids), past_key_values.get_seq_length(), len(ids) - 1)
+    past_key_values.crop(length)
+    rest = ids[length:][None].to(model.device)
+    with torch.no_grad():
+        # Decode-style positions: the model offsets cache_position by the rope_deltas of the prefill
+        model(input_ids=rest, attention_mask=torch.ones(1, len(ids), dtype=torch.long, device=model.device),
+              past_key_values=past_key_values, cache_position=torch.arange(length, len(ids), device=model.device),
+              use_cache=True)
+    return ids, past_key_values
+
+def _cached_inputs(processor, prefix_cache, key, messages, device):
+    """
+    Prompt tokens rebuilt from the template text and the cached image grid (no image decode, no vision
+    tower), with the longest cached KV prefix. Returns (inputs, entry, prefix length, original size) or None.
+    """
+    info = prefix_cache.image_info(key)
+    if info is None:
+        return None
+    ids, num_tokens = _template_ids(processor, info, messages)
+
+    # The prefix must cover every image token, since pixel values are not passed again
+    image_token_id = processor.tokenizer.convert_tokens_to_ids(processor.image_token)
+    positions = (ids == image_token_id).nonzero()
+    if len(positions) != num_tokens:
+        return None
+    entry, length = prefix_cache.match(key, ids, min_length=int(positions[-1]) + 1)
+    if entry is None:
+        return None
+    length = min(length, len(ids) - 1)  # at least one token left to prefill
+    inputs = {"input_ids": ids[None].to(device), "attention_mask": torch.ones_like(ids)[None].to(device)}
+    return inputs, entry, length, info["original_dims"]
+
+def analyze_i2t(model, processor, image_path, prompt, top_k, temperature, image_path_2=None, strength=0.75,
+                mix_ratio=0.5, history=None, prefix_cache=None, session_id=None, start=None):
+    """
+    Answers prompt about the image (after the earlier turns of history) on a loaded model. Streams tokens,
+    saves the V2 log and sends the "result" message. Raises on failure.
+    Returns {"text", "thinking", "answer", "tokens", "ttft"}.
+    """
+    if not os.path.exists(image_path):
+        raise FileNotFoundError("Image 1 not found")
+    if image_path_2 and not os.path.exists(image_path_2):
+        print("WARNING: Image 2 provided but not found. Ignoring.", flush=True)
+        image_path_2 = None
+
+    timer = shared_utils.stage_timer
+    start = start or time.time()
+
+    print("--> [I2T Worker] Processing Input...", flush=True)
+    with timer.stage("preprocess"):
+        key = None
+        cached = None
+        device = shared_utils.execution_device(model)
+        if prefix_cache is not None:
+            key = image_key(image_path, image_path_2, mix_ratio)
+            cached = _cached_inputs(processor, prefix_cache, key, build_messages(prompt, history=history), device)
+        if cached is not None:
+            inputs, entry, prefix_length, original_dims = cached
+            past_key_values = prefix_cache.fork(entry, prefix_length)
+            owner = _rope_owner(model)
+            if owner is not None and entry.rope_deltas is not None:
+                owner.rope_deltas = entry.rope_deltas.clone()
+            print(f"--> [I2T Worker] Prefix cache hit: {prefix_length}/{inputs['input_ids'].shape[1]} tokens reused", flush=True)
+        else:
+            final_image, original_dims = prepare_image(image_path, image_path_2, mix_ratio)
+            inputs = processor.apply_chat_template(
+                build_messages(prompt, image=final_image, history=history), add_generation_prompt=True,
+                tokenize=True, return_dict=True, return_tensors="pt"
+            ).to(device)
+            past_key_values = None
+            prefix_length = 0
 
+    print(f"--> [I2T Worker] Generating (TopK: {top_k}, Temp: {temperature})...", flush=True)
+
+    # Cast top_k to int because generation expects integer
+    k_val = int(top_k)
+    
+    gen_kwargs = {
+        "max_new_tokens": 4096,
+        "do_sample": True if temperature > 0 else False, 
+        "top_k": k_val, 
+        "temperature": temperature
+    }
+
+    streamer = SectionStreamer(processor.tokenizer)
+    with timer.stage("generate", sync=True):
         with torch.no_grad():
-            outputs = model.generate(**inputs, **gen_kwargs)
+            generated = model.generate(**inputs, **gen_kwargs, streamer=streamer, past_key_values=past_key_values,
+                                       return_dict_in_generate=True)
 
-        outputs = outputs[:, inputs.input_ids.shape[1]:]
+    with timer.stage("decode"):
+        prompt_length = inputs["input_ids"].shape[1]
+        outputs = generated.sequences[:, prompt_length:]
         raw_response = processor.decode(outputs[0], skip_special_tokens=True)
         final_response = clean_output_text(raw_response)
 
-        # Custom logic to reconstruct what save_json_log did
-        
-        # 1. Parsing Thinking vs Answer
-        thought = ""
-        answer = final_response
-        think_match = re.search(r'<think>(.*?)</think>', final_response, re.DOTALL)
-        if think_match:
-            thought = think_match.group(1).strip()
-            answer = final_response.replace(think_match.group(0), "").strip()
-
-        answer = answer.replace("<answer>", "").replace("</answer>", "").strip()
+    # 1. Parsing Thinking vs Answer
+    thought, answer = split_thinking(final_response)
+
+    if prefix_cache is not None:
+        # Keep the KV of prompt + answer: follow-up questions continue from it
+        if cached is None and "image_grid_thw" in inputs:
+            prefix_cache.remember_image(key, inputs["image_grid_thw"][0], original_dims)
+        owner = _rope_owner(model)
+        rope_deltas = owner.rope_deltas.clone() if owner is not None and owner.rope_deltas is not None else None
+        past = generated.past_key_values
+        ids = generated.sequences[0, :past.get_seq_length()]
+        info = prefix_cache.image_info(key)
+        if session_id and info is not None:
+            # The session history keeps only the answer, so the next turn's prompt diverges from the
+            # generated tokens at the thinking section: cache the turn as it will be templated instead
+            turns = list(history or []) + [{"role": "user", "content": prompt}, {"role": "assistant", "content": answer}]
+            try:
+                with timer.stage("generate", sync=True):
+                    ids, past = _answer_turn_kv(model, processor, info, build_messages(None, history=turns),
+                                                generated.sequences[0], past)
+            except Exception as e:
+                # The generated KV was cut in place: nothing consistent is left to keep
+                print(f"--> [I2T Worker] Warning: could not cache the answer turn: {e}", flush=True)
+                past = None
+        if past is not None:
+            prefix_cache.store(key, ids, past, rope_deltas)
+
+    # Custom logic to reconstruct what save_json_log did
+    
+    # 2. Ancestor Params Merging (Maintain compatibility with old/new schemas if possible)
+    ancestor_params = {}
+    try:
+        base_path = os.path.splitext(image_path)[0]
+        potential_json = base_path + ".json"
+        if os.path.exists(potential_json):
+            with open(potential_json, 'r') as f:
+                ancestor_data = json.load(f)
+                # Support v1 and v2
+                ancestor_params = ancestor_data.get("parameters", {})
+    except Exception as e:
+        print(f"[I2T Worker] Could not load ancestor params: {e}")
+
+    # Params
+    final_params = ancestor_params.copy()
+    final_params.update(gen_kwargs)
+    final_params["strength"] = strength
+    final_params["mix_ratio"] = mix_ratio
+    final_params["original_width"] = original_dims[0]
+    final_params["original_height"] = original_dims[1]
+
+    # Inputs
+    inputs_data = {
+        "prompt": prompt,
+        "source_images": [os.path.basename(image_path)]
+    }
+    if image_path_2:
+        inputs_data["source_images"].append(os.path.basename(image_path_2))
+    if history:
+        inputs_data["history"] = history
         
-        # 2. Ancestor Params Merging (Maintain compatibility with old/new schemas if possible)
-        ancestor_params = {}
-        try:
-            base_path = os.path.splitext(image_path)[0]
-            potential_json = base_path + ".json"
-            if os.path.exists(potential_json):
-                with open(potential_json, 'r') as f:
-                    ancestor_data = json.load(f)
-                    # Support v1 and v2
-                    ancestor_params = ancestor_data.get("parameters", {})
-        except Exception as e:
-            print(f"[I2T Worker] Could not load ancestor params: {e}")
-
-        # Params
-        final_params = ancestor_params.copy()
-        final_params.update(gen_kwargs)
-        final_params["strength"] = strength
-        final_params["mix_ratio"] = mix_ratio
-        final_params["original_width"] = original_dims[0]
-        final_params["original_height"] = original_dims[1]
-
-        # Inputs
-        inputs_data = {
-            "prompt": prompt,
-            "source_images": [os.path.basename(image_path)]
+    # Outputs
+    outputs_data = {
+        "type": "text",
+        "text_content": {
+            "thinking_process": thought,
+            "final_answer": answer,
+            "raw_full_response": final_response
         }
-        if image_path_2:
-            inputs_data["source_images"].append(os.path.basename(image_path_2))
-            
-        # Outputs
-        outputs_data = {
-            "type": "text",
-            "text_content": {
-                "thinking_process": thought,
-                "final_answer": answer,
-                "raw_full_response": final_response
-            }
-        }
-        
-        # Filename construction handled by shared_utils if we pass a target name
-        # We want i2t_...json
-        base_name = os.path.basename(image_path)
-        safe_name = base_name.replace(" ", "_")
-        timestamp_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        target_json_name = f"i2t_{safe_name}_{timestamp_str}.json"
-        
-        shared_utils.save_generation_log("i2t", inputs_data, final_params, outputs_data, image_path_for_filename=target_json_name)
- 
-        print(f"TEXT_OUTPUT_START")
-        print(final_response)
-        print(f"TEXT_OUTPUT_END")
+    }
+    
+    # Filename construction handled by shared_utils if we pass a target name
+    # We want i2t_...json
+    base_name = os.path.basename(image_path)
+    safe_name = base_name.replace(" ", "_")
+    timestamp_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    target_json_name = f"i2t_{safe_name}_{timestamp_str}.json"
+    n = 2
+    while os.path.exists(os.path.join(shared_utils.OUTPUT_DIR, target_json_name)):
+        # Cached follow-ups can finish within the same second
+        target_json_name = f"i2t_{safe_name}_{timestamp_str}_{n}.json"
+        n += 1
+    
+    ttft = round(streamer.first_token_at - start, 3) if streamer.first_token_at else None
+    extra_meta = {"ttft": ttft}
+    if prefix_cache is not None:
+        extra_meta["prefix_cache"] = {"reused_tokens": prefix_length, "prompt_tokens": int(prompt_length)}
+    if session_id:
+        extra_meta["session_id"] = session_id
+    with timer.stage("save"):
+        shared_utils.save_generation_log("i2t", inputs_data, final_params, outputs_data, image_path_for_filename=target_json_name,
+                                         extra_meta=extra_meta)
+
+    ipc.emit("result", kind="text", text=final_response, thinking=thought, answer=answer)
+    return {"text": final_response, "thinking": thought, "answer": answer,
+            "tokens": int(outputs.shape[1]), "ttft": ttft}
+
+def run_i2t(image_path, image_path_2, prompt, top_k, temperature, strength=0.75, mix_ratio=0.5):
+    print(f"--> [I2T Worker] Starting Analysis (GLM-4.1V Thinking). PID: {os.getpid()}", flush=True)
+
+    if not os.path.exists(image_path):
+        print("ERROR: Image 1 not found", flush=True)
+        ipc.emit("error", message="Image 1 not found")
+        sys.exit(1)
+
+    timer = shared_utils.stage_timer
+    start = time.time()
+
+    try:
+        gc.collect()
+        torch.cuda.empty_cache()
+
+        with timer.stage("load"):
+            print(f"--> [I2T Worker] Loading Processor...", flush=True)
+            processor = AutoProcessor.from_pretrained(MODEL_ID, trust_remote_code=True)
+
+            # Class resolved from the config (cached), weights loaded once
+            model = shared_utils.load_i2t_model(MODEL_ID)
+
+        result = analyze_i2t(model, processor, image_path, prompt, top_k, temperature, image_path_2=image_path_2,
+                             strength=strength, mix_ratio=mix_ratio, start=start)
+        ipc.emit("metrics", elapsed=round(time.time() - start, 2), tokens=result["tokens"], ttft=result["ttft"],
+                 timings=timer.snapshot())
 
         print("--> [I2T Worker] Analysis Completed.", flush=True)
 
@@ -179,6 +358,7 @@ def run_i2t(image_path, image_path_2, prompt, top_k, temperature, strength=0.75,
         import traceback
         traceback.print_exc()
         print(f"ERROR: {str(e)}", flush=True)
+        ipc.emit("error", message=f"{type(e).__name__}: {e}")
         sys.exit(1)
 
 if __name__ == "__main__":
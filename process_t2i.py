@@ -8,6 +8,10 @@ import traceback
 import gc
 import datetime
 import shared_utils
+import prior_cache
+import output_writer
+import latent_preview
+import memory_planner
 from diffusers import DiffusionPipeline
 
 MODEL_ID = "zai-org/GLM-Image"
@@ -17,6 +21,83 @@ shared_utils.setup_logging()
 
 
 
+def generate_t2i(pipe, prompt, width, height, steps, guidance, seed, loras=None, top_k=1, temperature=0.6,
+                 batch_size=1, seeds=None, fingerprint=None, output_format=None, output_quality=None,
+                 preview_every=None):
+    """
+    Runs a T2I generation on an already loaded pipeline. Raises on failure.
+    batch_size images (or one per explicit seed) are generated in batched pipeline calls;
+    each one is saved with its own V2 log. Returns the list of saved paths.
+    fingerprint: request hash from result_cache, stored in each log's meta.
+    output_format / output_quality: archival encoding (see output_writer), server defaults if None.
+    preview_every: steps between latent previews (see latent_preview), 0 disables them.
+    """
+    seed_list = shared_utils.resolve_seeds(seed, batch_size, seeds)
+    policy = output_writer.resolve_policy(output_format, output_quality)
+    prior_cache.configure(top_k, temperature, loras)
+
+    print(f"--> [T2I Worker] Generating {len(seed_list)} image(s) (TopK: {top_k}, Temp: {temperature})...", flush=True)
+    # Pass extra params ONLY IF supported by the pipeline's __call__ method
+    # Standard Diffusion Pipelines usually do not support top_k/temperature, but we check to be safe/future-proof.
+    import inspect
+    sig_params = inspect.signature(pipe.__call__).parameters
+    
+    extra_kwargs = {}
+    if "top_k" in sig_params and top_k is not None: 
+        extra_kwargs["top_k"] = int(top_k)
+    if "temperature" in sig_params and temperature is not None: 
+        extra_kwargs["temperature"] = float(temperature)
+
+    step_callback = None
+    if "callback_on_step_end" in sig_params:
+        step_callback = latent_preview.make_callback(MODEL_ID, steps, preview_every,
+                                                     progress=shared_utils.make_progress_callback(steps))
+        extra_kwargs["callback_on_step_end"] = step_callback
+        if "callback_on_step_end_tensor_inputs" in sig_params:
+            extra_kwargs["callback_on_step_end_tensor_inputs"] = ["latents"]
+
+    def run_chunk(chunk_seeds):
+        # One generator per image for the diffusion noise (the pipeline uses the first one for the AR prior)
+        prior_cache.reset_status()
+        plan = memory_planner.prepare(width, height, len(chunk_seeds), guidance, loras)
+        device = shared_utils.execution_device(pipe)
+        generators = [torch.Generator(device=device).manual_seed(s) for s in chunk_seeds]
+        with shared_utils.stage_timer.stage("denoise", sync=True):
+            images = pipe(
+                prompt=prompt, width=width, height=height,
+                num_inference_steps=steps, guidance_scale=guidance,
+                num_images_per_prompt=len(chunk_seeds), generator=generators,
+                **extra_kwargs
+            ).images
+        memory_planner.observe(plan)
+        latent_preview.calibrate(MODEL_ID, images[0])  # first run of a model only
+        return images
+
+    inputs_data = {
+        "prompt": prompt,
+        "loras": loras or []
+    }
+    params_data = {
+        "width": width, "height": height, "steps": steps,
+        "guidance": guidance, "seed": seed,
+        "top_k": top_k, "temperature": temperature
+    }
+
+    saved = []
+    for chunk_seeds, images in shared_utils.generate_in_chunks(run_chunk, seed_list, prefix="T2I Worker"):
+        # How the images were produced goes to the log meta, not to the user parameters
+        meta = {"prior_cache": prior_cache.last_status(), "memory": memory_planner.last_plan(),
+                "fingerprint": fingerprint}
+        saved += output_writer.save_images("t2i", chunk_seeds, images, inputs_data, params_data, policy,
+                                           meta, "T2I Worker")
+
+    with shared_utils.stage_timer.stage("save"):
+        output_writer.writer.drain()  # files and thumbnails all written before the job ends
+    output_writer.write_logs(shared_utils.stage_timer.snapshot())
+    latent_preview.report(step_callback, "T2I Worker")
+    print("--> [T2I Worker] Task Completed.", flush=True)
+    return saved
+
 def run_t2i(prompt, width, height, steps, guidance, seed, lora_config=None, top_k=1, temperature=0.6):
     print(f"--> [T2I Worker] Starting process PID: {os.getpid()}", flush=True)
 
@@ -25,72 +106,18 @@ def run_t2i(prompt, width, height, steps, guidance, seed, lora_config=None, top_
         torch.cuda.empty_cache()
 
         print("--> [T2I Worker] Loading Pipeline...", flush=True)
-        pipe = DiffusionPipeline.from_pretrained(MODEL_ID, torch_dtype=torch.bfloat16, trust_remote_code=True)
-
-        shared_utils.load_loras(pipe, lora_config)
-
-        print("--> [T2I Worker] Enabling CPU Offload & Tiling...", flush=True)
-        pipe.enable_model_cpu_offload()
-        try: pipe.enable_vae_tiling()
-        except: pass
-        try: pipe.enable_attention_slicing("max")
-        except: pass
-
-        generator = torch.Generator(device="cuda").manual_seed(seed)
-
-        print(f"--> [T2I Worker] Generating (TopK: {top_k}, Temp: {temperature})...", flush=True)
-        # Pass extra params ONLY IF supported by the pipeline's __call__ method
-        # Standard Diffusion Pipelines usually do not support top_k/temperature, but we check to be safe/future-proof.
-        import inspect
-        sig_params = inspect.signature(pipe.__call__).parameters
-        
-        extra_kwargs = {}
-        if "top_k" in sig_params and top_k is not None: 
-            extra_kwargs["top_k"] = int(top_k)
-        if "temperature" in sig_params and temperature is not None: 
-            extra_kwargs["temperature"] = float(temperature)
-
-        image = pipe(
-            prompt=prompt, width=width, height=height,
-            num_inference_steps=steps, guidance_scale=guidance,
-            generator=generator,
-            **extra_kwargs
-        ).images[0]
-
-        out_filename = f"t2i_{int(time.time())}.png"
-        save_path = os.path.join("/app/outputs", out_filename)
-        os.makedirs("/app/outputs", exist_ok=True)
-        image.save(save_path)
-        print(f"SUCCESS_OUTPUT:{save_path}", flush=True)
-
-    # SAVE JSON (V2)
-        
-        # Inputs
-        inputs_data = {
-            "prompt": prompt,
-            "loras": []
-        }
-        if lora_config and os.path.exists(lora_config):
-            try:
-                with open(lora_config, 'r') as f: inputs_data["loras"] = json.load(f)
-            except: pass
-
-        # Params
-        params_data = {
-            "width": width, "height": height, "steps": steps, 
-            "guidance": guidance, "seed": seed, 
-            "top_k": top_k, "temperature": temperature
-        }
-
-        # Outputs
-        outputs_data = {
-            "type": "image",
-            "files": [os.path.basename(save_path)]
-        }
-
-        shared_utils.save_generation_log("t2i", inputs_data, params_data, outputs_data, image_path_for_filename=save_path)
-
-        print("--> [T2I Worker] Task Completed.", flush=True)
+        with shared_utils.stage_timer.stage("load"):
+            pipe = DiffusionPipeline.from_pretrained(MODEL_ID, torch_dtype=torch.bfloat16, trust_remote_code=True)
+
+        with shared_utils.stage_timer.stage("lora"):
+            shared_utils.load_loras(pipe, lora_config)
+        with shared_utils.stage_timer.stage("load"):
+            memory_planner.install(pipe, MODEL_ID, prefix="T2I Worker")
+        shared_utils.instrument_pipeline(pipe)
+        prior_cache.install(pipe, MODEL_ID)
+
+        generate_t2i(pipe, prompt, width, height, steps, guidance, seed,
+                     shared_utils.read_lora_config(lora_config), top_k, temperature)
 
     except Exception as e:
         print(f"CRITICAL ERROR IN T2I WORKER:", flush=True)
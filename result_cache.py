@@ -0,0 +1,61 @@
+import os
+import json
+import hashlib
+import history_index
+import storage
+
+# Content-addressed cache of finished T2I / I2I results.
+# A request fingerprint (generation fields + content hashes of the LoRA and
+# source image files + model revision) is stored in the meta of every V2 log
+# and indexed by history_index. An identical request is answered from the
+# existing outputs; deleting any of them (or changing a referenced file)
+# makes the fingerprint miss again.
+
+# Bump when the fields below change meaning
+FINGERPRINT_VERSION = 1
+IMAGE_MODEL_ID = "zai-org/GLM-Image"  # mirrors process_t2i.MODEL_ID (no torch import here)
+HF_HUB_DIR = os.path.join(os.environ.get("HF_HOME", os.path.expanduser("~/.cache/huggingface")), "hub")
+
+FIELDS = ("prompt", "width", "height", "steps", "guidance", "seed", "batch_size", "seeds",
+          "top_k", "temperature", "strength", "mix_ratio", "output_format", "output_quality")
+
+def model_revision(model_id=IMAGE_MODEL_ID):
+    """Commit hash of the locally cached model (GLM_MODEL_REVISION overrides), 'unknown' if not downloaded yet."""
+    if os.environ.get("GLM_MODEL_REVISION"):
+        return os.environ["GLM_MODEL_REVISION"]
+    ref = os.path.join(HF_HUB_DIR, "models--" + model_id.replace("/", "--"), "refs", "main")
+    try:
+        with open(ref) as f:
+            return f.read().strip()
+    except OSError:
+        return "unknown"
+
+def fingerprint(mode, args):
+    """Deterministic SHA-256 of everything that determines the images of a generation request."""
+    data = {
+        "v": FINGERPRINT_VERSION,
+        "mode": mode,
+        "model": IMAGE_MODEL_ID,
+        "revision": model_revision(),
+        "args": {k: args.get(k) for k in FIELDS if args.get(k) is not None},
+        "loras": [[storage.file_digest(path), float(strength), bool(active)]
+                  for path, strength, active in args.get("loras") or [] if os.path.exists(path)],
+        "images": [storage.file_digest(args[k]) for k in ("image_path", "image_path_2") if args.get(k)]
+    }
+    if mode == "t2i":
+        for k in ("strength", "mix_ratio"):
+            data["args"].pop(k, None)
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+def expected_images(args):
+    return len(args["seeds"]) if args.get("seeds") else int(args.get("batch_size") or 1)
+
+def lookup(fp, count, output_dir=history_index.OUTPUT_DIR, db_path=None):
+    """Output file names of a previous identical request, or None unless all count images still exist."""
+    found = history_index.find_by_fingerprint(fp, db_path=db_path or history_index.DB_PATH)
+    if len(found) < count:
+        return None
+    names = [filename for _, filename in found[-count:]]
+    if not all(name and os.path.exists(os.path.join(output_dir, name)) for name in names):
+        return None
+    return names
@@ -22,6 +22,8 @@ echo "   Server running on: http://localhost:7860"
 echo "   LoRA Directory: $LORA_DIR"
 echo "=================================================="
 
+# All GPUs are visible: the server starts one pinned worker per device.
+# Set GLM_DEVICES (e.g. GLM_DEVICES=0,2) to choose which ones to use.
 # Added PYTORCH_HIP_ALLOC_CONF for ROCm stability
 docker run --rm -it \
   --name glm_runner \
@@ -30,7 +32,7 @@ docker run --rm -it \
   --privileged \
   --device=/dev/kfd --device=/dev/dri \
   --group-add=video $RENDER_ARG \
-  -e HIP_VISIBLE_DEVICES=0 \
+  -e GLM_DEVICES \
   -e HSA_OVERRIDE_GFX_VERSION=11.0.0 \
   -e PYTORCH_HIP_ALLOC_CONF=expandable_segments:True \
   -v "$HF_CACHE_DIR":/root/.cache/huggingface \
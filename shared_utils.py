@@ -1,13 +1,78 @@
 import os
+import sys
+import gc
 import json
+import time
 import logging
+import functools
+from contextlib import contextmanager
+from collections import OrderedDict
+import torch
 import diffusers
+import history_index
+import ipc
 
 
 # Common Paths
 OUTPUT_DIR = "/app/outputs"
 LORA_DIR = "/app/loras"
 
+# Resolved I2T model classes, per model revision (see resolve_i2t_model_class)
+I2T_CLASS_CACHE = os.environ.get("GLM_I2T_CLASS_CACHE", "/app/cache/i2t_model_class.json")
+I2T_CANDIDATE_CLASSES = ["ChatGLMForConditionalGeneration", "Glm4vForConditionalGeneration",
+                         "Glm4vForCausalLM", "GLM4VForCausalLM", "ModelForCausalLM"]
+
+# Most images sent to the pipeline in one call (halved automatically on OOM)
+MAX_BATCH = int(os.environ.get("GLM_MAX_BATCH", "4"))
+
+class StageTimer:
+    """
+    Wall time per named stage of the current job (load, lora, ar_prior, denoise, vae_decode, save...).
+    Stages may nest; time spent in an inner stage is not counted again in the outer one,
+    so the totals add up to the instrumented wall time.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.totals = OrderedDict()
+        self._stack = []
+
+    @contextmanager
+    def stage(self, name, sync=False):
+        """sync=True waits for queued CUDA work, so asynchronous kernels are charged to this stage."""
+        start = time.perf_counter()
+        self._stack.append(0.0)
+        try:
+            yield
+        finally:
+            if sync and torch.cuda.is_available():
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start
+            inner = self._stack.pop()
+            self.totals[name] = self.totals.get(name, 0.0) + elapsed - inner
+            if self._stack:
+                self._stack[-1] += elapsed
+
+    def add(self, name, seconds):
+        """Charges a span measured by the caller (checkpoint style, no nesting)."""
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    def wrap(self, fn, name, sync=False):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            with self.stage(name, sync=sync):
+                return fn(*args, **kwargs)
+        return timed
+
+    def snapshot(self):
+        # list(): the background output writer may add to totals concurrently
+        return {name: round(seconds, 3) for name, seconds in list(self.totals.items())}
+
+# Timings of the job running in this process (written to the V2 meta and sent as IPC metrics)
+stage_timer = StageTimer()
+
 def setup_logging():
     """Configures logging to suppress verbose library warnings."""
     logging.getLogger("transformers").setLevel(logging.ERROR)
@@ -24,7 +89,145 @@ def save_json(full_path, data, prefix="System"):
     except Exception as e:
         print(f"--> [{prefix} Warning] Failed to save JSON: {e}", flush=True)
 
-def save_generation_log(mode, inputs, params, outputs, image_path_for_filename=None):
+CLAIM_SUFFIX = ".part"
+
+def unique_output_path(mode, ext=".png", base=None):
+    """
+    /app/outputs/<mode>_<unix time><ext> (or <base><ext>), suffixed _2, _3... if the name is taken.
+    The name is claimed by creating <path>.part exclusively (holding our PID), so workers on other devices
+    never get the same one; release_output_path() drops the claim once the file is written.
+    """
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    base = base or f"{mode}_{int(time.time())}"
+    n = 1
+    while True:
+        path = os.path.join(OUTPUT_DIR, (base if n == 1 else f"{base}_{n}") + ext)
+        n += 1
+        if os.path.exists(path) or os.path.exists(os.path.splitext(path)[0] + ".json"):
+            continue
+        try:
+            fd = os.open(path + CLAIM_SUFFIX, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            continue
+        with os.fdopen(fd, "w") as f:
+            f.write(str(os.getpid()))
+        if os.path.exists(path):  # written between the check and the claim
+            os.remove(path + CLAIM_SUFFIX)
+            continue
+        return path
+
+def release_output_path(path):
+    """Drops the claim of unique_output_path() (the file is written, or will not be)."""
+    try:
+        os.remove(path + CLAIM_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+def remove_stale_claims(output_dir=OUTPUT_DIR):
+    """
+    Deletes the name claims (and half-written .tmp files) left by workers that were killed,
+    e.g. on cancel. Claims of processes still running are kept. Returns how many were removed.
+    """
+    removed = 0
+    try:
+        entries = [e for e in os.scandir(output_dir) if e.name.endswith(CLAIM_SUFFIX)]
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            with open(entry.path) as f:
+                pid = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            pid = 0
+        if pid:
+            try:
+                os.kill(pid, 0)
+                continue  # still running
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                continue
+        path = entry.path[:-len(CLAIM_SUFFIX)]
+        for leftover in (path + ".tmp", entry.path):
+            try:
+                os.remove(leftover)
+            except FileNotFoundError:
+                pass
+        removed += 1
+    return removed
+
+def resolve_seeds(seed, batch_size=1, seeds=None):
+    """Explicit seeds win; otherwise batch_size consecutive seeds starting at seed."""
+    if seeds:
+        return [int(s) for s in seeds]
+    return [(int(seed) + i) % 2**32 for i in range(max(1, int(batch_size or 1)))]
+
+def is_oom_error(e):
+    return isinstance(e, torch.cuda.OutOfMemoryError) or "out of memory" in str(e).lower()
+
+def generate_in_chunks(run_chunk, seeds, prefix="Worker", max_batch=None):
+    """
+    Runs run_chunk(chunk_seeds) -> [PIL images] over seeds in as few pipeline calls as fit in memory.
+    Starts with chunks of max_batch (default MAX_BATCH) and halves them on OOM.
+    Yields (chunk_seeds, images) as soon as each chunk is done.
+    """
+    chunk = max(1, min(len(seeds), max_batch or MAX_BATCH))
+    i = 0
+    while i < len(seeds):
+        part = seeds[i:i + chunk]
+        try:
+            images = run_chunk(part)
+        except Exception as e:
+            if not is_oom_error(e) or chunk == 1:
+                raise
+            gc.collect()
+            torch.cuda.empty_cache()
+            chunk = max(1, chunk // 2)
+            print(f"--> [{prefix}] ⚠️ Out of memory with {len(part)} images, retrying in chunks of {chunk}", flush=True)
+            continue
+        yield part, images
+        i += len(part)
+
+def denoising_steps(pipe, total_steps):
+    """
+    Steps of the running pipeline call: pipe.num_timesteps once the pipeline has set it
+    (img2img only runs about steps * strength of them), else total_steps.
+    """
+    try:
+        count = int(getattr(pipe, "num_timesteps", 0) or 0)
+    except (TypeError, ValueError):
+        count = 0
+    return count if count > 0 else total_steps
+
+def make_progress_callback(total_steps, label=None):
+    """
+    callback_on_step_end that emits a "progress" IPC message {step, total, it_s, eta} after each denoising step.
+    The rate is measured from the first step, so the AR stage before it does not skew the ETA.
+    total_steps is only the fallback when the pipeline does not report its timestep count.
+    """
+    state = {"first": None}
+
+    def callback(pipe, step_index, timestep, callback_kwargs):
+        now = time.time()
+        step = step_index + 1
+        total = denoising_steps(pipe, total_steps)
+        if state["first"] is None or step <= state["first"][0]:
+            state["first"] = (step, now)  # first step of this pipeline call
+        first_step, first_time = state["first"]
+        rate = (step - first_step) / (now - first_time) if now > first_time else 0.0
+        info = {
+            "step": step, "total": total,
+            "it_s": round(rate, 2),
+            "eta": round((total - step) / rate, 1) if rate > 0 else None
+        }
+        if label:
+            info["label"] = label
+        ipc.emit("progress", **info)
+        return callback_kwargs
+
+    return callback
+
+def save_generation_log(mode, inputs, params, outputs, image_path_for_filename=None, extra_meta=None, timings=None):
     """
     Unified V2 JSON Saver.
     mode: 't2i' | 'i2i' | 'i2t'
@@ -32,6 +235,8 @@ def save_generation_log(mode, inputs, params, outputs, image_path_for_filename=N
     params: dict { 'width', 'height', ... }
     outputs: dict { 'type', 'files': [], 'text_content': {} }
     image_path_for_filename: usage for determinig filename (optional)
+    extra_meta: dict merged into 'meta' (e.g. the request fingerprint)
+    timings: stage timings of the job (default: stage_timer.snapshot(), call from the worker thread)
     """
     import datetime
     import uuid
@@ -40,7 +245,7 @@ def save_generation_log(mode, inputs, params, outputs, image_path_for_filename=N
     if image_path_for_filename:
         base_name = os.path.basename(image_path_for_filename)
         # If it's an image, swap ext. If it's already a target json name, keep it.
-        if base_name.lower().endswith(('.png', '.jpg', '.jpeg')):
+        if base_name.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
              json_filename = os.path.splitext(base_name)[0] + ".json"
         else:
              json_filename = base_name if base_name.endswith(".json") else base_name + ".json"
@@ -64,19 +269,181 @@ def save_generation_log(mode, inputs, params, outputs, image_path_for_filename=N
         "outputs": outputs
     }
 
+    if extra_meta:
+        data["meta"].update(extra_meta)
+    if timings is None:
+        timings = stage_timer.snapshot()
+    if timings:
+        data["meta"]["timings"] = timings  # seconds per stage of the job
+
     save_json(full_path, data, prefix=f"{mode.upper()} Worker")
 
+    # Keep the history index in sync (failures here must never break a generation)
+    try:
+        history_index.index_file(full_path)
+    except Exception as e:
+        print(f"--> [{mode.upper()} Worker Warning] History index update failed: {e}", flush=True)
+
+def load_image_pipeline(model_id, prefix="Worker"):
+    """Loads the GLM-Image pipeline in bfloat16."""
+    import torch
+    from diffusers import DiffusionPipeline
+
+    print(f"--> [{prefix}] Loading Pipeline...", flush=True)
+    return DiffusionPipeline.from_pretrained(model_id, torch_dtype=torch.bfloat16, trust_remote_code=True)
+
+def instrument_pipeline(pipe):
+    """
+    Charges the internal stages of a loaded pipeline to stage_timer: AR prior tokens,
+    prompt encoding, VAE encode/decode and the CPU-offload transfers done by the
+    accelerate hooks. Whatever remains of a pipeline call is the denoising loop.
+    Call after memory_planner.install() so the offload hooks exist.
+    """
+    for method, name in (("generate_prior_tokens", "ar_prior"), ("encode_prompt", "text_encode")):
+        if hasattr(pipe, method):
+            setattr(pipe, method, stage_timer.wrap(getattr(pipe, method), name, sync=True))
+    vae = getattr(pipe, "vae", None)
+    if vae is not None:
+        vae.decode = stage_timer.wrap(vae.decode, "vae_decode", sync=True)
+        vae.encode = stage_timer.wrap(vae.encode, "vae_encode", sync=True)
+
+    def wrap_offload_hooks():
+        for component in getattr(pipe, "components", {}).values():
+            hook = getattr(component, "_hf_hook", None)
+            if hook is not None and hasattr(hook, "pre_forward") and not hasattr(hook.pre_forward, "__wrapped__"):
+                hook.pre_forward = stage_timer.wrap(hook.pre_forward, "offload", sync=True)
+
+    # The pipeline re-creates its offload hooks at the end of every call (maybe_free_model_hooks)
+    if hasattr(pipe, "enable_model_cpu_offload"):
+        reenable = stage_timer.wrap(pipe.enable_model_cpu_offload, "offload", sync=True)
+
+        @functools.wraps(reenable)
+        def enable_model_cpu_offload(*args, **kwargs):
+            result = reenable(*args, **kwargs)
+            wrap_offload_hooks()
+            return result
+        pipe.enable_model_cpu_offload = enable_model_cpu_offload
+    wrap_offload_hooks()
+
+def _find_generation_class(module, exclude=None):
+    for name in I2T_CANDIDATE_CLASSES:
+        if hasattr(module, name):
+            return getattr(module, name)
+    for name, obj in vars(module).items():
+        if isinstance(obj, type) and name.endswith(("ForCausalLM", "ForConditionalGeneration")) and obj is not exclude:
+            return obj
+    return None
+
+def resolve_i2t_model_class(model_id, cache_path=I2T_CLASS_CACHE):
+    """
+    Generation class of a vision-language model, found from its config and remote-code module
+    without loading any weights. The result is cached per model revision.
+    Returns (class, config).
+    """
+    import transformers
+    from transformers import AutoConfig
+    from transformers.dynamic_module_utils import get_class_from_dynamic_module
+
+    config = AutoConfig.from_pretrained(model_id, trust_remote_code=True)
+    revision = getattr(config, "_commit_hash", None) or "unknown"
+
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    entry = cache.get(model_id)
+    if entry and entry.get("revision") == revision:
+        try:
+            if entry["source"] == "native":
+                return getattr(transformers, entry["reference"]), config
+            return get_class_from_dynamic_module(entry["reference"], model_id), config
+        except Exception as e:
+            print(f"--> [I2T Worker] Cached model class unusable ({e}), resolving again", flush=True)
+
+    target, source, reference = None, None, None
+    # Classes built into transformers (GLM-4.1V: Glm4vForConditionalGeneration)
+    for name in getattr(config, "architectures", None) or []:
+        if hasattr(transformers, name):
+            target, source, reference = getattr(transformers, name), "native", name
+            break
+    # Remote code: a generation head from auto_map, or the robust scan of the modeling module
+    if target is None:
+        auto_map = getattr(config, "auto_map", None) or {}
+        for key in ("AutoModelForCausalLM", "AutoModelForImageTextToText", "AutoModelForVision2Seq"):
+            if isinstance(auto_map.get(key), str):
+                target = get_class_from_dynamic_module(auto_map[key], model_id)
+                source, reference = "remote", auto_map[key]
+                break
+        if target is None and isinstance(auto_map.get("AutoModel"), str):
+            base = get_class_from_dynamic_module(auto_map["AutoModel"], model_id)
+            target = _find_generation_class(sys.modules[base.__module__], exclude=base)
+            if target is not None:
+                source, reference = "remote", auto_map["AutoModel"].rsplit(".", 1)[0] + "." + target.__name__
+    if target is None:
+        raise ValueError(f"Could not find a CausalLM class for {model_id}")
+
+    cache[model_id] = {"revision": revision, "source": source, "reference": reference}
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump(cache, f, indent=2)
+    except OSError as e:
+        print(f"--> [I2T Worker] Warning: could not cache model class: {e}", flush=True)
+    return target, config
+
+def load_i2t_model(model_id, prefix="I2T Worker"):
+    """Loads a vision-language model once, straight onto the GPU(s) (safetensors shards are memory-mapped)."""
+    target, config = resolve_i2t_model_class(model_id)
+    print(f"--> [{prefix}] Loading Model ({target.__name__})...", flush=True)
+    return target.from_pretrained(
+        model_id, config=config, torch_dtype=torch.bfloat16, trust_remote_code=True,
+        low_cpu_mem_usage=True, device_map="auto"
+    ).eval()
+
+def execution_device(pipe):
+    """
+    Device a pipeline computes on (the GPU under offload hooks), or a transformers model its inputs go to;
+    the CPU on a GPU-less worker.
+    """
+    device = getattr(pipe, "_execution_device", None) or getattr(pipe, "device", None)
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return device
+
+def pin_vision_encoders(pipe):
+    """Fix Vision Encoder Pinning (Required for model_cpu_offload in i2i, see memory_planner)."""
+    device = execution_device(pipe)
+    vision_components = ["vision_language_encoder", "vision_model", "image_encoder"]
+    for name in vision_components:
+        if hasattr(pipe, name) and getattr(pipe, name) is not None:
+            getattr(pipe, name).to(device)
+
+def read_lora_config(config_path):
+    """Returns the worker LoRA list [[path, strength, active], ...] stored in config_path."""
+    if not config_path or not os.path.exists(config_path):
+        return []
+    try:
+        with open(config_path, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"--> [LoRA] ⚠️ Could not read config: {e}", flush=True)
+        return []
+
 def load_loras(pipe, config_path):
     """
     Loads and fuses LoRA adapters into the pipeline based on the config file.
     """
-    if not config_path or not os.path.exists(config_path): 
+    apply_loras(pipe, read_lora_config(config_path))
+
+def apply_loras(pipe, data):
+    """
+    Loads and fuses LoRA adapters given in worker format [[path, strength, active], ...].
+    """
+    if not data:
         return
-    
+
     try:
-        with open(config_path, 'r') as f:
-            data = json.load(f)
-        
         adapters, weights = [], []
         for i, item in enumerate(data):
             # Format expected: [path, strength, active]
@@ -102,3 +469,80 @@ def load_loras(pipe, config_path):
 
     except Exception as e:
         print(f"--> [LoRA] ❌ Error: {e}", flush=True)
+
+
+class LoraAdapterCache:
+    """
+    Keeps LoRA adapters loaded in a resident pipeline, keyed by (path, mtime).
+    Switching LoRAs or strengths only calls set_adapters (no fuse, no reload);
+    a file is loaded again only if it changed on disk. Adapters not used by the
+    current job are dropped least-recently-used once more than max_loaded are kept.
+    """
+
+    def __init__(self, pipe, max_loaded=None):
+        self.pipe = pipe
+        self.max_loaded = max_loaded or int(os.environ.get("GLM_MAX_LOADED_LORAS", "6"))
+        self.adapters = OrderedDict()  # (path, mtime) -> adapter name
+        self.counter = 0
+        self.enabled = True
+
+    def _delete(self, key):
+        name = self.adapters.pop(key)
+        try:
+            self.pipe.delete_adapters(name)
+            print(f"--> [LoRA] 🗑️ Dropped cached adapter {os.path.basename(key[0])}", flush=True)
+        except Exception as e:
+            print(f"--> [LoRA] ⚠️ Could not drop {name}: {e}", flush=True)
+
+    def _ensure_loaded(self, path):
+        key = (path, os.path.getmtime(path))
+        if key in self.adapters:
+            self.adapters.move_to_end(key)
+            return self.adapters[key]
+
+        # Same file modified on disk: the old weights are stale
+        for stale in [k for k in self.adapters if k[0] == path]:
+            self._delete(stale)
+
+        self.counter += 1
+        name = f"lora_{self.counter}"
+        print(f"--> [LoRA] 🧩 Loading: {os.path.basename(path)}", flush=True)
+        self.pipe.load_lora_weights(path, adapter_name=name)
+        self.adapters[key] = name
+        return name
+
+    def activate(self, data):
+        """Makes exactly the active entries of [[path, strength, active], ...] drive the pipeline."""
+        start = time.time()
+        weights = OrderedDict()  # adapter name -> summed strength (same file listed twice)
+        for item in data or []:
+            path, strength, active = item[0], float(item[1]), bool(item[2])
+            if not active:
+                continue
+            if not os.path.exists(path):
+                print(f"--> [LoRA] ⚠️ Missing file: {path}", flush=True)
+                continue
+            try:
+                name = self._ensure_loaded(path)
+                weights[name] = weights.get(name, 0.0) + strength
+            except Exception as e:
+                print(f"--> [LoRA] ❌ Error loading {os.path.basename(path)}: {e}", flush=True)
+
+        if weights:
+            if not self.enabled:
+                self.pipe.enable_lora()
+                self.enabled = True
+            self.pipe.set_adapters(list(weights), adapter_weights=list(weights.values()))
+            print(f"--> [LoRA] ✅ Activated {len(weights)} LoRAs in {time.time() - start:.2f}s "
+                  f"({len(self.adapters)} cached)", flush=True)
+        elif self.adapters and self.enabled:
+            self.pipe.disable_lora()
+            self.enabled = False
+            print("--> [LoRA] ⏸️ LoRAs disabled (kept in cache)", flush=True)
+
+        in_use = set(weights)
+        for key in list(self.adapters):
+            if len(self.adapters) <= self.max_loaded:
+                break
+            if self.adapters[key] not in in_use:
+                self._delete(key)
@@ -5,11 +5,13 @@
 
 // --- GLOBAL STATE ---
 let loraFiles = [];
+let loraCatalog = {}; // filename -> header metadata from /api/scan_loras
 let timerInterval;
 let startTime;
 let currentMode = "t2i";
 let uploadedImageDims = { w: 0, h: 0 }; // Dimensioni originali immagine caricata
 let i2tFullResponse = ""; // Buffer per accumulare il testo I2T
+let currentJobId = null; // Job ID assigned by the server queue (JOB| event)
 
 // --- DOM ELEMENTS REFERENCE ---
 
@@ -161,6 +163,14 @@ function startTimer() {
 
 function stopTimer() { clearInterval(timerInterval); }
 
+function showProgress(p) {
+    // Structured per-step progress from the worker (PROGRESS| events)
+    let text = `⏳ ${p.label ? p.label + ' · ' : ''}Step ${p.step}/${p.total}`;
+    if (p.it_s) text += ` · ${p.it_s} it/s`;
+    if (p.eta !== null && p.eta !== undefined) text += ` · ETA ${Math.ceil(p.eta)}s`;
+    statusText.innerText = text;
+}
+
 let currentResultPath = "";
 
 // Separate Prompt Buffers
@@ -192,8 +202,7 @@ function toggleSystemLog() {
 function showImage(url) {
     placeholder.style.display = 'none';
     imgArea.style.display = 'flex';
-    // Timestamp per evitare cache del browser
-    // Timestamp per evitare cache del browser
+    // Outputs never change once written: no cache-busting query, the browser cache serves repeats
     currentResultPath = url; // Save relative path
 
     // Save to buffer
@@ -201,12 +210,20 @@ function showImage(url) {
         imageBuffers[currentMode] = url;
     }
 
-    resultImg.src = url + "?t=" + Date.now();
+    resultImg.src = url;
     resultImg.style.display = 'block';
 
     // Show Action Buttons
 }
 
+// Quick JPEG sent while the final file is being written: shown, but not kept as the result
+function showPreview(url) {
+    placeholder.style.display = 'none';
+    imgArea.style.display = 'flex';
+    resultImg.src = url;
+    resultImg.style.display = 'block';
+}
+
 // --- TAB SWITCHING LOGIC ---
 
 window.switchTab = function (mode, btn) {
@@ -225,7 +242,7 @@ window.switchTab = function (mode, btn) {
         const savedImg = imageBuffers[mode];
         if (savedImg) {
             currentResultPath = savedImg;
-            resultImg.src = savedImg + "?t=" + Date.now();
+            resultImg.src = savedImg;
             resultImg.style.display = 'block';
             placeholder.style.display = 'none';
             imgArea.style.display = 'flex';
@@ -471,6 +488,9 @@ async function scanLoras() {
         });
         const data = await res.json();
 
+        loraCatalog = {};
+        (data.catalog || []).forEach(entry => { loraCatalog[entry.filename] = entry; });
+
         if (data.files && data.files.length > 0) {
             loraFiles = data.files;
             // Update potential existing selects
@@ -486,12 +506,25 @@ async function scanLoras() {
     }
 }
 
+function describeLora(filename) {
+    const meta = loraCatalog[filename];
+    if (!meta) return filename;
+    if (meta.error) return `${filename}\n⚠️ ${meta.error}`;
+    const lines = [filename, `${(meta.size / 1048576).toFixed(1)} MB`];
+    if (meta.rank) lines.push(`Rank: ${meta.rank}${meta.alpha ? ` (alpha ${meta.alpha})` : ''}`);
+    if (meta.target_modules && meta.target_modules.length) lines.push(`Targets: ${meta.target_modules.join(', ')}`);
+    if (meta.base_model) lines.push(`Base: ${meta.base_model}`);
+    if (meta.trigger_words && meta.trigger_words.length) lines.push(`Triggers: ${meta.trigger_words.join(', ')}`);
+    return lines.join('\n');
+}
+
 function populateSelect(sel, selectedValue = "") {
     sel.innerHTML = '<option value="">(None)</option>';
     loraFiles.forEach(f => {
         const opt = document.createElement('option');
         opt.value = f;
         opt.innerText = f;
+        opt.title = describeLora(f);
         if (f === selectedValue) opt.selected = true;
         sel.appendChild(opt);
     });
@@ -532,7 +565,7 @@ function updatePreviews() {
         const p1 = uploadedPathInput.value;
         if (p1) {
             let url = p1.startsWith('/app/') ? p1.substring(4) : p1;
-            preview1.src = url + "?t=" + Date.now();
+            preview1.src = url;
             preview1.classList.remove('hidden');
             btnDel1.classList.remove('hidden');
             uploadZone1.classList.add('has-image');
@@ -550,7 +583,7 @@ function updatePreviews() {
         const p2 = uploadedPathInput2.value;
         if (p2) {
             let url = p2.startsWith('/app/') ? p2.substring(4) : p2;
-            preview2.src = url + "?t=" + Date.now();
+            preview2.src = url;
             preview2.classList.remove('hidden');
             btnDel2.classList.remove('hidden');
             uploadZone2.classList.add('has-image');
@@ -625,15 +658,40 @@ window.swapUploadedImages = function () {
 
 
 
+// SHA-256 of a file (hex), or null where WebCrypto is unavailable (plain HTTP on a LAN address)
+async function fileDigest(file) {
+    if (!window.crypto || !window.crypto.subtle) return null;
+    try {
+        const hash = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        return Array.from(new Uint8Array(hash)).map(b => b.toString(16).padStart(2, '0')).join('');
+    } catch (e) {
+        return null;
+    }
+}
+
 async function handleFileUploadGeneral(file, pathInput) {
     const formData = new FormData();
     formData.append("file", file);
     // Visual feedback handled by updatePreviews or loading state if added
 
     try {
+        // Content already on the server: reuse it without sending the bytes again
+        const digest = await fileDigest(file);
+        if (digest) {
+            const known = await fetch(`/api/upload_image/${digest}`);
+            if (known.ok) {
+                const data = await known.json();
+                pathInput.value = data.path;
+                log("Already uploaded: " + file.name);
+                updatePreviews();
+                return;
+            }
+        }
+
         const res = await fetch('/api/upload_image', { method: 'POST', body: formData });
         const data = await res.json();
 
+        if (data.error) log("Upload failed: " + data.error, true);
         if (data.path) {
             pathInput.value = data.path;
             log("Uploaded: " + file.name);
@@ -692,6 +750,7 @@ let isProcessing = false;
 function setGenerationState(processing) {
     if (!btnGenerate) return; // Safety Check
     isProcessing = processing;
+    if (!processing) currentJobId = null;
 
     if (processing) {
         // STOP STATE
@@ -721,7 +780,8 @@ btnGenerate.onclick = async () => {
     // IF PROCESSING -> STOP
     if (isProcessing) {
         if (confirm("Abort current process?")) {
-            await fetch('/api/stop', { method: 'POST' });
+            if (currentJobId) await fetch(`/api/jobs/${currentJobId}/cancel`, { method: 'POST' });
+            else await fetch('/api/stop', { method: 'POST' });
             log("🛑 Abort Signal Sent", true);
             // State will be reset by the DONE/ERR handler or manually here to be safe
         }
@@ -767,6 +827,8 @@ async function handleI2T() {
     thinkingBox.innerText = "";
     answerBox.innerText = "";
     i2tFullResponse = "";
+    let streamedThought = "";
+    let streamedAnswer = "";
 
     startTimer();
 
@@ -787,17 +849,33 @@ async function handleI2T() {
 
         const reader = response.body.getReader();
         const decoder = new TextDecoder();
+        let pending = ""; // token events are small and frequent: keep a partial event for the next read
 
         while (true) {
             const { value, done } = await reader.read();
             if (done) break;
-            const chunk = decoder.decode(value);
-            const lines = chunk.split('\n\n');
+            pending += decoder.decode(value, { stream: true });
+            const lines = pending.split('\n\n');
+            pending = lines.pop();
             lines.forEach(line => {
                 if (line.startsWith('data: ')) {
                     const content = line.substring(6);
-                    if (content.startsWith('TXT|')) {
-                        // I2T text stream
+                    if (content.startsWith('JOB|')) {
+                        currentJobId = content.substring(4);
+                    } else if (content.startsWith('THINK|')) {
+                        // Tokens of the thinking section, as they are generated
+                        streamedThought += JSON.parse(content.substring(6));
+                        thinkingBox.innerText = streamedThought;
+                        thinkingBox.scrollTop = thinkingBox.scrollHeight;
+                        statusText.innerText = "Thinking...";
+                    } else if (content.startsWith('ANS|')) {
+                        // Tokens of the answer section, as they are generated
+                        streamedAnswer += JSON.parse(content.substring(4));
+                        answerBox.innerText = streamedAnswer;
+                        answerBox.scrollTop = answerBox.scrollHeight;
+                        statusText.innerText = "Answering...";
+                    } else if (content.startsWith('TXT|')) {
+                        // Final I2T text (replaces the streamed tokens)
                         i2tFullResponse += content.substring(4) + "\n";
                         const parsed = parseThinking(i2tFullResponse);
                         thinkingBox.innerText = parsed.thought;
@@ -861,6 +939,7 @@ async function handleGeneration() {
         guidance: parseFloat(sliderCfg.value),
         seed: parseInt(seedInput.value),
         randomize: randomizeCheckbox.checked,
+        batch_size: parseInt(document.getElementById('batch-size').value) || 1,
         loras: loras,
         top_k: parseFloat(sliderTopK.value), // Unified
         temperature: parseFloat(sliderTemp.value), // Unified
@@ -875,18 +954,28 @@ async function handleGeneration() {
 
         const reader = response.body.getReader();
         const decoder = new TextDecoder();
+        let pending = ""; // an event split across reads is completed by the next one
 
         while (true) {
             const { value, done } = await reader.read();
             if (done) break;
-            const chunk = decoder.decode(value);
-            const lines = chunk.split('\n\n');
+            pending += decoder.decode(value, { stream: true });
+            const lines = pending.split('\n\n');
+            pending = lines.pop();
             lines.forEach(line => {
                 if (line.startsWith('data: ')) {
                     const content = line.substring(6);
-                    if (content.startsWith('LOG|')) {
+                    if (content.startsWith('JOB|')) {
+                        currentJobId = content.substring(4);
+                    } else if (content.startsWith('PROGRESS|')) {
+                        showProgress(JSON.parse(content.substring(9)));
+                    } else if (content.startsWith('LOG|')) {
                         log(content.substring(4));
                         statusText.innerText = content.substring(4);
+                    } else if (content.startsWith('PREVIEW|')) {
+                        showPreview(content.substring(8));
+                    } else if (content.startsWith('LATENT|')) {
+                        showPreview(JSON.parse(content.substring(7)).url);
                     } else if (content.startsWith('IMG|')) {
                         showImage(content.substring(4));
                     } else if (content.startsWith('DONE|')) {
@@ -931,25 +1020,26 @@ window.toggleHistory = function () {
     }
 }
 
-async function loadHistory() {
-    try {
-        const res = await fetch('/api/history');
-        const data = await res.json();
-        lastHistoryData = data.history || []; // Store in cache
-        refreshHistoryView(); // Trigger render
-    } catch (e) {
-        console.error("Failed to load history", e);
-    }
+function loadHistory() {
+    // Back to the first (newest) page
+    currentPage = 0;
+    refreshHistoryView();
 }
 
 function refreshHistoryView() {
-    // Prevent caching with timestamp
-    fetch('/api/history?t=' + Date.now())
+    // Server-side pagination: only the current page is fetched (summary = no I2T text)
+    const query = new URLSearchParams({ limit: pageSize, summary: 1, t: Date.now() });
+    if (!showAllHistory) query.set('mode', currentMode);
+    if (currentPage > 0 && historyCursors[currentPage]) query.set('cursor', historyCursors[currentPage]);
+    else currentPage = 0;
+
+    fetch('/api/history?' + query.toString())
         .then(res => res.json())
         .then(data => {
             try {
                 console.log("History Loaded:", data.history);
                 lastHistoryData = data.history || [];
+                historyNextCursor = data.next_cursor || null;
                 if (typeof renderHistoryRobust === 'function') {
                     renderHistoryRobust(lastHistoryData);
                 } else if (typeof renderHistoryNew === 'function') {
@@ -986,11 +1076,24 @@ function renderHistory(items) {
             </div>
         `;
 
-        div.onclick = () => restoreHistoryState(item);
+        div.onclick = () => openHistoryItem(item);
         historyList.appendChild(div);
     });
 }
 
+async function openHistoryItem(item) {
+    // Summary items carry no I2T text: fetch the full record before restoring
+    if (item.summary && item.id) {
+        try {
+            const res = await fetch(`/api/history/item/${encodeURIComponent(item.id)}`);
+            if (res.ok) item = await res.json();
+        } catch (e) {
+            console.error("Failed to load history item", e);
+        }
+    }
+    restoreHistoryState(item);
+}
+
 function restoreHistoryState(item) {
     const p = item.params;
     console.log("Restoring history item:", item); // DEBUG
@@ -1117,7 +1220,7 @@ function renderHistoryNew(items) {
             </div>
         `;
 
-        div.onclick = () => restoreHistoryState(item);
+        div.onclick = () => openHistoryItem(item);
         historyList.appendChild(div);
     });
 }
@@ -1127,6 +1230,8 @@ let currentPage = 0;
 let pageSize = 8; // Default for 128px
 let historyIconSize = 128;
 let showAllHistory = false; // New State
+let historyCursors = [null]; // Cursor of each visited page (page 0 = newest)
+let historyNextCursor = null;
 
 function toggleHistoryFilter() {
     showAllHistory = !showAllHistory;
@@ -1149,52 +1254,32 @@ function setHistorySize(size) {
     refreshHistoryView();
 }
 
-function changePage(delta) {
-    const totalPages = Math.ceil(lastValidItemsCount / pageSize);
-    const newPage = currentPage + delta;
+function historyThumbUrl(imageUrl) {
+    // Outputs are served downscaled from the thumbnail cache instead of the full-size PNG
+    if (!imageUrl || !imageUrl.startsWith('/outputs/')) return imageUrl;
+    const name = imageUrl.substring('/outputs/'.length);
+    return `/api/thumb/${encodeURIComponent(name)}?size=${historyIconSize * 2}`;
+}
 
-    if (newPage >= 0 && newPage < totalPages) {
-        currentPage = newPage;
+function changePage(delta) {
+    if (delta > 0 && historyNextCursor) {
+        currentPage += 1;
+        historyCursors[currentPage] = historyNextCursor;
+        refreshHistoryView();
+    } else if (delta < 0 && currentPage > 0) {
+        currentPage -= 1;
         refreshHistoryView();
     }
 }
 
-// Global to track total items for pagination limits
-let lastValidItemsCount = 0;
-
 function renderHistoryRobust(items) {
     historyList.innerHTML = '';
     historyList.scrollTop = 0;
 
-    // 0. SORT DESCENDING (Newest First)
-    items.sort((a, b) => b.timestamp - a.timestamp);
-
-    // 1. FILTER
-    const validItems = items.filter(item => {
-        const p = item.params;
-        if (!p || Object.keys(p).length === 0) return false;
-
-        // Show All Logic
-        if (showAllHistory) return true;
+    // Items arrive already sorted (newest first), mode-filtered and paginated by /api/history
+    const validItems = items.filter(item => item.params && Object.keys(item.params).length > 0);
 
-        const itemMode = (p.params && p.params.mode ? p.params.mode : (p.mode || 'unk')).toString().toUpperCase();
-        const curMode = (currentMode || 'UNK').toString().toUpperCase();
-
-        // DEBUG: Log ignored items to help debugging
-        if (itemMode !== curMode) {
-            // console.log(`[Filter] Hidden: ${itemMode} != ${curMode} for ${item.filename}`);
-        }
-
-        return itemMode === curMode;
-    });
-
-    console.log(`[History] Filtered for ${currentMode.toUpperCase()}: ${validItems.length} items found.`);
-    if (items.length > 0) {
-        // console.log("Sample Item 0:", items[0]);
-    }
-
-    // FIX: Update global count for pagination
-    lastValidItemsCount = validItems.length;
+    console.log(`[History] Page ${currentPage + 1} for ${currentMode.toUpperCase()}: ${validItems.length} items.`);
 
     if (validItems.length === 0) {
         historyList.innerHTML = '<div style="padding:20px; color:#999; text-align:center; font-size:12px;">No history found.</div>';
@@ -1204,11 +1289,6 @@ function renderHistoryRobust(items) {
         return;
     }
 
-    // 2. PAGINATE
-    const totalPages = Math.ceil(validItems.length / pageSize);
-    if (currentPage >= totalPages) currentPage = totalPages - 1;
-    if (currentPage < 0) currentPage = 0;
-
     // Update Buttons State
     const btnPrev = document.getElementById('btn-page-prev');
     const btnNext = document.getElementById('btn-page-next');
@@ -1218,14 +1298,12 @@ function renderHistoryRobust(items) {
         btnPrev.style.cursor = (currentPage <= 0) ? "default" : "pointer";
     }
     if (btnNext) {
-        btnNext.disabled = (currentPage >= totalPages - 1);
-        btnNext.style.opacity = (currentPage >= totalPages - 1) ? "0.3" : "1";
-        btnNext.style.cursor = (currentPage >= totalPages - 1) ? "default" : "pointer";
+        btnNext.disabled = !historyNextCursor;
+        btnNext.style.opacity = !historyNextCursor ? "0.3" : "1";
+        btnNext.style.cursor = !historyNextCursor ? "default" : "pointer";
     }
 
-    const startIdx = currentPage * pageSize;
-    const endIdx = startIdx + pageSize;
-    const pageItems = validItems.slice(startIdx, endIdx);
+    const pageItems = validItems;
 
     // 3. RENDER PAGE
     pageItems.forEach(item => {
@@ -1247,7 +1325,7 @@ function renderHistoryRobust(items) {
 
         div.innerHTML = `
             <div class="history-thumb">
-                <img src="${item.image}" loading="lazy" alt="${item.filename}">
+                <img src="${historyThumbUrl(item.image)}" loading="lazy" alt="${item.filename}">
             </div>
             <div class="history-info" style="position:relative;">
                 <span class="mode-badge" style="background:${isForeign ? '#777' : '#444'}; padding:2px 5px; border-radius:3px; font-size:9px;">${itemMode}</span>
@@ -1281,7 +1359,7 @@ function renderHistoryRobust(items) {
             delRow.appendChild(btnDel);
             actionsDiv.appendChild(delRow);
 
-            div.onclick = () => restoreHistoryState(item);
+            div.onclick = () => openHistoryItem(item);
         }
 
         // UNIVERSAL MOVE BUTTONS (For I2I/I2T modes)
@@ -1353,7 +1431,7 @@ function renderHistoryRobust(items) {
     controlsDiv.style.borderTop = "1px solid #333";
     controlsDiv.style.marginTop = "auto";
     controlsDiv.innerHTML = `
-        <span style="font-size:11px; color:#888;">Page ${currentPage + 1} / ${totalPages}</span>
+        <span style="font-size:11px; color:#888;">Page ${currentPage + 1}${historyNextCursor ? "" : " (last)"}</span>
         <div style="font-size:10px; color:#555;">(${validItems.length} total)</div>
     `;
     historyList.appendChild(controlsDiv);
@@ -1430,7 +1508,7 @@ function updateParamVisibility() {
     const isI2T = (currentMode === 'i2t');
 
     // IDs to disable/enable
-    const ids = ['width', 'height', 'steps', 'guidance', 'seed', 'randomize'];
+    const ids = ['width', 'height', 'steps', 'guidance', 'seed', 'randomize', 'batch-size'];
     ids.forEach(id => {
         const el = document.getElementById(id);
         if (el) {
@@ -0,0 +1,149 @@
+import os
+import re
+import json
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+import history_index
+import thumbnails
+from PIL import Image
+
+# Files in OUTPUT_DIR: content-addressed uploads and removal of a history entry
+# together with everything it produced (image, sweep cells, thumbnails, index row).
+OUTPUT_DIR = "/app/outputs"
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp")
+UPLOAD_CHUNK = 1024 * 1024
+MAX_UPLOAD_MB = int(os.environ.get("GLM_MAX_UPLOAD_MB", "200"))
+
+# path -> (size, mtime, sha256), so large files (LoRAs, gallery images) are hashed once per change.
+# Shared by uploads, result fingerprints, ETags and the thumbnail cache keys.
+# LRU bounded by GLM_DIGEST_CACHE_ITEMS: a large gallery does not grow it for the life of the server.
+MAX_DIGESTS = int(os.environ.get("GLM_DIGEST_CACHE_ITEMS", "20000"))
+_digests = OrderedDict()
+_digests_lock = threading.Lock()  # called from request threads
+
+def _remember_digest(path, st, digest):
+    with _digests_lock:
+        _digests[path] = (st.st_size, st.st_mtime, digest)
+        _digests.move_to_end(path)
+        while len(_digests) > MAX_DIGESTS:
+            _digests.popitem(last=False)
+
+def file_digest(path):
+    """SHA-256 of a file's content, memoized until its size or mtime changes."""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    with _digests_lock:
+        entry = _digests.get(path)
+        if entry is not None and entry[:2] == (st.st_size, st.st_mtime):
+            _digests.move_to_end(path)
+            return entry[2]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    _remember_digest(path, st, digest)
+    return digest
+
+def upload_name(filename, digest):
+    """Content-addressed name of an upload: readable stem of the original name + start of its SHA-256."""
+    stem, ext = os.path.splitext(os.path.basename(filename))
+    stem = re.sub(r"[^\w.-]+", "_", stem).strip("._")[:64] or "upload"
+    return f"{stem}_{digest[:16]}{ext.lower()}"
+
+def find_upload(digest, output_dir=OUTPUT_DIR, db_path=None):
+    """Stored upload with this SHA-256 ({path, filename, width, height, format, size}), None if unknown or deleted."""
+    known = history_index.find_upload(digest.lower(), db_path=db_path or history_index.DB_PATH)
+    if known is None:
+        return None
+    path = os.path.join(output_dir, known["filename"])
+    if not os.path.exists(path):
+        return None
+    return dict(known, path=path)
+
+def save_upload(fileobj, filename, output_dir=OUTPUT_DIR, db_path=None):
+    """
+    Streams an uploaded file object into output_dir in chunks while hashing it (blocking:
+    run it off the event loop). Identical bytes are stored once: a known digest returns
+    the existing file. New files are validated by decoding them once, and their size is
+    recorded with the digest. Raises ValueError for rejected files.
+    Returns {path, filename, width, height, format, size, existing}.
+    """
+    if not filename.lower().endswith(IMAGE_EXTS):
+        raise ValueError(f"Unsupported file type: {os.path.basename(filename)}")
+    os.makedirs(output_dir, exist_ok=True)
+    tmp_path = os.path.join(output_dir, f".upload_{uuid.uuid4().hex}.tmp")
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as buffer:
+            for chunk in iter(lambda: fileobj.read(UPLOAD_CHUNK), b""):
+                size += len(chunk)
+                if size > MAX_UPLOAD_MB * 1024 * 1024:
+                    raise ValueError(f"File larger than {MAX_UPLOAD_MB} MB")
+                h.update(chunk)
+                buffer.write(chunk)
+        digest = h.hexdigest()
+
+        known = find_upload(digest, output_dir, db_path)
+        if known is not None:
+            return dict(known, existing=True)
+
+        try:
+            with Image.open(tmp_path) as img:
+                img.load()
+                width, height = img.size
+                fmt = img.format
+        except Exception as e:
+            raise ValueError(f"Not a valid image: {os.path.basename(filename)} ({type(e).__name__})")
+
+        name = upload_name(filename, digest)
+        path = os.path.join(output_dir, name)
+        os.replace(tmp_path, path)
+        st = os.stat(path)
+        _remember_digest(os.path.abspath(path), st, digest)  # already hashed
+        history_index.record_upload(digest, name, width, height, fmt, size, db_path=db_path or history_index.DB_PATH)
+        return {"path": path, "filename": name, "width": width, "height": height, "format": fmt,
+                "size": size, "existing": False}
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _remove(path):
+    if os.path.exists(path):
+        thumbnails.invalidate(path)
+        os.remove(path)
+
+def delete_entry(filename, output_dir=OUTPUT_DIR, db_path=None):
+    """
+    Deletes a history entry given its image or its JSON log: the image, the files
+    listed in the log (sweep cells), their thumbnails, the log and its index row.
+    """
+    safe_name = os.path.basename(filename)
+    file_path = os.path.join(output_dir, safe_name)
+    base_name = os.path.splitext(safe_name)[0]
+    json_path = os.path.join(output_dir, base_name + ".json")
+
+    if safe_name.endswith(".json"):
+        json_path = file_path
+        for ext in IMAGE_EXTS:
+            img = os.path.join(output_dir, base_name + ext)
+            if os.path.exists(img):
+                _remove(img)
+                break
+    else:
+        _remove(file_path)
+
+    # Sweeps list their cell images in the log: remove them with it
+    if os.path.exists(json_path):
+        try:
+            with open(json_path, "r") as f:
+                extra_files = json.load(f).get("outputs", {}).get("files", [])
+        except Exception:
+            extra_files = []
+        for name in extra_files:
+            _remove(os.path.join(output_dir, os.path.basename(str(name))))
+        os.remove(json_path)
+    history_index.remove_file(json_path, db_path=db_path or history_index.DB_PATH)
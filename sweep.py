@@ -0,0 +1,206 @@
+import os
+import time
+import copy
+import inspect
+import torch
+import shared_utils
+import thumbnails
+import ipc
+import prior_cache
+import memory_planner
+import output_writer
+from PIL import Image, ImageDraw
+
+# X/Y parameter sweep on the resident T2I pipeline.
+# Every cell is rendered with the same prompt and seed; the outputs are the cell
+# images, a labelled contact sheet and one V2 log (the manifest) for the sweep.
+# Images are claimed and archived like any other output (output_writer).
+
+AXES = ("guidance", "steps", "temperature", "top_k", "lora_strength")
+# Axes that change the AR prior: with any other axis the prior tokens and the
+# prompt embeddings are computed once and shared by every cell.
+# LoRA strength is one of them: prior_cache treats the LoRA set (strengths
+# included) as an input of the AR stage, so a shared prior would be stale.
+AR_AXES = ("temperature", "top_k", "lora_strength")
+SAMPLING_AXES = ("temperature", "top_k")  # AR axes passed to the pipeline call
+MAX_CELLS = 64
+SHEET_CELL_SIZE = 384
+LABEL_HEIGHT = 28
+
+def _cast(axis, value):
+    return int(value) if axis in ("steps", "top_k") else float(value)
+
+def _label(axis, value):
+    return f"{axis}={value}"
+
+def make_contact_sheet(cells, x_labels, y_labels, cell_size=SHEET_CELL_SIZE):
+    """cells[row][col] PIL images -> one labelled grid image."""
+    rows, cols = len(cells), len(cells[0])
+    first = cells[0][0]
+    scale = cell_size / max(first.width, first.height)
+    cw, ch = max(1, int(first.width * scale)), max(1, int(first.height * scale))
+    left = 0 if y_labels == [None] else 160
+
+    sheet = Image.new("RGB", (left + cols * cw, LABEL_HEIGHT + rows * ch), (20, 20, 20))
+    draw = ImageDraw.Draw(sheet)
+    for c, text in enumerate(x_labels):
+        draw.text((left + c * cw + 6, 8), text, fill=(230, 230, 230))
+    for r, text in enumerate(y_labels):
+        if text:
+            draw.text((6, LABEL_HEIGHT + r * ch + ch // 2), text, fill=(230, 230, 230))
+    for r, row in enumerate(cells):
+        for c, img in enumerate(row):
+            sheet.paste(img.resize((cw, ch), Image.LANCZOS), (left + c * cw, LABEL_HEIGHT + r * ch))
+    return sheet
+
+def generate_sweep(pipe, prompt, width, height, steps, guidance, seed, x_axis, x_values,
+                   y_axis=None, y_values=None, loras=None, lora_index=0, top_k=1, temperature=0.6,
+                   lora_cache=None):
+    """
+    Renders every (x, y) combination back to back on an already loaded pipeline. Raises on failure.
+    Returns the path of the contact sheet.
+    """
+    axes = [x_axis] + ([y_axis] if y_axis else [])
+    for axis in axes:
+        if axis not in AXES:
+            raise ValueError(f"Unknown sweep axis: {axis} (expected one of {', '.join(AXES)})")
+    if y_axis == x_axis:
+        raise ValueError("x_axis and y_axis must differ")
+    x_values = [_cast(x_axis, v) for v in x_values]
+    y_values = [_cast(y_axis, v) for v in y_values] if y_axis else [None]
+    if not x_values or not y_values:
+        raise ValueError("Sweep axes need at least one value")
+    if len(x_values) * len(y_values) > MAX_CELLS:
+        raise ValueError(f"Sweep too large ({len(x_values) * len(y_values)} cells, max {MAX_CELLS})")
+    base_loras = loras or []
+    loras = copy.deepcopy(base_loras)
+    if "lora_strength" in axes:
+        if lora_cache is None or not 0 <= lora_index < len(loras):
+            raise ValueError(f"lora_strength sweep needs a LoRA at index {lora_index}")
+
+    sig_params = inspect.signature(pipe.__call__).parameters
+    for axis in SAMPLING_AXES:
+        if axis in axes and axis not in sig_params:
+            raise ValueError(f"This pipeline does not support '{axis}': every cell would be identical")
+
+    base_kwargs = {"width": width, "height": height}
+    # One image per call; placed for the shared AR prior / prompt encoding, then planned again per cell
+    memory_plan = memory_planner.prepare(width, height, 1, guidance, loras)
+    reuse = (not any(axis in AR_AXES for axis in axes)
+             and hasattr(pipe, "generate_prior_tokens") and "prior_token_ids" in sig_params)
+    if reuse:
+        # Shared by every cell: AR prior tokens (the slow part) and the prompt embeddings
+        start = time.time()
+        prior_cache.configure(top_k, temperature, loras)
+        prior_cache.reset_status()
+        device = shared_utils.execution_device(pipe)
+        generator = torch.Generator(device=device).manual_seed(seed)
+        prior_token_ids, _, _ = pipe.generate_prior_tokens(
+            prompt=prompt, height=height, width=width, device=device, generator=generator
+        )
+        prompt_embeds, negative_prompt_embeds = pipe.encode_prompt(prompt, True, device=device, dtype=pipe.dtype)
+        base_kwargs.update({
+            "prompt": None, "prior_token_ids": prior_token_ids,
+            "prompt_embeds": prompt_embeds, "negative_prompt_embeds": negative_prompt_embeds
+        })
+        shared_prior_status = prior_cache.last_status()
+        print(f"--> [Sweep] Prior tokens and prompt embeddings computed once ({time.time() - start:.1f}s)", flush=True)
+    else:
+        base_kwargs["prompt"] = prompt
+        shared_prior_status = None
+
+    # Claims sweep_<time> for the contact sheet; the cells are named after it
+    policy = output_writer.resolve_policy()
+    ext = output_writer.extension(policy)
+    sheet_path = shared_utils.unique_output_path("sweep", ext)
+    stamp = os.path.splitext(os.path.basename(sheet_path))[0]
+
+    def emit_result(output_info, path):
+        # Background thread, once the archival file is written
+        ipc.emit("result", kind="image", path=path)
+    cells, cell_files = [], []
+    total = len(x_values) * len(y_values)
+    print(f"--> [Sweep] {total} cells: {' x '.join(axes)}", flush=True)
+
+    for r, y in enumerate(y_values):
+        row = []
+        for c, x in enumerate(x_values):
+            cell = {"guidance": guidance, "steps": steps, "temperature": temperature, "top_k": top_k}
+            cell[x_axis] = x
+            if y_axis:
+                cell[y_axis] = y
+
+            if "lora_strength" in axes:
+                loras[lora_index][1] = cell["lora_strength"]
+                with shared_utils.stage_timer.stage("lora"):
+                    lora_cache.activate(loras)
+
+            plan = memory_planner.prepare(width, height, 1, cell["guidance"], loras)
+            kwargs = dict(base_kwargs)
+            kwargs.update({
+                "num_inference_steps": cell["steps"], "guidance_scale": cell["guidance"],
+                "generator": torch.Generator(device=shared_utils.execution_device(pipe)).manual_seed(seed)
+            })
+            if "top_k" in sig_params and cell["top_k"] is not None:
+                kwargs["top_k"] = int(cell["top_k"])
+            if "temperature" in sig_params and cell["temperature"] is not None:
+                kwargs["temperature"] = float(cell["temperature"])
+            if "callback_on_step_end" in sig_params:
+                kwargs["callback_on_step_end"] = shared_utils.make_progress_callback(
+                    cell["steps"], label=f"Cell {r * len(x_values) + c + 1}/{total}"
+                )
+
+            if not reuse:
+                prior_cache.configure(cell["top_k"], cell["temperature"], loras)
+                prior_cache.reset_status()
+            start = time.time()
+            with shared_utils.stage_timer.stage("denoise", sync=True):
+                image = pipe(**kwargs).images[0]
+            plan = memory_planner.observe(plan)
+            if plan and plan.get("actual_peak_mb", 0) >= (memory_plan or {}).get("actual_peak_mb", 0):
+                memory_plan = plan  # the manifest records the cell with the highest peak
+            print(f"--> [Sweep] Cell {r * len(x_values) + c + 1}/{total} "
+                  f"({', '.join(_label(a, cell[a]) for a in axes)}) in {time.time() - start:.1f}s", flush=True)
+            cell_path = shared_utils.unique_output_path("sweep", ext, base=f"{stamp}_r{r}_c{c}")
+            with shared_utils.stage_timer.stage("save"):
+                ipc.emit("result", kind="preview", path=output_writer.write_preview(image, cell_path))
+                output_writer.archive(image, cell_path, policy,
+                                      lambda info, path=cell_path: emit_result(info, path), "Sweep")
+            row.append(image)
+            cell_files.append({"file": os.path.basename(cell_path), "row": r, "col": c,
+                               **{a: cell[a] for a in axes}})
+            if not reuse and prior_cache.last_status():
+                cell_files[-1]["prior_cache"] = prior_cache.last_status()
+        cells.append(row)
+
+    def finish_sheet(output_info):
+        emit_result(output_info, sheet_path)
+        thumbnails.make_thumbnails(sheet_path)
+
+    with shared_utils.stage_timer.stage("save"):
+        sheet = make_contact_sheet(cells, [_label(x_axis, x) for x in x_values],
+                                   [_label(y_axis, y) if y_axis else None for y in y_values])
+        output_writer.archive(sheet, sheet_path, policy, finish_sheet, "Sweep")
+        output_writer.writer.drain()  # the manifest lists files that exist
+
+    # Manifest (V2 log): the contact sheet first, so the history shows it
+    inputs_data = {"prompt": prompt, "loras": base_loras}
+    params_data = {
+        "width": width, "height": height, "steps": steps, "guidance": guidance, "seed": seed,
+        "top_k": top_k, "temperature": temperature,
+        "x_axis": x_axis, "x_values": x_values, "y_axis": y_axis, "y_values": y_values if y_axis else [],
+        "lora_index": lora_index if "lora_strength" in axes else None
+    }
+    outputs_data = {
+        "type": "sweep",
+        "files": [os.path.basename(sheet_path)] + [cell["file"] for cell in cell_files],
+        "cells": cell_files
+    }
+    extra_meta = {"shared_prior": reuse, "prior_cache": shared_prior_status}
+    if memory_plan:
+        extra_meta["memory"] = memory_plan
+    shared_utils.save_generation_log("sweep", inputs_data, params_data, outputs_data, image_path_for_filename=sheet_path,
+                                     extra_meta=extra_meta)
+
+    print("--> [Sweep] Task Completed.", flush=True)
+    return sheet_path
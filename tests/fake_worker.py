@@ -0,0 +1,50 @@
+import os
+import sys
+import json
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import ipc
+
+# Stand-in for worker.py / i2t_worker.py without models or a GPU.
+# Speaks the same protocol: "ready" on start, then for every job line on stdin
+# a progress message, a result, metrics and "done". The result reports the
+# device the worker was pinned to (GLM_DEVICE), so tests can check placement.
+#   args.delay: seconds the job takes (default GLM_FAKE_DELAY or 0)
+#   args.fail:  end the job with an error
+#   args.oversize: send a message longer than ipc.LINE_LIMIT first
+#   args.tail:  stdout lines printed right before "done" (like "Task Completed.")
+
+DELAY = float(os.environ.get("GLM_FAKE_DELAY", "0"))
+
+def serve():
+    ipc.emit("ready", pid=os.getpid())
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        job = json.loads(line)
+        ipc.set_job(job.get("job_id"))
+        args = job.get("args", {})
+        start = time.time()
+        print(f"--> [Fake Worker] Job {job.get('job_id')} ({job.get('mode', 't2i').upper()})", flush=True)
+        time.sleep(float(args.get("delay", DELAY)))
+        if args.get("oversize"):
+            ipc.emit("log", text="x" * ipc.LINE_LIMIT)
+        ok = not args.get("fail")
+        if ok:
+            ipc.emit("progress", step=1, total=1)
+            ipc.emit("result", kind="text", text=f"device {os.environ.get('GLM_DEVICE')}",
+                     answer=os.environ.get("GLM_DEVICE"))
+        else:
+            ipc.emit("error", message="RuntimeError: fake failure")
+        ipc.emit("metrics", elapsed=round(time.time() - start, 3))
+        for i in range(int(args.get("tail", 0))):
+            print(f"--> [Fake Worker] tail {i}", flush=True)
+        ipc.emit("done", ok=ok)
+        ipc.set_job(None)
+
+if __name__ == "__main__":
+    serve()
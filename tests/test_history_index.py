@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import datetime
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import history_index
+
+def write_log(output_dir, name, seed=1, loras=(), mtime=None):
+    """One V2 T2I log and its image; mtime (unix time) becomes the history timestamp."""
+    image = name + ".png"
+    open(os.path.join(output_dir, image), "wb").close()
+    data = {
+        "meta": {"version": "2.0", "mode": "t2i"},
+        "inputs": {"prompt": f"prompt {name}", "loras": [[f"/app/loras/{l}", 1.0, True] for l in loras]},
+        "parameters": {"seed": seed, "steps": 30},
+        "outputs": {"type": "image", "files": [image]}
+    }
+    path = os.path.join(output_dir, name + ".json")
+    with open(path, "w") as f:
+        json.dump(data, f)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+def make_index(tmp_path, count=5):
+    output_dir, db_path = str(tmp_path / "outputs"), str(tmp_path / "index.db")
+    os.makedirs(output_dir)
+    for i in range(count):
+        write_log(output_dir, f"t2i_{i}", seed=i, mtime=1_700_000_000 + i)
+    history_index.reconcile(output_dir, db_path)
+    return output_dir, db_path
+
+def test_cursor_pages_cover_every_item_once(tmp_path):
+    _, db_path = make_index(tmp_path, count=5)
+    seen, cursor = [], None
+    while True:
+        items, cursor = history_index.query(limit=2, cursor=cursor, db_path=db_path)
+        seen += [item["id"] for item in items]
+        if cursor is None:
+            break
+    assert seen == [f"t2i_{i}.json" for i in reversed(range(5))]
+
+def test_bad_cursor_is_rejected(tmp_path):
+    _, db_path = make_index(tmp_path, count=1)
+    with pytest.raises(ValueError):
+        history_index.query(cursor="not-a-cursor", db_path=db_path)
+
+def test_lora_and_date_filters(tmp_path):
+    output_dir, db_path = make_index(tmp_path, count=3)
+    day = datetime.datetime(2024, 6, 15, 12).timestamp()
+    write_log(output_dir, "t2i_styled", loras=["style.safetensors"], mtime=day)
+    history_index.reconcile(output_dir, db_path)
+
+    items, _ = history_index.query(lora="style.safetensors", db_path=db_path)
+    assert [item["id"] for item in items] == ["t2i_styled.json"]
+    assert items[0]["loras"] == ["style.safetensors"]
+
+    items, _ = history_index.query(date_from="2024-06-15", date_to="2024-06-15", db_path=db_path)
+    assert [item["id"] for item in items] == ["t2i_styled.json"]
+    items, _ = history_index.query(date_to="2024-06-14", db_path=db_path)
+    assert len(items) == 3
+
+def test_reindexing_replaces_the_loras_of_an_entry(tmp_path):
+    output_dir, db_path = make_index(tmp_path, count=0)
+    path = write_log(output_dir, "t2i_swap", loras=["old.safetensors"])
+    history_index.index_file(path, db_path=db_path)
+    write_log(output_dir, "t2i_swap", loras=["new.safetensors"])
+    history_index.index_file(path, db_path=db_path)
+
+    assert history_index.get_item("t2i_swap.json", db_path=db_path)["loras"] == ["new.safetensors"]
+    assert history_index.query(lora="old.safetensors", db_path=db_path)[0] == []
@@ -0,0 +1,52 @@
+import os
+import sys
+from PIL import Image
+from starlette.applications import Starlette
+from starlette.routing import Mount
+from starlette.testclient import TestClient
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import http_cache
+import storage
+
+def outputs_client(tmp_path):
+    Image.new("RGB", (64, 64), (10, 120, 200)).save(tmp_path / "t2i_1.png")
+    (tmp_path / "notes.txt").write_text("hello")
+    app = Starlette(routes=[Mount("/outputs", app=http_cache.OutputFiles(directory=str(tmp_path)))])
+    return TestClient(app), str(tmp_path / "t2i_1.png")
+
+def test_output_images_have_a_content_etag_and_answer_304(tmp_path):
+    client, path = outputs_client(tmp_path)
+    response = client.get("/outputs/t2i_1.png")
+    assert response.status_code == 200
+    assert response.headers["etag"] == f'"{storage.file_digest(path)}"'
+    assert response.headers["cache-control"] == http_cache.IMMUTABLE
+
+    again = client.get("/outputs/t2i_1.png", headers={"If-None-Match": response.headers["etag"]})
+    assert again.status_code == 304 and again.content == b""
+    assert client.get("/outputs/t2i_1.png", headers={"If-None-Match": '"other"'}).status_code == 200
+    assert client.get("/outputs/notes.txt").headers["cache-control"] == http_cache.REVALIDATE
+
+def test_output_images_answer_range_requests(tmp_path):
+    client, path = outputs_client(tmp_path)
+    with open(path, "rb") as f:
+        data = f.read()
+    response = client.get("/outputs/t2i_1.png", headers={"Range": "bytes=0-9"})
+    assert response.status_code == 206
+    assert response.content == data[:10]
+    assert response.headers["content-range"] == f"bytes 0-9/{len(data)}"
+
+def test_compressed_static_assets_refuse_ranges(tmp_path):
+    (tmp_path / "script.js").write_text("console.log('glm');\n" * 200)
+    Image.new("RGB", (8, 8)).save(tmp_path / "logo.png")
+    app = Starlette(routes=[Mount("/static", app=http_cache.StaticAssets(directory=str(tmp_path)))])
+    client = TestClient(app)
+
+    response = client.get("/static/script.js", headers={"Range": "bytes=0-9", "Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["accept-ranges"] == "none"
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.text == "console.log('glm');\n" * 200
+    assert client.get("/static/logo.png", headers={"Range": "bytes=0-9"}).status_code == 206
@@ -0,0 +1,53 @@
+import os
+import sys
+import asyncio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import job_queue
+
+def test_cancel_while_starting_reaches_the_hook():
+    async def scenario():
+        started, hooked = asyncio.Event(), []
+        release = asyncio.Event()
+
+        async def runner(job):
+            started.set()
+            await release.wait()  # e.g. waiting for a device or for the worker to start
+            job.set_cancel_hook(lambda: hooked.append(job.id))
+            return True
+
+        scheduler = job_queue.JobScheduler({"t2i": runner})
+        job = scheduler.submit("t2i", {})
+        await started.wait()
+        assert scheduler.cancel(job.id)
+        release.set()
+        while not job.is_finished():
+            await asyncio.sleep(0.01)
+        return job, hooked
+
+    job, hooked = asyncio.run(scenario())
+    assert hooked == [job.id]
+    assert job.state == job_queue.CANCELLED
+
+def test_cancel_queued_job():
+    async def scenario():
+        release = asyncio.Event()
+
+        async def runner(job):
+            await release.wait()
+            return True
+
+        scheduler = job_queue.JobScheduler({"t2i": runner}, concurrency=1)
+        first, second = scheduler.submit("t2i", {}), scheduler.submit("t2i", {})
+        await asyncio.sleep(0.01)
+        assert scheduler.cancel(second.id)
+        release.set()
+        while not first.is_finished():
+            await asyncio.sleep(0.01)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first.state == job_queue.DONE
+    assert second.state == job_queue.CANCELLED
@@ -0,0 +1,41 @@
+import os
+import sys
+import json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import history_index
+import result_cache
+
+ARGS = {"prompt": "a lighthouse", "width": 1024, "height": 1024, "steps": 30, "guidance": 3.0,
+        "seed": 42, "top_k": 1, "temperature": 0.6, "loras": []}
+
+def store_result(output_dir, db_path, name, fp):
+    """A finished T2I output whose log carries the request fingerprint."""
+    open(os.path.join(output_dir, name + ".png"), "wb").close()
+    path = os.path.join(output_dir, name + ".json")
+    with open(path, "w") as f:
+        json.dump({"meta": {"version": "2.0", "mode": "t2i", "fingerprint": fp},
+                   "inputs": {"prompt": ARGS["prompt"]}, "parameters": {"seed": ARGS["seed"]},
+                   "outputs": {"type": "image", "files": [name + ".png"]}}, f)
+    history_index.index_file(path, db_path=db_path)
+
+def test_fingerprint_ignores_preview_every_and_i2i_only_fields():
+    fp = result_cache.fingerprint("t2i", ARGS)
+    assert result_cache.fingerprint("t2i", dict(ARGS, preview_every=5)) == fp
+    assert result_cache.fingerprint("t2i", dict(ARGS, strength=0.3)) == fp
+    assert result_cache.fingerprint("t2i", dict(ARGS, steps=31)) != fp
+    assert result_cache.fingerprint("i2i", ARGS) != fp
+
+def test_lookup_hits_only_while_every_output_exists(tmp_path):
+    output_dir, db_path = str(tmp_path), str(tmp_path / "index.db")
+    fp = result_cache.fingerprint("t2i", ARGS)
+    assert result_cache.lookup(fp, 1, output_dir, db_path) is None
+
+    store_result(output_dir, db_path, "t2i_1", fp)
+    assert result_cache.lookup(fp, 1, output_dir, db_path) == ["t2i_1.png"]
+    assert result_cache.lookup(fp, 2, output_dir, db_path) is None  # batch of two, one stored
+
+    os.remove(os.path.join(output_dir, "t2i_1.png"))
+    assert result_cache.lookup(fp, 1, output_dir, db_path) is None
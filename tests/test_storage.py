@@ -0,0 +1,57 @@
+import io
+import os
+import sys
+import json
+import pytest
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import history_index
+import storage
+import thumbnails
+
+def png_bytes(color=(200, 30, 30)):
+    buf = io.BytesIO()
+    Image.new("RGB", (32, 24), color).save(buf, "PNG")
+    return buf.getvalue()
+
+def test_identical_uploads_are_stored_once(tmp_path):
+    output_dir, db_path = str(tmp_path), str(tmp_path / "index.db")
+    first = storage.save_upload(io.BytesIO(png_bytes()), "My Photo.png", output_dir, db_path)
+    again = storage.save_upload(io.BytesIO(png_bytes()), "renamed.png", output_dir, db_path)
+    other = storage.save_upload(io.BytesIO(png_bytes((0, 0, 255))), "My Photo.png", output_dir, db_path)
+
+    assert not first["existing"] and (first["width"], first["height"]) == (32, 24)
+    assert again["existing"] and again["filename"] == first["filename"]
+    assert other["filename"] != first["filename"]
+    assert sorted(n for n in os.listdir(output_dir) if n.endswith(".png")) == sorted([first["filename"], other["filename"]])
+
+def test_rejected_upload_leaves_nothing_behind(tmp_path):
+    output_dir, db_path = str(tmp_path), str(tmp_path / "index.db")
+    with pytest.raises(ValueError):
+        storage.save_upload(io.BytesIO(b"not an image"), "broken.png", output_dir, db_path)
+    with pytest.raises(ValueError):
+        storage.save_upload(io.BytesIO(png_bytes()), "notes.txt", output_dir, db_path)
+    assert [n for n in os.listdir(output_dir) if not n.startswith("index.db")] == []
+
+def test_delete_entry_removes_sweep_cells_thumbnails_and_row(tmp_path, monkeypatch):
+    output_dir, db_path = str(tmp_path / "outputs"), str(tmp_path / "index.db")
+    os.makedirs(output_dir)
+    monkeypatch.setattr(thumbnails, "THUMB_DIR", str(tmp_path / "thumbs"))
+    files = ["sweep_1.png", "sweep_1_r0_c0.png", "sweep_1_r0_c1.png"]
+    for name in files:
+        Image.new("RGB", (16, 16)).save(os.path.join(output_dir, name))
+    log = os.path.join(output_dir, "sweep_1.json")
+    with open(log, "w") as f:
+        json.dump({"meta": {"mode": "sweep"}, "inputs": {"prompt": "grid"}, "parameters": {},
+                   "outputs": {"type": "sweep", "files": files}}, f)
+    history_index.index_file(log, db_path=db_path)
+    thumbnails.get_thumbnail(os.path.join(output_dir, "sweep_1.png"), 128)
+    assert os.listdir(thumbnails.THUMB_DIR)
+
+    storage.delete_entry("sweep_1.json", output_dir, db_path)
+    assert os.listdir(output_dir) == []
+    assert os.listdir(thumbnails.THUMB_DIR) == []
+    assert history_index.get_item("sweep_1.json", db_path=db_path) is None
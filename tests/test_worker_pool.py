@@ -0,0 +1,178 @@
+import os
+import sys
+import time
+import asyncio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import worker_manager
+
+FAKE_WORKER = os.path.join(ROOT, "tests", "fake_worker.py")
+SCRIPTS = {"image": FAKE_WORKER, "i2t": FAKE_WORKER}
+
+def make_pool(devices=("fake0", "fake1"), open_slots=True):
+    pool = worker_manager.WorkerPool(list(devices), SCRIPTS)
+    if open_slots:
+        asyncio.run(pool.open())
+    return pool  # otherwise acquire() opens it on the running loop
+
+class AliveWorker:
+    """Stands in for a ResidentWorker whose process is running."""
+    def is_alive(self):
+        return True
+
+class StoppedWorker:
+    def is_alive(self):
+        return False
+
+def test_fake_devices_hide_gpus():
+    env = worker_manager.device_env("fake1")
+    assert env["CUDA_VISIBLE_DEVICES"] == "" and env["HIP_VISIBLE_DEVICES"] == ""
+    assert env["GLM_DEVICE"] == "fake1"
+    assert worker_manager.device_env("1")["CUDA_VISIBLE_DEVICES"] == "1"
+
+def test_open_uses_given_devices():
+    pool = make_pool(("fake0", "fake1", "fake2"))
+    assert [slot.device for slot in pool.slots] == ["fake0", "fake1", "fake2"]
+    assert pool.size == 3
+
+def test_choose_prefers_preferred_then_loaded_then_loras():
+    pool = make_pool(("fake0", "fake1", "fake2"))
+    a, b, c = pool.slots
+    b.workers["image"] = AliveWorker()
+    c.loras = ["/loras/style.safetensors"]
+    assert pool.choose("image") is b
+    assert pool.choose("image", prefer="fake0") is a
+    c.workers["image"] = AliveWorker()
+    assert pool.choose("image", loras=["/loras/style.safetensors"]) is c
+
+def test_choose_avoids_unloading_other_model_and_spreads_work():
+    pool = make_pool()
+    a, b = pool.slots
+    a.workers["i2t"] = AliveWorker()
+    assert pool.choose("image") is b
+    a.workers["i2t"] = StoppedWorker()
+    a.last_used, b.last_used = time.time(), time.time() - 60
+    assert pool.choose("image") is b  # idle the longest
+
+def test_choose_skips_busy_slots():
+    pool = make_pool()
+    pool.slots[0].job = "running"
+    assert pool.choose("image", prefer="fake0") is pool.slots[1]
+    pool.slots[1].job = "running"
+    assert pool.choose("image") is None
+
+def test_acquire_waits_for_a_free_device():
+    async def scenario():
+        pool = make_pool(("fake0",), open_slots=False)
+        order = []
+
+        async def job(name, hold):
+            async with pool.acquire(name, "image") as slot:
+                order.append((name, slot.device, pool.busy()))
+                await asyncio.sleep(hold)
+
+        await asyncio.gather(job("first", 0.05), job("second", 0))
+        return pool, order
+
+    pool, order = asyncio.run(scenario())
+    assert order == [("first", "fake0", 1), ("second", "fake0", 1)]
+    assert pool.busy() == 0 and pool.slots[0].jobs_run == 2
+
+def test_acquire_runs_jobs_on_separate_devices_concurrently():
+    async def scenario():
+        pool = make_pool(open_slots=False)
+        held = []
+
+        async def job(name):
+            async with pool.acquire(name, "image") as slot:
+                held.append(slot.device)
+                await asyncio.sleep(0.05)
+                return pool.busy()
+
+        busy = await asyncio.gather(job("a"), job("b"))
+        return held, busy
+
+    held, busy = asyncio.run(scenario())
+    assert sorted(held) == ["fake0", "fake1"]
+    assert max(busy) == 2
+
+def test_jobs_run_on_pinned_fake_workers():
+    async def scenario():
+        pool = worker_manager.WorkerPool(["fake0", "fake1"], SCRIPTS)
+        results = []
+
+        async def job(name):
+            async with pool.acquire(name, "image") as slot:
+                answer, ok = None, False
+                async for kind, payload in slot.workers["image"].run_job("t2i", {"delay": 1.0}):
+                    if kind == "msg" and payload.get("kind") == "text":
+                        answer = payload.get("answer")
+                    elif kind == "end":
+                        ok = payload
+                results.append((slot.device, answer, ok))
+
+        try:
+            start = time.time()
+            await asyncio.gather(job("a"), job("b"))
+            elapsed = time.time() - start
+            failed = []
+            async with pool.acquire("c", "image", prefer="fake1") as slot:
+                async for kind, payload in slot.workers["image"].run_job("t2i", {"fail": True}):
+                    if kind == "end":
+                        failed.append(payload)
+            return results, elapsed, failed, pool.alive("image")
+        finally:
+            await pool.stop()
+
+    results, elapsed, failed, alive = asyncio.run(scenario())
+    assert sorted(results) == [("fake0", "fake0", True), ("fake1", "fake1", True)]
+    assert failed == [False]
+    assert alive == 2
+    assert elapsed < 1.9  # 1s each: the two jobs ran at the same time
+
+def test_run_job_drops_a_job_cancelled_before_it_was_sent():
+    async def scenario():
+        worker = worker_manager.ResidentWorker(FAKE_WORKER, env=worker_manager.device_env("fake0"))
+        try:
+            items = [item async for item in worker.run_job("t2i", {}, cancelled=lambda: True)]
+            ok = [payload async for kind, payload in worker.run_job("t2i", {}) if kind == "end"]
+            return items, ok
+        finally:
+            await worker.stop()
+
+    items, ok = asyncio.run(scenario())
+    assert items == [("end", False)]
+    assert ok == [True]  # the worker is still usable
+
+def test_unreadable_message_ends_the_job_with_an_error():
+    async def scenario():
+        worker = worker_manager.ResidentWorker(FAKE_WORKER, env=worker_manager.device_env("fake0"))
+        try:
+            items = [item async for item in worker.run_job("t2i", {"oversize": True})]
+            ok = [payload async for kind, payload in worker.run_job("t2i", {}) if kind == "end"]
+            return items, ok
+        finally:
+            await worker.stop()
+
+    items, ok = asyncio.run(asyncio.wait_for(scenario(), timeout=30))
+    errors = [payload for kind, payload in items if kind == "msg" and payload.get("type") == "error"]
+    assert errors and "stream failed" in errors[0]["message"]
+    assert items[-1] == ("end", False)
+    assert ok == [True]  # restarted after the failure
+
+def test_last_stdout_lines_stay_with_their_job():
+    async def scenario():
+        worker = worker_manager.ResidentWorker(FAKE_WORKER, env=worker_manager.device_env("fake0"))
+        try:
+            first = [item async for item in worker.run_job("t2i", {"tail": 200})]
+            second = [item async for item in worker.run_job("t2i", {})]
+            return first, second
+        finally:
+            await worker.stop()
+
+    first, second = asyncio.run(asyncio.wait_for(scenario(), timeout=30))
+    tail = [payload for kind, payload in first if kind == "log" and "tail" in payload]
+    assert len(tail) == 200 and first[-1] == ("end", True)
+    assert not [payload for kind, payload in second if kind == "log" and "tail" in payload]
@@ -0,0 +1,109 @@
+import os
+import logging
+import threading
+import storage
+from PIL import Image
+
+# Downscaled variants of the images in OUTPUT_DIR, served by /api/thumb.
+# Cache entries are keyed by the SHA-256 of the source file content (storage.file_digest,
+# memoized), so a file overwritten under the same name never serves a stale thumbnail.
+OUTPUT_DIR = "/app/outputs"
+THUMB_DIR = os.environ.get("GLM_THUMB_DIR", "/app/cache/thumbs")
+MAX_CACHE_MB = int(os.environ.get("GLM_THUMB_CACHE_MB", "512"))
+
+# Requested sizes are rounded up to one of these (bounded number of variants per image)
+SIZES = (64, 128, 256, 512)
+EAGER_SIZES = (128, 256)  # generated right after each T2I/I2I save (history icons at 2x)
+FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+QUALITY = 80
+
+_lock = threading.Lock()
+
+def normalize_size(size):
+    for s in SIZES:
+        if size <= s:
+            return s
+    return SIZES[-1]
+
+def resolve_source(filename, output_dir=OUTPUT_DIR):
+    """Path of an image in output_dir, or None (no directory traversal, images only)."""
+    name = os.path.basename(filename)
+    if not name.lower().endswith((".png", ".jpg", ".jpeg", ".webp")):
+        return None
+    path = os.path.join(output_dir, name)
+    return path if os.path.isfile(path) else None
+
+def get_thumbnail(src_path, size=128, fmt="webp"):
+    """Returns (cache_path, media_type) for a downscaled copy of src_path, creating it on a miss."""
+    size = normalize_size(int(size))
+    pil_format, media_type = FORMATS.get(fmt, FORMATS["webp"])
+    ext = "jpg" if pil_format == "JPEG" else "webp"
+    cache_path = os.path.join(THUMB_DIR, f"{storage.file_digest(src_path)}_{size}.{ext}")
+
+    if os.path.exists(cache_path):
+        try:
+            os.utime(cache_path)  # LRU: mtime = last access
+        except OSError:
+            pass
+        return cache_path, media_type
+
+    os.makedirs(THUMB_DIR, exist_ok=True)
+    with Image.open(src_path) as img:
+        img.thumbnail((size, size), Image.LANCZOS)
+        if pil_format == "JPEG" and img.mode != "RGB":
+            img = img.convert("RGB")
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        img.save(tmp_path, pil_format, quality=QUALITY)
+    os.replace(tmp_path, cache_path)
+    enforce_limit()
+    return cache_path, media_type
+
+def make_thumbnails(src_path, sizes=EAGER_SIZES):
+    """Eagerly fills the cache for a freshly saved output. Never raises."""
+    try:
+        for size in sizes:
+            get_thumbnail(src_path, size)
+    except Exception as e:
+        print(f"Warning: thumbnail generation failed for {src_path}: {e}", flush=True)
+
+def invalidate(src_path):
+    """Drops every cached variant of src_path (call before deleting the file)."""
+    try:
+        prefix = storage.file_digest(src_path) + "_"
+    except OSError:
+        return
+    with _lock:
+        if not os.path.isdir(THUMB_DIR):
+            return
+        for entry in os.scandir(THUMB_DIR):
+            if entry.name.startswith(prefix):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+def enforce_limit(max_mb=None):
+    """Evicts the least recently used thumbnails until the cache fits in max_mb (default MAX_CACHE_MB)."""
+    limit = (MAX_CACHE_MB if max_mb is None else max_mb) * 1024 * 1024
+    with _lock:
+        entries = []
+        total = 0
+        for entry in os.scandir(THUMB_DIR):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        if total <= limit:
+            return
+        entries.sort()
+        removed = 0
+        for _, size, path in entries:
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                removed += 1
+            except OSError:
+                pass
+        logging.info(f"--> [Thumbs] Evicted {removed} cached thumbnails")
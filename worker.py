@@ -0,0 +1,102 @@
+import sys
+import os
+import json
+import gc
+import time
+import traceback
+import torch
+import shared_utils
+import prior_cache
+import memory_planner
+import ipc
+import output_writer
+import process_t2i
+import process_i2i
+import sweep
+
+# Resident GLM-Image worker.
+# Loads the pipeline ONCE, then serves t2i / i2i / sweep jobs received as JSON lines on stdin:
+#   {"job_id": "...", "mode": "t2i" | "i2i" | "sweep" | "release", "args": {...}}
+# "release" moves the pipeline off the GPU so another model can use the device.
+# Results, progress and errors go to the server as IPC messages (ipc.py);
+# every job ends with a "done" message carrying ok=true/false.
+
+def serve():
+    print(f"--> [Worker] Starting resident worker PID: {os.getpid()}", flush=True)
+    # Output names claimed by a worker killed mid-job (cancel, crash) would otherwise stay forever
+    stale = shared_utils.remove_stale_claims()
+    if stale:
+        print(f"--> [Worker] Removed {stale} stale output claim(s)", flush=True)
+
+    # The load time is reported with the first job served by this process
+    timer = shared_utils.stage_timer
+    with timer.stage("load"):
+        pipe = shared_utils.load_image_pipeline(process_t2i.MODEL_ID, prefix="Worker")
+        # Placement, VAE tiling and attention are chosen per call from the free VRAM
+        memory_planner.install(pipe, process_t2i.MODEL_ID, prefix="Worker")
+    shared_utils.instrument_pipeline(pipe)
+    prior_cache.install(pipe, process_t2i.MODEL_ID)  # re-renders of the same prompt/seed skip the AR stage
+    lora_cache = shared_utils.LoraAdapterCache(pipe)
+
+    ipc.emit("ready", pid=os.getpid())
+
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+
+        ok = False
+        images = 0
+        start = time.time()
+        try:
+            job = json.loads(line)
+            ipc.set_job(job.get("job_id"))
+            mode = job.get("mode", "t2i")
+            args = dict(job.get("args", {}))
+
+            if mode != "release":
+                # LoRAs stay loaded in the resident pipeline: strength / selection changes are applied in place
+                with timer.stage("lora"):
+                    lora_cache.activate(args.get("loras") or [])
+
+            print(f"--> [Worker] Job {job.get('job_id')} ({mode.upper()})", flush=True)
+            if mode == "release":
+                memory_planner.release()
+            elif mode == "i2i":
+                images = len(process_i2i.generate_i2i(pipe, **args))
+            elif mode == "sweep":
+                sweep.generate_sweep(pipe, lora_cache=lora_cache, **args)
+                images = 1
+            else:
+                images = len(process_t2i.generate_t2i(pipe, **args))
+            ok = True
+
+        except Exception as e:
+            print(f"CRITICAL ERROR IN RESIDENT WORKER:", flush=True)
+            traceback.print_exc()
+            sys.stdout.flush()
+            ipc.emit("error", message=f"{type(e).__name__}: {e}")
+
+        finally:
+            try:
+                output_writer.writer.drain()  # a failed job may still have images being written
+            except Exception as e:
+                print(f"--> [Worker] ⚠️ Background save failed: {e}", flush=True)
+            timings = timer.snapshot()
+            output_writer.write_logs(timings)  # images saved before a failure still get their log
+            gc.collect()
+            torch.cuda.empty_cache()
+            metrics = {"elapsed": round(time.time() - start, 2), "images": images, "timings": timings,
+                       "outputs": output_writer.writer.take_stats()}
+            if torch.cuda.is_available():
+                metrics["max_vram_mb"] = round(memory_planner.take_job_peak() / 2**20)
+                torch.cuda.reset_peak_memory_stats()
+            ipc.emit("metrics", **metrics)
+            ipc.emit("done", ok=ok)
+            ipc.set_job(None)
+            timer.reset()
+
+    print("--> [Worker] stdin closed, exiting.", flush=True)
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,280 @@
+import os
+import sys
+import time
+import uuid
+import asyncio
+import logging
+import subprocess
+from contextlib import asynccontextmanager
+import ipc
+
+# Restart the worker once its resident memory grows past this limit (0 = never)
+MAX_WORKER_RSS_MB = int(os.environ.get("GLM_WORKER_MAX_RSS_MB", "64000"))
+# LoRA adapters a resident image worker keeps loaded (shared_utils.LoraAdapterCache)
+MAX_TRACKED_LORAS = int(os.environ.get("GLM_MAX_LOADED_LORAS", "6"))
+
+def get_rss_mb(pid):
+    """Resident set size of a process in MB, read from /proc (0 if unavailable)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+class ResidentWorker:
+    """
+    Owns a long-lived worker.py process that keeps the GLM-Image pipeline loaded.
+    Jobs are written to its stdin as JSON lines; its IPC messages (see ipc.py) and
+    stdout log lines are streamed back until the "done" message of that job.
+    The process is restarted automatically when it dies or exceeds MAX_WORKER_RSS_MB.
+    """
+
+    def __init__(self, script="worker.py", max_rss_mb=MAX_WORKER_RSS_MB, env=None, label=None):
+        self.script = script
+        self.max_rss_mb = max_rss_mb
+        self.env = env or {}  # e.g. the device pinning of device_env()
+        self.label = label or script
+        self.process = None
+        self.channel = None
+        self.current_job = None
+        self.job_lock = asyncio.Lock()
+        self.proc_lock = asyncio.Lock()
+
+    # --- Process lifecycle ---
+    async def start(self):
+        async with self.proc_lock:
+            if self.is_alive():
+                return
+            logging.info(f"--> [Worker Manager] Starting {self.label}...")
+            self.channel = await ipc.WorkerChannel.spawn("python", "-u", self.script, stdin=True, env=self.env)
+            self.process = self.channel.process
+
+    def is_alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def stop(self):
+        async with self.proc_lock:
+            if self.process is None:
+                return
+            logging.info(f"--> [Worker Manager] Stopping {self.label}...")
+            process, self.process = self.process, None
+            if process.returncode is None:
+                process.terminate()
+                try:
+                    await asyncio.wait_for(process.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+
+    async def restart(self, reason):
+        logging.info(f"--> [Worker Manager] Restarting {self.label} ({reason})")
+        await self.stop()
+        await self.start()
+
+    def cancel_current(self):
+        """Aborts the running job by killing the worker; run_job() starts a fresh one afterwards."""
+        if self.current_job is None or not self.is_alive():
+            return False
+        logging.info(f"--> [Worker Manager] Killing {self.label} (job cancelled)")
+        self.process.kill()
+        return True
+
+    async def _check_memory(self):
+        if not self.max_rss_mb or not self.is_alive():
+            return
+        rss = get_rss_mb(self.process.pid)
+        if rss > self.max_rss_mb:
+            await self.restart(f"RSS {rss:.0f}MB > {self.max_rss_mb}MB")
+
+    # --- Job execution ---
+    async def run_job(self, mode, args, cancelled=None):
+        """
+        Sends one job to the worker and yields its output:
+        ("log", text) for stdout lines, ("msg", dict) for its IPC messages, then a final ("end", ok).
+        Messages of other jobs (e.g. one abandoned mid-stream) are dropped. After "done", stdout is
+        read up to the job's end mark, so its last log lines are not left for the next job.
+        cancelled: fn() -> bool checked once the worker is ready, before the job is sent (a cancel
+        that arrived while waiting for the lock or for a restart never reached cancel_current()).
+        """
+        job_id = uuid.uuid4().hex
+        async with self.job_lock:
+            if not self.is_alive():
+                if self.process is not None:
+                    logging.info(f"--> [Worker Manager] {self.label} died (code {self.process.returncode}), restarting...")
+                await self.start()
+
+            if cancelled is not None and cancelled():
+                yield ("end", False)
+                return
+
+            channel = self.channel
+            self.current_job = channel.current_job = job_id  # from here on cancel_current() kills the worker
+            try:
+                await channel.send({"job_id": job_id, "mode": mode, "args": args})
+                ok, marked = None, False  # "done" and the stdout end mark, in either order
+                while ok is None or not marked:
+                    kind, payload = await channel.next()
+                    if kind == "eof":
+                        await channel.process.wait()
+                        ok = bool(ok)
+                        break
+                    if kind == "end_mark":
+                        marked = marked or payload == job_id
+                        continue
+                    if kind == "msg":
+                        if payload.get("job_id") != job_id:
+                            continue
+                        if payload.get("type") == "done":
+                            ok = bool(payload.get("ok"))
+                            continue
+                    yield (kind, payload)
+                yield ("end", ok)
+            except (BrokenPipeError, ConnectionResetError, OSError) as e:
+                yield ("log", f"Worker pipe error: {e}")
+                yield ("end", False)
+            finally:
+                self.current_job = channel.current_job = None
+
+            await self._check_memory()
+            if not self.is_alive():
+                await self.start()
+
+# --- Device pool ---
+def detect_devices():
+    """
+    Device slots for the worker pool: GLM_DEVICES (e.g. "0,1" or "cpu,cpu" for GPU-less tests),
+    else the devices visible to the server (HIP/CUDA_VISIBLE_DEVICES), else one per GPU found by torch.
+    The torch probe blocks for seconds: WorkerPool.open() runs it in a thread.
+    """
+    for var in ("GLM_DEVICES", "HIP_VISIBLE_DEVICES", "CUDA_VISIBLE_DEVICES"):
+        value = os.environ.get(var, "").strip()
+        if value:
+            return [d.strip() for d in value.split(",") if d.strip()]
+    try:
+        # In a subprocess: the server itself does not import torch
+        probe = subprocess.run([sys.executable, "-c", "import torch; print(torch.cuda.device_count())"],
+                               capture_output=True, text=True, timeout=120)
+        count = int(probe.stdout.strip().splitlines()[-1])
+    except (OSError, ValueError, IndexError, subprocess.TimeoutExpired):
+        count = 0
+    return [str(i) for i in range(count)] or ["0"]
+
+def device_env(device):
+    """Environment of a worker pinned to one device: it sees only that GPU, as cuda:0. cpu/fake slots see none."""
+    visible = "" if device.lower().startswith(("cpu", "fake")) else device
+    return {"HIP_VISIBLE_DEVICES": visible, "CUDA_VISIBLE_DEVICES": visible, "GLM_DEVICE": device}
+
+class DeviceSlot:
+    """One device: its resident workers (one per model, started on demand) and what they have loaded."""
+
+    def __init__(self, device, scripts, max_loras=MAX_TRACKED_LORAS):
+        self.device = device
+        self.env = device_env(device)
+        self.workers = {model: ResidentWorker(script, env=self.env, label=f"{script} [{device}]")
+                        for model, script in scripts.items()}
+        self.job = None           # id of the job holding this device
+        self.loras = []           # LoRA paths recently activated in the image worker, most recent last
+        self.max_loras = max_loras
+        self.jobs_run = 0
+        self.last_used = 0.0
+
+    def holds(self, model):
+        worker = self.workers.get(model)
+        return worker is not None and worker.is_alive()
+
+    def note_loras(self, paths):
+        """Mirrors the worker's LoRA adapter cache (LRU of GLM_MAX_LOADED_LORAS adapters)."""
+        for path in paths:
+            if path in self.loras:
+                self.loras.remove(path)
+            self.loras.append(path)
+        del self.loras[:max(0, len(self.loras) - self.max_loras)]
+
+    def to_dict(self):
+        return {
+            "device": self.device,
+            "job": self.job,
+            "loaded": [model for model in self.workers if self.holds(model)],
+            "loras": list(self.loras),
+            "jobs_run": self.jobs_run,
+            "last_used": self.last_used or None
+        }
+
+class WorkerPool:
+    """
+    One DeviceSlot per device; each job holds one slot while it runs.
+    acquire() picks among the idle slots the one that needs the least loading:
+    the preferred device (e.g. the one holding a chat's KV cache), then a slot whose
+    worker already has the model, then the most of the job's LoRAs, then one with no
+    other model to unload, then the one idle the longest (spreads work across devices).
+    """
+
+    def __init__(self, devices, scripts):
+        self.devices = devices  # None: detect_devices() on open()
+        self.scripts = scripts
+        self.slots = []
+        self._idle = None  # asyncio.Condition, created on the server loop
+
+    async def open(self):
+        """Creates the device slots, probing the GPUs in a thread if no devices were given (idempotent)."""
+        if self.slots:
+            return
+        devices = self.devices or await asyncio.to_thread(detect_devices)
+        if not self.slots:
+            self.slots = [DeviceSlot(device, self.scripts) for device in devices]
+            logging.info(f"--> [Worker Manager] Devices: {', '.join(devices)}")
+
+    @property
+    def size(self):
+        return len(self.slots)
+
+    def choose(self, model, loras=(), prefer=None):
+        """Best idle slot for a job (None if all are busy)."""
+        idle = [slot for slot in self.slots if slot.job is None]
+        if not idle:
+            return None
+
+        def score(slot):
+            others = any(slot.holds(m) for m in slot.workers if m != model)
+            return (slot.device == prefer, slot.holds(model), len(set(loras) & set(slot.loras)),
+                    not others, -slot.last_used)
+        return max(idle, key=score)
+
+    @asynccontextmanager
+    async def acquire(self, job_id, model, loras=(), prefer=None):
+        """Holds the best idle slot for one job (waits if every device is busy)."""
+        await self.open()
+        if self._idle is None:
+            self._idle = asyncio.Condition()
+        async with self._idle:
+            await self._idle.wait_for(lambda: any(slot.job is None for slot in self.slots))
+            slot = self.choose(model, loras, prefer)
+            slot.job = job_id
+        try:
+            yield slot
+        finally:
+            slot.job = None
+            slot.jobs_run += 1
+            slot.last_used = time.time()
+            async with self._idle:
+                self._idle.notify()
+
+    async def start(self, model):
+        """Starts the model's worker on every device (loaded in parallel)."""
+        await self.open()
+        await asyncio.gather(*(slot.workers[model].start() for slot in self.slots))
+
+    async def stop(self):
+        await asyncio.gather(*(worker.stop() for slot in self.slots for worker in slot.workers.values()))
+
+    def alive(self, model):
+        return sum(1 for slot in self.slots if slot.holds(model))
+
+    def busy(self):
+        return sum(1 for slot in self.slots if slot.job is not None)
+
+    def to_list(self):
+        return [slot.to_dict() for slot in self.slots]